@@ -13,8 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
+# as early as possible, so that the startup timeline includes importing our dependencies
+STARTED_AT = time.perf_counter()
+
 import asyncio
 import contextlib
+import importlib
 import logging
 import traceback
 from pathlib import Path
@@ -34,6 +39,10 @@ from bot_bin.bot import Bot
 from discord.ext import commands
 
 from . import utils
+from .utils import admission, pgbouncer
+from .utils.members import MemberResolver
+from .utils.replicas import ReplicaSet
+from .utils.timeline import StartupTimeline
 
 BASE_DIR = Path(__file__).parent
 SQL_DIR = BASE_DIR / 'sql'
@@ -41,16 +50,54 @@ SQL_DIR = BASE_DIR / 'sql'
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('bot')
 
+jinja_env = jinja2.Environment(
+	loader=jinja2.FileSystemLoader(str(SQL_DIR)),
+	line_statement_prefix='-- :')
+
+def queries(template_name):
+	return jinja_env.get_template(template_name).module
+
 class CautiousMemory(Bot):
 	def __init__(self, *args, **kwargs):
-		super().__init__(*args, setup_db=True, **kwargs)
-		self.jinja_env = jinja2.Environment(
-			loader=jinja2.FileSystemLoader(str(SQL_DIR)),
-			line_statement_prefix='-- :')
+		self.timeline = StartupTimeline(STARTED_AT)
+		self.timeline.mark('bot created')
+		member_cache_config = kwargs['config'].get('member_cache', {})
+		super().__init__(*args, setup_db=True, **self.member_cache_options(member_cache_config), **kwargs)
+		self.jinja_env = jinja_env
+		self.member_resolver = MemberResolver(
+			maxsize=member_cache_config.get('size', 10_000),
+			ttl=member_cache_config.get('ttl', 5 * 60))
+		self.replicas = None
+		self.admission = admission.AdmissionController(self.config.get('admission', {}))
+		# command name → extension, for extensions which haven't been loaded yet
+		self.lazy_commands = {
+			command: extension
+			for extension, commands_ in self.lazy_extensions.items()
+			for command in commands_}
+
+	@staticmethod
+	def member_cache_options(member_cache_config):
+		"""return the keyword arguments to discord.Client for the configured member cache mode"""
+		intents = discord.Intents.default()
+		# lean is the default since it doesn't need a privileged intent, which the bot may not be approved for
+		if member_cache_config.get('mode', 'lean') == 'full':
+			# every member of every guild, which needs the (privileged) members intent
+			intents.members = True
+			return dict(intents=intents)
+
+		# lean: cache no members beyond the bot's own. They're looked up as needed by self.member_resolver.
+		return dict(
+			intents=intents,
+			member_cache_flags=discord.MemberCacheFlags.none(),
+			chunk_guilds_at_startup=False)
 
 	def process_config(self):
 		self.owners = set(self.config.get('extra_owners', []))
 		self.config['success_emojis'] = {False: self.config['failure_emoji'], True: self.config['success_emoji']}
+		# this also applies to the listener connection and any read replicas, which share these options
+		self.config['database'].setdefault('record_class', utils.Record)
+		if 'pgbouncer' in self.config:
+			pgbouncer.configure(self.config['database'])
 
 		super().process_config()
 
@@ -64,23 +111,109 @@ class CautiousMemory(Bot):
 		return member.guild_permissions.administrator or await self.is_owner(member)
 
 	def queries(self, template_name):
-		return self.jinja_env.get_template(template_name).module
+		return queries(template_name)
+
+	def read_pool(self, guild_id=None):
+		"""return a pool suitable for read only queries on guild_id's data: a read replica if one is fit to use"""
+		if self.replicas is None:
+			return self.pool
+		return self.replicas.pool(guild_id) or self.pool
+
+	def note_write(self, guild_id):
+		"""record that guild_id's data was just written, so that reads of it don't go to a lagging replica"""
+		if self.replicas is not None:
+			self.replicas.note_write(guild_id)
+
+	### Events
+
+	async def on_ready(self):
+		await super().on_ready()
+		if self.timeline.mark('ready'):
+			logger.info('Startup timeline:\n%s', self.timeline.format())
+
+	async def on_command(self, ctx):
+		if self.timeline.mark('first command'):
+			logger.info('First command %.2fs after startup', self.timeline.elapsed('first command'))
+
+	async def invoke(self, ctx):
+		priority = admission.priority_of(ctx.command.callback) if ctx.command else admission.Priority.interactive
+		with self.admission.classify(priority, ctx.guild and ctx.guild.id):
+			await super().invoke(ctx)
 
-	### Init / Shutdown
+	async def get_context(self, message, *, cls=commands.Context):
+		ctx = await super().get_context(message, cls=cls)
+		if ctx.command is None and ctx.invoked_with in self.lazy_commands:
+			self.load_lazy_extension(self.lazy_commands[ctx.invoked_with])
+			ctx = await super().get_context(message, cls=cls)
+		return ctx
+
+	### Init / Shutdown
 
 	async def init_db(self):
+		# the pool, the listener connection, and the replicas don't depend on each other
+		await asyncio.gather(
+			self.timeline.timed('database pool', self.init_pool()),
+			self.timeline.timed('listener connection', self.init_listener()),
+			self.timeline.timed('read replicas', self.init_replicas()))
+
+	async def init_pool(self):
 		await super().init_db()
-		await self.init_listener()
+		# replicas aren't wrapped, since reads sent to them don't compete for the primary's connections
+		self.pool = admission.AdmittedPool(self.pool, self.admission)
+
+	async def init_replicas(self):
+		replicas_config = self.config.get('database_replicas')
+		if not replicas_config or not replicas_config.get('replicas'):
+			return
+		replicas = ReplicaSet(replicas_config)
+		await replicas.connect(self.config['database'])
+		self.replicas = replicas
+
+	async def start_stateless(self):
+		"""Serve interactions without connecting to the gateway, so nothing is cached about any guild.
+		The HTTP API is still logged in to, since is_owner needs it.
+		"""
+		await self.login(self.config['tokens']['discord'])
+		await self.init_db()
+		for extension in self.stateless_extensions:
+			self.load_extension(extension)
+
+	def load_extensions(self):
+		for extension in self.startup_extensions:
+			with self.timeline.span('import ' + extension):
+				importlib.import_module(extension)
+			with self.timeline.span('setup ' + extension):
+				self.load_extension(extension)
+
+	def load_lazy_extension(self, extension):
+		with self.timeline.span('load lazy extension ' + extension):
+			self.load_extension(extension)
+		for command in self.lazy_extensions[extension]:
+			self.lazy_commands.pop(command, None)
 
 	async def init_listener(self):
-		self.listener_conn = await asyncpg.connect(**self.config['database'])
+		# LISTEN needs a session of its own, so this is the only connection which bypasses PgBouncer
+		self.listener_conn = await asyncpg.connect(**pgbouncer.direct_options(self.config))
 		def on_page_edit(connection, pid, channel, revision_id):
 			# convert an asyncpg event into a discord event
 			self.dispatch('cm_page_edit', int(revision_id))
 		def on_page_delete(connection, pid, channel, payload):
 			guild_id, page_id, title = payload.split(',', 2)
 			self.dispatch('cm_page_delete', int(guild_id), int(page_id), title)
-		self.listener_conn_callbacks = [('page_edit', on_page_edit), ('page_delete', on_page_delete)]
+		def on_wiki_import(connection, pid, channel, guild_id):
+			self.dispatch('cm_wiki_import', int(guild_id))
+		def on_title_change(connection, pid, channel, payload):
+			guild_id, op, page_id, alias, title = payload.split(',', 4)
+			self.dispatch('cm_title_change', int(guild_id), op, int(page_id), alias == 'true', title)
+		def on_api_token_change(connection, pid, channel, payload):
+			user_id, app_id = map(int, payload.split(','))
+			self.dispatch('cm_api_token_change', user_id, app_id)
+		self.listener_conn_callbacks = [
+			('page_edit', on_page_edit),
+			('page_delete', on_page_delete),
+			('wiki_import', on_wiki_import),
+			('title_change', on_title_change),
+			('api_token_change', on_api_token_change)]
 		for channel, callback in self.listener_conn_callbacks:
 			await self.listener_conn.add_listener(channel, callback)
 
@@ -89,17 +222,35 @@ class CautiousMemory(Bot):
 			for channel, callback in self.listener_conn_callbacks:
 				await self.listener_conn.remove_listener(channel, callback)
 			await self.listener_conn.close()
+		if self.replicas is not None:
+			await self.replicas.close()
 		await super().close()
 
 	startup_extensions = utils.expand("""{
 		cautious_memory.cogs.{
-			{permissions,wiki,watch_lists,binding}.{db,commands},
+			{permissions,wiki,watch_lists,binding,export,changelog}.{db,commands},
 			api,
+			api_server,
+			interactions,
+			archive,
+			gc,
 			meta},
-		jishaku,
 		bot_bin.{
 			misc,
-			debug,
 			sql,
 			stats}}
 	""")
+
+	# what start_stateless loads: just enough to serve interactions
+	stateless_extensions = utils.expand("""
+		cautious_memory.cogs.{
+			{permissions,wiki}.{db,commands},
+			interactions}
+	""")
+
+	# owner-only extensions which are slow to import and rarely used.
+	# each is loaded the first time someone tries to use one of the listed commands.
+	lazy_extensions = {
+		'jishaku': ('jishaku', 'jsk'),
+		'bot_bin.debug': ('most-common-types', 'objgrowth', 'mem', 'perf'),
+	}
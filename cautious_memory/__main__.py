@@ -1,8 +1,184 @@
+import argparse
+import asyncio
+import json
+import sys
+
+import asyncpg
 import json5
 
-from . import CautiousMemory, BASE_DIR
+from . import CautiousMemory, BASE_DIR, jinja_env, queries
+from .utils import pgbouncer
+
+def load_config():
+	with open(BASE_DIR.parent / 'config.json5') as f:
+		return json5.load(f)
+
+async def connect(config):
+	# these commands want a session of their own (e.g. migrate takes an advisory lock), so bypass PgBouncer
+	return await asyncpg.connect(**pgbouncer.direct_options(config))
+
+def run(config, args):
+	CautiousMemory(config=config).run()
+
+async def export_guild(config, args):
+	from .cogs.export.db import export_guild
+	from .utils.archive import RevisionArchive
+
+	archive_config = config.get('revision_archive')
+	archive = RevisionArchive(archive_config['path']) if archive_config else None
+
+	conn = await connect(config)
+	try:
+		with open(args.file, 'wb') as fp:
+			await export_guild(conn, queries('export.sql'), args.guild_id, fp, archive=archive)
+	finally:
+		await conn.close()
+
+async def import_guild(config, args):
+	from .cogs.export.db import import_guild
+
+	conn = await connect(config)
+	try:
+		with open(args.file, 'rb') as fp:
+			count = await import_guild(conn, queries('export.sql'), args.guild_id, fp)
+	finally:
+		await conn.close()
+	print(f'Imported {count} pages.')
+
+async def audit_plans(config, args):
+	from .utils.plan_audit import audit
+
+	baseline = None
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+
+	conn = await connect(config)
+	try:
+		result = await audit(conn, queries('plan_audit.sql'), jinja_env, seed=args.seed, baseline=baseline)
+	finally:
+		await conn.close()
+
+	for key, reason in result.skipped.items():
+		print(f'skipped {key}: {reason}', file=sys.stderr)
+	for problem in result.problems:
+		print(problem)
+
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as f:
+			json.dump(result.costs, f, indent='\t', sort_keys=True)
+
+	sys.exit(bool(result.problems))
+
+async def migrate(config, args):
+	from .utils import migrations
+
+	conn = await connect(config)
+	try:
+		await migrations.migrate(
+			conn, queries('migrations.sql'), migrations.load(),
+			dry_run=args.dry_run, baseline=args.baseline, lock_timeout=args.lock_timeout)
+	finally:
+		await conn.close()
+
+def serve_interactions(config, args):
+	bot = CautiousMemory(config=config)
+	bot.loop.run_until_complete(bot.start_stateless())
+	try:
+		bot.loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		bot.loop.run_until_complete(bot.close())
+
+async def register_interactions(config, args):
+	from .cogs.interactions import register_commands
+
+	commands = await register_commands(
+		config['tokens']['discord'], config['interactions']['application_id'], guild_id=args.guild_id)
+	print(f'Registered {len(commands)} commands.')
+
+async def fake_interaction(config, args):
+	from .cogs.interactions import fake_interaction, generate_keys, send_fake_interaction
+
+	if args.generate_keys:
+		signing_key, verify_key = generate_keys()
+		print(f'signing key (for --signing-key): {signing_key}')
+		print(f'public key (for interactions.public_key in the config): {verify_key}')
+		return
+
+	options = dict(option.split('=', 1) for option in args.options)
+	payload = fake_interaction(
+		args.command, options,
+		guild_id=args.guild_id, user_id=args.user_id, role_ids=args.role_id, permissions=args.permissions)
+	interactions_config = config['interactions']
+	url = args.url or f"http://{interactions_config.get('host', '127.0.0.1')}:{interactions_config.get('port', 8081)}/interactions"
+	status, body = await send_fake_interaction(url, args.signing_key, payload)
+	print(status, body)
+
+def main():
+	parser = argparse.ArgumentParser(prog='python -m cautious_memory')
+	parser.set_defaults(func=run)
+	subparsers = parser.add_subparsers()
+
+	export_parser = subparsers.add_parser('export', help="export a guild's wiki to a file")
+	export_parser.add_argument('guild_id', type=int)
+	export_parser.add_argument('file')
+	export_parser.set_defaults(func=lambda config, args: asyncio.run(export_guild(config, args)))
+
+	import_parser = subparsers.add_parser('import', help='import a wiki export into a guild')
+	import_parser.add_argument('guild_id', type=int)
+	import_parser.add_argument('file')
+	import_parser.set_defaults(func=lambda config, args: asyncio.run(import_guild(config, args)))
+
+	audit_parser = subparsers.add_parser(
+		'audit-plans',
+		help='check the query plans of every SQL macro for sequential scans of large tables and cost regressions')
+	audit_parser.add_argument(
+		'--seed', action='store_true',
+		help='add synthetic data first, for databases without much data. It is rolled back afterwards.')
+	audit_parser.add_argument('--baseline', help='fail if any plan costs much more than it did in this file')
+	audit_parser.add_argument('--save-baseline', help='write the cost of each plan to this file')
+	audit_parser.set_defaults(func=lambda config, args: asyncio.run(audit_plans(config, args)))
+
+	migrate_parser = subparsers.add_parser('migrate', help='apply schema migrations')
+	group = migrate_parser.add_mutually_exclusive_group()
+	group.add_argument(
+		'--dry-run', action='store_true',
+		help='show the pending migrations and the locks they would take, without applying them')
+	group.add_argument(
+		'--baseline', action='store_true',
+		help='record every migration as applied without running it, for databases created from schema.sql')
+	migrate_parser.add_argument(
+		'--lock-timeout', default='5s',
+		help='give up on a statement which waits this long for a lock (default: %(default)s)')
+	migrate_parser.set_defaults(func=lambda config, args: asyncio.run(migrate(config, args)))
+
+	serve_parser = subparsers.add_parser(
+		'serve-interactions', help='serve slash commands over HTTP only, without connecting to the gateway')
+	serve_parser.set_defaults(func=serve_interactions)
+
+	register_parser = subparsers.add_parser('register-interactions', help='tell Discord about the slash commands')
+	register_parser.add_argument(
+		'--guild-id', type=int,
+		help='register them in just this guild, which takes effect immediately (global commands take up to an hour)')
+	register_parser.set_defaults(func=lambda config, args: asyncio.run(register_interactions(config, args)))
+
+	fake_parser = subparsers.add_parser(
+		'fake-interaction', help='send a signed slash command to the interactions server, as Discord would')
+	fake_parser.add_argument(
+		'--generate-keys', action='store_true', help='print a new key pair to test with, and exit')
+	fake_parser.add_argument('--signing-key', help='the private key matching interactions.public_key, in hex')
+	fake_parser.add_argument('--url', help='default: the host and port in the config')
+	fake_parser.add_argument('--guild-id', type=int, default=0)
+	fake_parser.add_argument('--user-id', type=int, default=0)
+	fake_parser.add_argument('--role-id', type=int, action='append', default=[])
+	fake_parser.add_argument('--permissions', type=int, default=0, help="the member's permissions bitfield")
+	fake_parser.add_argument('command', nargs='?', default='list')
+	fake_parser.add_argument('options', nargs='*', metavar='name=value')
+	fake_parser.set_defaults(func=lambda config, args: asyncio.run(fake_interaction(config, args)))
 
-with open(BASE_DIR.parent / 'config.json5') as f:
-	config = json5.load(f)
+	args = parser.parse_args()
+	args.func(load_config(), args)
 
-CautiousMemory(config=config).run()
+main()
@@ -15,6 +15,9 @@
 
 import base64
 import contextlib
+import hashlib
+import hmac
+import logging
 import secrets
 
 import discord
@@ -22,13 +25,29 @@ from discord.ext import commands
 
 from .. import SQL_DIR
 from .. import utils
+from ..utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
 
 class API(commands.Cog):
 	TOKEN_DELIMITER = b';'
+	TOKEN_CACHE_SIZE = 10_000
+	# in case an invalidation notification is missed, e.g. while the listener connection is down
+	TOKEN_CACHE_TTL = 5 * 60
 
 	def __init__(self, bot):
 		self.bot = bot
 		self.queries = self.bot.queries('api.sql')
+		self.secret_key = self.bot.config['api']['secret_key'].encode()
+		# (user_id, app_id) → secret hash
+		self.token_cache = LRUCache(self.TOKEN_CACHE_SIZE, ttl=self.TOKEN_CACHE_TTL)
+		# bumped on invalidation so that a lookup which raced with an invalidation is not cached
+		self.token_cache_generation = 0
+
+	@commands.Cog.listener()
+	async def on_cm_api_token_change(self, user_id, app_id):
+		self.token_cache.pop((user_id, app_id))
+		self.token_cache_generation += 1
 
 	@staticmethod
 	def any_parent_command_is(command, parent_command):
@@ -84,15 +103,20 @@ class API(commands.Cog):
 		await self.delete_app(ctx.author.id, app_id)
 		await ctx.message.add_reaction(self.bot.config['success_emoji'])
 
-	@api_token.command(name='show', aliases=['get'])
-	async def token_show(self, ctx, *, app_id: int):
-		"""Sends you your token for a particular API application."""
-		app_name, token = await self.existing_token(ctx.author.id, app_id)
-		if token is None:
+	@api_token.command(name='regenerate', aliases=['regen'])
+	async def token_regenerate(self, ctx, *, app_id: int):
+		"""Replaces the token for one of your API applications and DMs you the new one.
+
+		Tokens are not stored, so they can't be shown again. Use this if you lost yours.
+		The old token stops working immediately.
+		"""
+		result = await self.regenerate_token(ctx.author.id, app_id)
+		if result is None:
 			await ctx.send('Error: no such app found.')
 			return
 
-		await self.send_token(ctx, token, app_name)
+		app_name, token = result
+		await self.send_token(ctx, token, app_name, new=True)
 
 	async def send_token(self, ctx, token, app_name, *, new=False):
 		message = (
@@ -111,21 +135,22 @@ class API(commands.Cog):
 	async def list_apps(self, user_id):
 		return await self.bot.pool.fetch(self.queries.list_apps(), user_id)
 
-	async def existing_token(self, user_id, app_id):
-		row = await self.bot.pool.fetchrow(self.queries.existing_token(), user_id, app_id)
-		if row is None:
-			return None
-		app_name, secret = row
-		return app_name, self.encode_token(user_id, app_id, secret)
-
 	async def new_token(self, user_id, app_name):
 		secret = secrets.token_bytes()
-		app_id = await self.bot.pool.fetchval(self.queries.new_token(), user_id, app_name, secret)
+		app_id = await self.bot.pool.fetchval(self.queries.new_token(), user_id, app_name, self.hash_secret(secret))
 		return self.encode_token(user_id, app_id, secret)
 
 	async def regenerate_token(self, user_id, app_id):
-		await self.delete_app(user_id, app_id)
-		return await self.new_token(user_id)
+		"""replace the secret of an existing app. Return (app_name, token), or None if there's no such app."""
+		secret = secrets.token_bytes()
+		app_name = await self.bot.pool.fetchval(
+			self.queries.regenerate_token(), user_id, app_id, self.hash_secret(secret))
+		if app_name is None:
+			return None
+		return app_name, self.encode_token(user_id, app_id, secret)
+
+	def hash_secret(self, secret):
+		return hmac.new(self.secret_key, secret, hashlib.sha256).digest()
 
 	async def validate_token(self, token, user_id=None, app_id=None):
 		try:
@@ -139,13 +164,25 @@ class API(commands.Cog):
 		if app_id is None:
 			app_id = token_app_id
 
-		db_secret = await self.bot.pool.fetchval(self.queries.get_secret(), user_id, app_id)
-		if db_secret is None:
+		secret_hash = await self.get_secret_hash(user_id, app_id)
+		if secret_hash is None:
 			secrets.compare_digest(token, token)
 			return False
 
-		db_token = self.encode_token(user_id, app_id, db_secret)
-		return (user_id, app_id) if secrets.compare_digest(token, db_token) else (None, None)
+		return (user_id, app_id) if hmac.compare_digest(self.hash_secret(secret), secret_hash) else (None, None)
+
+	async def get_secret_hash(self, user_id, app_id):
+		key = user_id, app_id
+		secret_hash = self.token_cache.get(key)
+		if secret_hash is not None:
+			return secret_hash
+
+		generation = self.token_cache_generation
+		secret_hash = await self.bot.pool.fetchval(self.queries.get_secret_hash(), user_id, app_id)
+		# unknown apps are not cached, so that a new app works right away
+		if secret_hash is not None and self.token_cache_generation == generation:
+			self.token_cache[key] = secret_hash
+		return secret_hash
 
 	async def delete_user_account(self, user_id):
 		await self.bot.pool.execute(self.queries.delete_user_account(), user_id)
@@ -170,5 +207,13 @@ class API(commands.Cog):
 		return user_id, app_id, secret
 
 def setup(bot):
-	if bot.config.get('api'):
-		bot.add_cog(API(bot))
+	config = bot.config.get('api')
+	if not config:
+		return
+	# an empty key would still "work", but then anyone could compute the stored hashes
+	if not config.get('secret_key'):
+		logger.warning(
+			'API commands disabled: api.secret_key is not set in the config. '
+			'Generate one with e.g. `openssl rand -hex 32`.')
+		return
+	bot.add_cog(API(bot))
@@ -0,0 +1,214 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import functools
+import json
+import logging
+import zlib
+
+from aiohttp import web
+from bot_bin.sql import connection
+from discord.ext import commands
+
+from ..utils import errors
+from ..utils.admission import Priority
+
+logger = logging.getLogger(__name__)
+
+def _default(x):
+	if isinstance(x, datetime.datetime):
+		return x.isoformat()
+	raise TypeError(f'Object of type {type(x).__name__} is not JSON serializable')
+
+_dumps = functools.partial(json.dumps, default=_default)
+
+def json_response(data, **kwargs):
+	return web.json_response(data, dumps=_dumps, **kwargs)
+
+def json_error(cls, message):
+	return cls(text=_dumps({'error': message}), content_type='application/json')
+
+class APIServer(commands.Cog):
+	"""A read only REST API for the wiki, served from within the bot process.
+
+	Every request must have an API token (see the api-token command) in the Authorization header.
+	Titles in paths must be percent encoded.
+
+	GET /guilds/{guild_id}/pages?after=&limit=
+	GET /guilds/{guild_id}/pages/{title}
+	GET /guilds/{guild_id}/pages/{title}/revisions?before=&limit=
+	GET /guilds/{guild_id}/aliases?after=&limit=
+
+	Listings are paginated by cursor: pass the "next" value of one response as "after" (or "before") of the next request.
+	Pages have an ETag, so If-None-Match may be used to poll them cheaply.
+	"""
+
+	DEFAULT_LIMIT = 50
+	MAX_LIMIT = 200
+	# larger than any revision ID
+	MAX_REVISION_ID = 2 ** 31 - 1
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.api = self.bot.cogs['API']
+		self.wiki_db = self.bot.cogs['WikiDatabase']
+		self.config = self.bot.config['api']['server']
+
+		self.app = web.Application(middlewares=[self.error_middleware])
+		self.app.add_routes([
+			web.get(r'/guilds/{guild_id:\d+}/pages', self.list_pages),
+			web.get(r'/guilds/{guild_id:\d+}/pages/{title}', self.get_page),
+			web.get(r'/guilds/{guild_id:\d+}/pages/{title}/revisions', self.list_revisions),
+			web.get(r'/guilds/{guild_id:\d+}/aliases', self.list_aliases),
+		])
+		self.runner = web.AppRunner(self.app)
+		self.task = self.bot.loop.create_task(self.start())
+
+	async def start(self):
+		await self.runner.setup()
+		host, port = self.config.get('host', '127.0.0.1'), self.config.get('port', 8080)
+		await web.TCPSite(self.runner, host, port).start()
+		logger.info('API server listening on %s:%s', host, port)
+
+	def cog_unload(self):
+		self.task.cancel()
+		self.bot.loop.create_task(self.runner.cleanup())
+
+	@web.middleware
+	async def error_middleware(self, request, handler):
+		guild_id = int(request.match_info['guild_id']) if 'guild_id' in request.match_info else None
+		try:
+			with self.bot.admission.classify(Priority.interactive, guild_id):
+				return await handler(request)
+		except errors.BusyError as exc:
+			raise json_error(web.HTTPServiceUnavailable, str(exc))
+		except errors.PageNotFoundError as exc:
+			raise json_error(web.HTTPNotFound, str(exc))
+		except errors.MissingPagePermissionsError as exc:
+			raise json_error(web.HTTPForbidden, str(exc))
+		except errors.PageError as exc:
+			raise json_error(web.HTTPBadRequest, str(exc))
+
+	async def authenticate(self, request):
+		"""return the member that the request's token belongs to, in the requested guild"""
+		token = request.headers.get('Authorization')
+		if token is None:
+			raise json_error(web.HTTPUnauthorized, 'An API token is required.')
+
+		try:
+			user_id, app_id = await self.api.validate_token(token.encode()) or (None, None)
+		except UnicodeEncodeError:
+			user_id = None
+		if user_id is None:
+			raise json_error(web.HTTPUnauthorized, 'Invalid API token.')
+
+		guild = self.bot.get_guild(int(request.match_info['guild_id']))
+		member = guild and await self.bot.member_resolver.fetch(guild, user_id)
+		if member is None:
+			# don't reveal which guilds the bot is in
+			raise json_error(web.HTTPNotFound, 'Guild not found.')
+		return member
+
+	def limit(self, request):
+		try:
+			limit = int(request.query.get('limit', self.DEFAULT_LIMIT))
+		except ValueError:
+			raise json_error(web.HTTPBadRequest, 'limit must be an integer.')
+		return max(1, min(limit, self.MAX_LIMIT))
+
+	@staticmethod
+	def etag(latest_revision, title):
+		# the title is included because renames don't create a new latest revision
+		return f'"{latest_revision}-{zlib.crc32(title.encode()):x}"'
+
+	@staticmethod
+	def if_none_match(request):
+		header = request.headers.get('If-None-Match', '')
+		return {tag.strip().replace('W/', '', 1) for tag in header.split(',')}
+
+	async def get_page(self, request):
+		member = await self.authenticate(request)
+		title = request.match_info['title']
+
+		async with self.bot.read_pool(member.guild.id).acquire() as conn:
+			connection.set(conn)
+			page = await self.wiki_db.get_page(member, title, partial=True)
+			etag = self.etag(page.latest_revision, page.original)
+			if etag in self.if_none_match(request):
+				return web.Response(status=304, headers={'ETag': etag})
+
+			page = await self.wiki_db.get_page(member, title, check_permissions=False)
+
+		return json_response({
+			'page_id': page.page_id,
+			'title': page.title,
+			'alias': page.alias,
+			'content': page.content,
+			'created': page.created,
+			'latest_revision': page.latest_revision,
+		}, headers={'ETag': self.etag(page.latest_revision, page.title)})
+
+	async def list_pages(self, request):
+		member = await self.authenticate(request)
+		limit = self.limit(request)
+		pages = await self.wiki_db.get_pages_after(member, request.query.get('after', ''), limit)
+		return json_response({
+			'pages': [{
+				'page_id': page.page_id,
+				'title': page.title,
+				'created': page.created,
+				'latest_revision': page.latest_revision,
+			} for page in pages],
+			'next': pages[-1].title if len(pages) == limit else None,
+		})
+
+	async def list_aliases(self, request):
+		member = await self.authenticate(request)
+		limit = self.limit(request)
+		aliases = await self.wiki_db.get_aliases_after(member, request.query.get('after', ''), limit)
+		return json_response({
+			'aliases': [{
+				'title': alias.title,
+				'target': alias.target,
+				'aliased': alias.aliased,
+			} for alias in aliases],
+			'next': aliases[-1].title if len(aliases) == limit else None,
+		})
+
+	async def list_revisions(self, request):
+		member = await self.authenticate(request)
+		limit = self.limit(request)
+		try:
+			before = int(request.query.get('before', self.MAX_REVISION_ID))
+		except ValueError:
+			raise json_error(web.HTTPBadRequest, 'before must be an integer.')
+
+		revisions = await self.wiki_db.get_page_revisions_before(member, request.match_info['title'], before, limit)
+		return json_response({
+			'revisions': [{
+				'revision_id': revision.revision_id,
+				'author': revision.author,
+				'title': revision.title,
+				'content': revision.content,
+				'revised': revision.revised,
+			} for revision in revisions],
+			'next': revisions[-1].revision_id if len(revisions) == limit else None,
+		})
+
+def setup(bot):
+	# tokens can't be checked without the API cog, which isn't loaded if the config is incomplete
+	if bot.config.get('api', {}).get('server') and 'API' in bot.cogs:
+		bot.add_cog(APIServer(bot))
@@ -0,0 +1,79 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import logging
+
+from discord.ext import commands
+
+logger = logging.getLogger(__name__)
+
+class RevisionArchiver(commands.Cog):
+	"""Periodically moves the contents of old revisions out of the database and into the revision archive.
+
+	WikiDatabase reads them back transparently.
+	"""
+	def __init__(self, bot):
+		self.bot = bot
+		self.config = self.bot.config['revision_archive']
+		self.archive = self.bot.cogs['WikiDatabase'].archive
+		self.queries = self.bot.queries('archive.sql')
+		self.task = self.bot.loop.create_task(self.archive_loop())
+
+	def cog_unload(self):
+		self.task.cancel()
+
+	async def archive_loop(self):
+		while True:
+			try:
+				count = await self.archive_cold_revisions()
+			except Exception:
+				logger.exception('failed to archive revisions')
+			else:
+				if count:
+					logger.info('archived %s revisions', count)
+
+			await asyncio.sleep(self.config.get('interval', 60 * 60))
+
+	async def archive_cold_revisions(self):
+		"""archive every revision older than the configured cutoff which isn't the latest revision of its page.
+		return how many revisions were archived.
+		"""
+		cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self.config.get('after_days', 90))
+		batch_size = self.config.get('batch_size', 1000)
+		total = 0
+
+		while True:
+			async with self.bot.pool.acquire() as conn, conn.transaction():
+				rows = await conn.fetch(self.queries.cold_revisions(), cutoff, batch_size)
+				if not rows:
+					return total
+
+				# the data must be on disk before we commit its location.
+				# if the commit fails instead, the records we appended are merely unreferenced.
+				locations = await self.bot.loop.run_in_executor(
+					None, self.archive.append, [row['content'] for row in rows])
+
+				segments, offsets, lengths = zip(*locations)
+				await conn.execute(
+					self.queries.archive_revisions(),
+					[row['revision_id'] for row in rows], segments, offsets, lengths)
+
+			total += len(rows)
+
+def setup(bot):
+	if bot.config.get('revision_archive'):
+		bot.add_cog(RevisionArchiver(bot))
@@ -61,14 +61,15 @@ class MessageBinding(commands.Cog, name='Message Binding'):
 		If a binding already exists for the given message, it will be updated.
 		"""
 		page = await self.db.bind(ctx.author, message, title)
+		content = await self.wiki_db.render(ctx.guild.id, page, member=ctx.author)
 		if isinstance(target, discord.TextChannel):
 			try:
-				await target.send(page.content)
+				await target.send(content)
 			except discord.Forbidden:
 				raise commands.UserInputError("I can't send messages to that channel.")
 		else:
 			try:
-				await target.edit(content=page.content)
+				await target.edit(content=content)
 			except discord.Forbidden:
 				raise commands.UserInput("I can't edit that message.")
 
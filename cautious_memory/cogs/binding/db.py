@@ -49,13 +49,28 @@ class MessageBindingDatabase(commands.Cog):
 				)
 				return
 
-			coros = []
-			async for binding in self._bound_messages(revision.page_id):
-				coros.append(self.bot.http.edit_message(
-					channel_id=binding.channel_id, message_id=binding.message_id, content=revision.content,
-				))
+			if revision.content is None:
+				# renames don't change the content
+				return
+
+			bindings = [binding async for binding in self._bound_messages(revision.page_id)]
+
+		if not bindings:
+			return
+
+		# the editor was checked against every page this includes when they saved it
+		content = await self.wiki_db.render(revision.guild, revision)
+		await asyncio.gather(*(
+			self.bot.http.edit_message(channel_id=binding.channel_id, message_id=binding.message_id, content=content)
+			for binding in bindings))
+
+	@commands.Cog.listener()
+	async def on_cm_page_includes_change(self, guild_id, page_ids):
+		if not self.bot.get_guild(guild_id):
+			return
 
-		await asyncio.gather(*coros)
+		bindings = await self.bot.pool.fetch(self.queries.pages_bound_contents(), page_ids)
+		await asyncio.gather(*await self.edit_bound_messages(guild_id, bindings), return_exceptions=True)
 
 	@commands.Cog.listener()
 	async def on_cm_page_delete(self, guild_id, page_id, title):
@@ -74,12 +89,38 @@ class MessageBindingDatabase(commands.Cog):
 
 		await asyncio.gather(*coros, return_exceptions=True)
 
+	@commands.Cog.listener()
+	async def on_cm_wiki_import(self, guild_id):
+		# an import into the guild it was exported from restores its bindings, so bring them up to date
+		if not self.bot.get_guild(guild_id):
+			return
+
+		bindings = await self.bot.pool.fetch(self.queries.guild_bound_contents(), guild_id)
+		await asyncio.gather(*await self.edit_bound_messages(guild_id, bindings), return_exceptions=True)
+
+	async def edit_bound_messages(self, guild_id, bindings) -> List[Awaitable]:
+		"""return coroutines which edit each bound message to show its page.
+		bindings must have the channel_id, message_id, page_id, latest_revision, and content of each page.
+		"""
+		# several messages may be bound to the same page
+		contents = {}
+		coros = []
+		for binding in bindings:
+			try:
+				content = contents[binding.page_id]
+			except KeyError:
+				content = contents[binding.page_id] = await self.wiki_db.render(guild_id, binding)
+			coros.append(self.bot.http.edit_message(
+				channel_id=binding.channel_id, message_id=binding.message_id, content=content,
+			))
+		return coros
+
 	@optional_connection
 	async def get_revision(self, revision_id):
 		row = await connection().fetchrow(self.queries.get_revision(), revision_id)
 		if row is None:
 			raise ValueError('revision_id not found')
-		return AttrDict(row)
+		return row
 
 	@optional_connection
 	async def bound_messages(self, member, title):
@@ -92,7 +133,7 @@ class MessageBindingDatabase(commands.Cog):
 	async def _bound_messages(self, page_id):
 		async with connection().transaction():
 			async for row in connection().cursor(self.queries.bound_messages(), page_id):
-				yield AttrDict(row)
+				yield row
 
 	@optional_connection
 	async def guild_bindings(self, member):
@@ -100,7 +141,7 @@ class MessageBindingDatabase(commands.Cog):
 		async with connection().transaction():
 			await self.wiki_db.check_permissions(member, Permissions.view)
 			async for row in connection().cursor(self.queries.guild_bindings(), member.guild.id):
-				yield AttrDict(row)
+				yield row
 
 	@optional_connection
 	async def bind(self, member, message: discord.Message, title):
@@ -108,17 +149,14 @@ class MessageBindingDatabase(commands.Cog):
 			page = await self.wiki_db.get_page(member, title, check_permissions=False)
 			await self.wiki_db.check_permissions(member, Permissions.manage_bindings, title)
 			await connection().execute(self.queries.bind(), message.channel.id, message.id, page.page_id)
-		binding = page
-		binding.channel_id = message.channel.id
-		binding.message_id = message.id
-		return binding
+		return AttrDict(page.items(), channel_id=message.channel.id, message_id=message.id)
 
 	@optional_connection
 	async def get_bound_page(self, message: discord.Message):
 		row = await connection().fetchrow(self.queries.get_bound_page(), message.id)
 		if row is None:
 			raise errors.BindingNotFoundError
-		return AttrDict(row)
+		return row
 
 	@optional_connection
 	async def unbind(self, member, message: discord.Message):
@@ -0,0 +1,63 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import discord
+from discord.ext import commands
+
+class Changelog(commands.Cog):
+	"""Commands that let server administrators follow wiki changes in a channel."""
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.db = self.bot.cogs['ChangelogDatabase']
+
+	async def cog_check(self, ctx):
+		if not ctx.guild:
+			raise commands.NoPrivateMessage
+		if not await self.bot.is_privileged(ctx.author):
+			raise commands.MissingPermissions(['administrator'])
+		return True
+
+	@commands.group(invoke_without_command=True)
+	async def changelog(self, ctx):
+		"""Shows which channel wiki changes are posted to.
+
+		Changes are collected and posted together every so often, rather than one message per change.
+		"""
+		channel_id = await self.db.channel_id(ctx.guild.id)
+		if channel_id is None:
+			await ctx.send(f'No changelog channel is set. Use the {ctx.prefix}changelog set command to set one.')
+		else:
+			await ctx.send(f'Wiki changes are posted to <#{channel_id}>.')
+
+	@changelog.command(name='set')
+	async def changelog_set(self, ctx, channel: discord.TextChannel = None):
+		"""Sets the channel to post wiki changes to. Defaults to the current channel."""
+		channel = channel or ctx.channel
+		permissions = channel.permissions_for(ctx.guild.me)
+		if not (permissions.send_messages and permissions.embed_links):
+			raise commands.BotMissingPermissions(['send_messages', 'embed_links'])
+
+		await self.db.set_channel(ctx.guild.id, channel.id)
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
+
+	@changelog.command(name='disable', aliases=['unset'])
+	async def changelog_disable(self, ctx):
+		"""Stops posting wiki changes."""
+		await self.db.delete_channel(ctx.guild.id)
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
+
+def setup(bot):
+	bot.add_cog(Changelog(bot))
@@ -0,0 +1,217 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+import discord
+from discord.ext import commands
+
+logger = logging.getLogger(__name__)
+
+class Change:
+	__slots__ = ('kind', 'title', 'old_title', 'authors', 'count', 'revision_id')
+
+	def __init__(self, kind, title, *, old_title=None, revision_id=None):
+		self.kind = kind
+		self.title = title
+		self.old_title = old_title
+		# user IDs, in the order of their first change. A dict is used as an ordered set.
+		self.authors = {}
+		self.count = 0
+		self.revision_id = revision_id
+
+	def format(self):
+		title = discord.utils.escape_markdown(self.title)
+		authors = ', '.join(f'<@{author}>' for author in self.authors)
+		if self.kind == 'create':
+			return f'🆕 **{title}** created by {authors}'
+		if self.kind == 'rename':
+			old_title = discord.utils.escape_markdown(self.old_title)
+			return f'🔀 **{old_title}** renamed to **{title}** by {authors}'
+		if self.kind == 'delete':
+			return f'🗑 **{title}** deleted'
+		times = f' {self.count} times' if self.count > 1 else ''
+		return f'✏ **{title}** edited{times} by {authors} (latest revision {self.revision_id})'
+
+class Digest:
+	"""The changes to one guild's wiki since the last changelog message.
+	Edits to the same page are collapsed into one line.
+	"""
+	__slots__ = ('changes', 'event_count')
+
+	def __init__(self):
+		# (kind, page_id or revision_id) → Change
+		self.changes = {}
+		self.event_count = 0
+
+	def add(self, key, change, author=None):
+		change = self.changes.setdefault(key, change)
+		if author is not None:
+			change.authors[author] = None
+		change.count += 1
+		self.event_count += 1
+		return change
+
+	def lines(self):
+		return [change.format() for change in self.changes.values()]
+
+class ChangelogDatabase(commands.Cog):
+	"""Posts a digest of wiki changes to each guild's changelog channel.
+
+	Changes are buffered per guild, and the buffer is posted as one message every flush_interval seconds,
+	or as soon as it holds flush_size changes.
+	"""
+	EMBED_COLOR = discord.Color.from_hsv(262/360, 55/100, 76/100)
+	# Discord's limit for embed descriptions
+	DESCRIPTION_LIMIT = 2048
+	# seconds to wait before retrying to load the changelog channels, doubling after each failure up to the max
+	LOAD_RETRY_DELAY = 1
+	LOAD_RETRY_MAX_DELAY = 5 * 60
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.queries = self.bot.queries('changelog.sql')
+		config = self.bot.config.get('changelog', {})
+		self.flush_interval = config.get('flush_interval', 60)
+		self.flush_size = config.get('flush_size', 25)
+		# guild_id → channel_id
+		self.channels = None
+		self.channels_loaded = asyncio.Event()
+		# guild_id → Digest
+		self.digests = {}
+		self.task = self.bot.loop.create_task(self.flush_loop())
+
+	def cog_unload(self):
+		self.task.cancel()
+
+	async def load_channels(self):
+		"""load the changelog channels, retrying until it works, since every listener waits for them"""
+		delay = self.LOAD_RETRY_DELAY
+		while True:
+			try:
+				self.channels = dict(await self.bot.pool.fetch(self.queries.changelog_channels()))
+			except Exception:
+				logger.exception('failed to load the changelog channels, retrying in %s seconds', delay)
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, self.LOAD_RETRY_MAX_DELAY)
+			else:
+				self.channels_loaded.set()
+				return
+
+	async def channel_id(self, guild_id):
+		await self.channels_loaded.wait()
+		return self.channels.get(guild_id)
+
+	async def set_channel(self, guild_id, channel_id):
+		await self.bot.pool.execute(self.queries.set_changelog_channel(), guild_id, channel_id)
+		await self.channels_loaded.wait()
+		self.channels[guild_id] = channel_id
+
+	async def delete_channel(self, guild_id):
+		await self.bot.pool.execute(self.queries.delete_changelog_channel(), guild_id)
+		await self.channels_loaded.wait()
+		self.channels.pop(guild_id, None)
+		self.digests.pop(guild_id, None)
+
+	@commands.Cog.listener()
+	async def on_cm_page_edit(self, revision_id):
+		await self.channels_loaded.wait()
+		if not self.channels:
+			# don't bother looking up the revision
+			return
+
+		row = await self.bot.pool.fetchrow(self.queries.changelog_revision(), revision_id)
+		if row is None or not self.bot.get_guild(row['guild']) or await self.channel_id(row['guild']) is None:
+			return
+
+		if row['is_create']:
+			key = 'create', row['page_id']
+			change = Change('create', row['new_title'])
+		elif row['is_rename']:
+			key = 'rename', row['revision_id']
+			change = Change('rename', row['new_title'], old_title=row['old_title'])
+		else:
+			key = 'edit', row['page_id']
+			change = Change('edit', row['current_title'])
+
+		change = self.digest(row['guild']).add(key, change, row['author'])
+		change.revision_id = row['revision_id']
+		await self.maybe_flush(row['guild'])
+
+	@commands.Cog.listener()
+	async def on_cm_page_delete(self, guild_id, page_id, title):
+		if not self.bot.get_guild(guild_id) or await self.channel_id(guild_id) is None:
+			return
+
+		self.digest(guild_id).add(('delete', page_id), Change('delete', title))
+		await self.maybe_flush(guild_id)
+
+	def digest(self, guild_id):
+		try:
+			return self.digests[guild_id]
+		except KeyError:
+			digest = self.digests[guild_id] = Digest()
+			return digest
+
+	async def maybe_flush(self, guild_id):
+		if self.digests[guild_id].event_count >= self.flush_size:
+			await self.flush(guild_id)
+
+	async def flush_loop(self):
+		await self.load_channels()
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			for guild_id in list(self.digests):
+				try:
+					await self.flush(guild_id)
+				except Exception:
+					logger.exception('failed to post the changelog of guild %s', guild_id)
+
+	async def flush(self, guild_id):
+		digest = self.digests.pop(guild_id, None)
+		if digest is None:
+			return
+
+		channel = self.bot.get_channel(self.channels.get(guild_id))
+		if channel is None:
+			return
+
+		# mentions in embeds don't ping anyone
+		for description in self.paginate(digest.lines()):
+			embed = discord.Embed(title='Wiki changes', description=description, color=self.EMBED_COLOR)
+			try:
+				await channel.send(embed=embed)
+			except discord.Forbidden:
+				logger.warning('missing permissions to post the changelog of guild %s', guild_id)
+				return
+
+	@classmethod
+	def paginate(cls, lines):
+		page = []
+		length = 0
+		for line in lines:
+			if page and length + len(line) + 1 > cls.DESCRIPTION_LIMIT:
+				yield '\n'.join(page)
+				page.clear()
+				length = 0
+			line = line[:cls.DESCRIPTION_LIMIT]
+			page.append(line)
+			length += len(line) + 1
+		if page:
+			yield '\n'.join(page)
+
+def setup(bot):
+	bot.add_cog(ChangelogDatabase(bot))
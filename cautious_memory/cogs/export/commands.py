@@ -0,0 +1,80 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import tempfile
+
+import discord
+from discord.ext import commands
+
+from ...utils.admission import heavy
+
+class Export(commands.Cog):
+	"""Commands that let server administrators back up and restore the wiki."""
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.db = self.bot.cogs['ExportDatabase']
+
+	async def cog_check(self, ctx):
+		if not ctx.guild:
+			raise commands.NoPrivateMessage
+		if not await self.bot.is_privileged(ctx.author):
+			raise commands.MissingPermissions(['administrator'])
+		return True
+
+	@commands.command()
+	@heavy
+	async def export(self, ctx):
+		"""Exports this server's wiki, including history, aliases, permissions and bindings.
+
+		The export can be loaded into another server (or this one) using the import command.
+		"""
+		with tempfile.TemporaryFile() as fp:
+			async with ctx.typing():
+				await self.db.export_guild(ctx.guild.id, fp)
+
+			size = fp.tell()
+			if size > ctx.guild.filesize_limit:
+				await ctx.send(
+					f'The export is {size} bytes, which is too large to upload to this server. '
+					'Ask the bot owner to export it for you instead.')
+				return
+
+			fp.seek(0)
+			filename = f'{ctx.guild.id}-wiki-{datetime.datetime.utcnow():%Y-%m-%d}.jsonl.gz'
+			await ctx.send(file=discord.File(fp, filename))
+
+	@commands.command(name='import')
+	@heavy
+	async def import_(self, ctx):
+		"""Imports a wiki export into this server. Attach the export file to your message.
+
+		No page or alias in the export may have the same title as an existing page or alias on this server.
+		If anything goes wrong, nothing will be imported.
+		"""
+		if not ctx.message.attachments:
+			raise commands.UserInputError('Please attach a wiki export to your message.')
+
+		with tempfile.TemporaryFile() as fp:
+			async with ctx.typing():
+				await ctx.message.attachments[0].save(fp)
+				fp.seek(0)
+				count = await self.db.import_guild(ctx.guild.id, fp)
+
+		await ctx.send(f'{self.bot.config["success_emojis"][True]} Imported {count} pages.')
+
+def setup(bot):
+	bot.add_cog(Export(bot))
@@ -0,0 +1,143 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import gzip
+import io
+import itertools
+import json
+import operator
+
+from bot_bin.sql import connection, optional_connection
+from discord.ext import commands
+
+from ...utils import errors
+
+# an export is a gzipped JSON lines file.
+# the first line is a header, and every line after that is a row of one of these tables, in this order.
+# rows of the same table are always consecutive, so that importing can stream each table into COPY.
+EXPORT_FORMAT = 'cautious-memory-export'
+EXPORT_VERSION = 1
+TABLES = {
+	'pages': ('page_id', 'title', 'latest_revision', 'created'),
+	'aliases': ('title', 'page_id', 'aliased'),
+	'revisions': ('revision_id', 'page_id', 'author', 'content', 'new_title', 'revised'),
+	'page_permissions': ('page_id', 'entity', 'allow', 'deny'),
+	'bound_messages': ('message_id', 'channel_id', 'page_id'),
+}
+TIMESTAMP_COLUMNS = frozenset({'created', 'aliased', 'revised'})
+
+def _encode(value):
+	if isinstance(value, datetime.datetime):
+		return value.isoformat()
+	return value
+
+def _decode(column, value):
+	if value is not None and column in TIMESTAMP_COLUMNS:
+		return datetime.datetime.fromisoformat(value)
+	return value
+
+async def export_guild(conn, queries, guild_id, fp, *, archive=None):
+	"""write all of a guild's wiki data to the binary file object fp.
+	rows are streamed from a cursor, so this never holds more than one row in memory.
+	archive is the RevisionArchive to read archived revision contents from, if any.
+	"""
+	with gzip.open(fp, 'wt', encoding='utf-8') as out:
+		json.dump({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'guild': guild_id}, out)
+		out.write('\n')
+
+		async with conn.transaction(isolation='repeatable_read', readonly=True):
+			for table, columns in TABLES.items():
+				query = getattr(queries, 'export_' + table)()
+				async for row in conn.cursor(query, guild_id):
+					values = {column: _encode(row[column]) for column in columns}
+					if table == 'revisions' and row['archive_segment'] is not None:
+						if archive is None:
+							raise RuntimeError('revision is archived but the revision archive is not configured')
+						values['content'] = archive.read(
+							row['archive_segment'], row['archive_offset'], row['archive_length'])
+					json.dump({'table': table, **values}, out)
+					out.write('\n')
+
+async def import_guild(conn, queries, guild_id, fp):
+	"""load an export from the binary file object fp into guild_id.
+
+	Each table is streamed through COPY into a temporary staging table, and then merged into the real tables
+	with fresh IDs, all in one transaction. Per-page notifications are suppressed; instead a single wiki_import
+	notification is sent when the transaction commits.
+
+	Return the number of pages imported.
+	"""
+	lines = map(json.loads, io.TextIOWrapper(gzip.open(fp, 'rb'), encoding='utf-8'))
+
+	try:
+		header = next(lines)
+	except (StopIteration, OSError, ValueError):
+		raise errors.WikiImportError('That file is not a wiki export.')
+	if header.get('format') != EXPORT_FORMAT:
+		raise errors.WikiImportError('That file is not a wiki export.')
+	if header.get('version') != EXPORT_VERSION:
+		raise errors.WikiImportError(f'Unsupported export version {header.get("version")!r}.')
+	source_guild_id = header['guild']
+
+	async with conn.transaction():
+		await conn.execute(queries.suppress_notifications())
+		await conn.execute(queries.create_staging_tables())
+
+		try:
+			for table, rows in itertools.groupby(lines, key=operator.itemgetter('table')):
+				try:
+					columns = TABLES[table]
+				except KeyError:
+					raise errors.WikiImportError(f'Unknown table {table!r} in export.')
+
+				await conn.copy_records_to_table(
+					'import_' + table,
+					columns=columns,
+					records=(tuple(_decode(column, row[column]) for column in columns) for row in rows))
+		except (OSError, ValueError, KeyError):
+			raise errors.WikiImportError('That export is corrupt.')
+
+		conflict = await conn.fetchval(queries.import_conflict(), guild_id)
+		if conflict is not None:
+			raise errors.WikiImportError(f'A page or alias called “{conflict}” already exists in this server.')
+
+		await conn.execute(queries.allocate_page_ids())
+		await conn.execute(queries.allocate_revision_ids())
+		tag = await conn.execute(queries.merge_pages(), guild_id)
+		await conn.execute(queries.merge_revisions())
+		await conn.execute(queries.merge_aliases(), guild_id)
+		await conn.execute(queries.merge_page_permissions(), guild_id, source_guild_id)
+		await conn.execute(queries.merge_bound_messages(), guild_id, source_guild_id)
+		await conn.execute(queries.notify_import(), guild_id)
+
+	return int(tag.rsplit(None, 1)[-1])
+
+class ExportDatabase(commands.Cog):
+	def __init__(self, bot):
+		self.bot = bot
+		self.queries = self.bot.queries('export.sql')
+
+	@optional_connection
+	async def export_guild(self, guild_id, fp):
+		archive = self.bot.cogs['WikiDatabase'].archive
+		await export_guild(connection(), self.queries, guild_id, fp, archive=archive)
+
+	@optional_connection
+	async def import_guild(self, guild_id, fp):
+		return await import_guild(connection(), self.queries, guild_id, fp)
+
+def setup(bot):
+	bot.add_cog(ExportDatabase(bot))
@@ -0,0 +1,179 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import logging
+import time
+
+from discord.ext import commands
+
+logger = logging.getLogger(__name__)
+
+# tables with any number of rows per page, which are purged before the pages themselves,
+# so that deleting a batch of pages doesn't cascade to an unbounded number of rows
+PAGE_TABLES = (
+	'page_usage_history',
+	'page_view_sketches',
+	'page_author_revision_counts',
+)
+
+# tables with a guild column which aren't cleaned up by cascade when a guild's pages are deleted
+GUILD_TABLES = (
+	'deleted_pages',
+	'pattern_subscribers',
+	'pending_notifications',
+	'guild_view_sketches',
+	'guild_revision_counts',
+	'guild_author_revision_counts',
+	'changelog_channels',
+)
+
+class GarbageCollector(commands.Cog):
+	"""Deletes the data of guilds the bot was removed from, and the page overwrites of deleted roles.
+
+	Deleting a big wiki in one statement would hold locks on (and bloat) the biggest tables for a long time,
+	so purges are queued in purge_queue and carried out in small batches, each in its own transaction.
+	Guild purges wait out a grace period first, in case the bot is added back.
+	Purges lost while the bot was offline are found by periodically reconciling the database with the guild list.
+
+	Page overwrites of members who leave are kept, since a member denied a permission could otherwise
+	get it back by leaving and rejoining.
+	"""
+	def __init__(self, bot):
+		self.bot = bot
+		self.config = self.bot.config.get('gc', {})
+		self.queries = self.bot.queries('gc.sql')
+		self.task = self.bot.loop.create_task(self.gc_loop())
+
+	def cog_unload(self):
+		self.task.cancel()
+
+	@property
+	def grace_period(self):
+		return datetime.timedelta(days=self.config.get('guild_grace_days', 7))
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild):
+		# the roles are gone once we're out of the guild, so remember which ones had role_permissions
+		role_ids = [role.id for role in guild.roles]
+		not_before = datetime.datetime.utcnow() + self.grace_period
+		await self.bot.pool.execute(self.queries.queue_guild_purge(), guild.id, role_ids, not_before)
+
+	@commands.Cog.listener()
+	async def on_guild_join(self, guild):
+		await self.bot.pool.execute(self.queries.cancel_guild_purge(), guild.id)
+
+	@commands.Cog.listener()
+	async def on_guild_role_delete(self, role):
+		# PermissionsDatabase deletes the role's role_permissions
+		await self.bot.pool.execute(self.queries.queue_role_purge(), role.guild.id, role.id)
+
+	async def gc_loop(self):
+		await self.bot.wait_until_ready()
+		last_reconciled = None
+		while True:
+			reconcile_interval = self.config.get('reconcile_interval', 24 * 60 * 60)
+			if last_reconciled is None or time.monotonic() - last_reconciled >= reconcile_interval:
+				try:
+					if await self.reconcile():
+						last_reconciled = time.monotonic()
+				except Exception:
+					logger.exception('failed to reconcile purges')
+
+			try:
+				await self.purge_due()
+			except Exception:
+				logger.exception('failed to purge data')
+
+			await asyncio.sleep(self.config.get('interval', 5 * 60))
+
+	async def reconcile(self):
+		"""queue purges for data left over from while the bot was offline.
+		Return whether it could be done: the guild list isn't reliable while some guilds are unavailable.
+		"""
+		if any(guild.unavailable for guild in self.bot.guilds):
+			return False
+
+		guild_ids = [guild.id for guild in self.bot.guilds]
+		not_before = datetime.datetime.utcnow() + self.grace_period
+		async with self.bot.pool.acquire() as conn, conn.transaction():
+			for guild_id, in await conn.fetch(self.queries.unknown_guilds(), guild_ids):
+				# their roles are unknown, but any role_permissions left over are only ever looked up by role ID,
+				# which is unique across guilds, so they're harmless
+				await conn.execute(self.queries.queue_guild_purge(), guild_id, [], not_before)
+
+			for guild in self.bot.guilds:
+				role_ids = [role.id for role in guild.roles]
+				for role_id, in await conn.fetch(self.queries.deleted_roles(), guild.id, role_ids):
+					await conn.execute(self.queries.queue_role_purge(), guild.id, role_id)
+
+		return True
+
+	async def purge_due(self):
+		for job in await self.bot.pool.fetch(self.queries.due_purges()):
+			if job.role_id is None and self.bot.get_guild(job.guild) is not None:
+				# we were added back while the bot was offline
+				await self.bot.pool.execute(self.queries.finish_purge(), job.purge_id)
+				continue
+
+			if job.role_id is None:
+				count = await self.purge_guild(job.guild, job.role_ids)
+				logger.info('purged %s rows of guild %s', count, job.guild)
+			else:
+				count = await self.purge_batches(self.queries.purge_role_overwrites(), job.guild, job.role_id)
+				# in case the role was deleted while the bot was offline
+				await self.bot.pool.execute(self.queries.purge_role_permissions(), [job.role_id])
+				logger.info('purged %s page overwrites of role %s', count, job.role_id)
+
+			await self.bot.pool.execute(self.queries.finish_purge(), job.purge_id)
+
+	async def purge_guild(self, guild_id, role_ids):
+		total = 0
+		for table in PAGE_TABLES:
+			total += await self.purge_batches(self.queries.purge_guild_page_rows(table), guild_id)
+		total += await self.purge_batches(self.queries.purge_guild_revisions(), guild_id)
+		total += await self.purge_batches(self.queries.purge_guild_pages(), guild_id)
+		total += await self.purge_batches(self.queries.purge_guild_deleted_revisions(), guild_id)
+		for table in GUILD_TABLES:
+			total += await self.purge_batches(self.queries.purge_guild_rows(table), guild_id)
+		if role_ids:
+			total += count_rows(await self.bot.pool.execute(self.queries.purge_role_permissions(), role_ids))
+		return total
+
+	async def purge_batches(self, query, *args):
+		"""Run query, which takes args followed by the batch size, until it deletes nothing.
+		Each batch is its own transaction, and they're spaced out to leave room for everyone else.
+		Return the number of rows deleted.
+		"""
+		batch_size = self.config.get('batch_size', 100)
+		total = 0
+		while True:
+			async with self.bot.pool.acquire() as conn, conn.transaction():
+				# nobody needs to hear about pages of a guild we've left, nor do they need tombstones
+				await conn.execute("SET LOCAL cm.suppress_notify = 'on'; SET LOCAL cm.purging = 'on'")
+				count = count_rows(await conn.execute(query, *args, batch_size))
+
+			total += count
+			if not count:
+				return total
+			await asyncio.sleep(self.config.get('batch_delay', 1))
+
+def count_rows(status):
+	"""return the number of rows affected according to a command status such as 'DELETE 100'"""
+	return int(status.rsplit(None, 1)[-1])
+
+def setup(bot):
+	bot.add_cog(GarbageCollector(bot))
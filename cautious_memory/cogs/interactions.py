@@ -0,0 +1,322 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The read only wiki commands as slash commands, received from Discord as HTTP requests ("interactions").
+
+Everything needed to answer an interaction is in its payload or the database, so this needs neither a gateway
+connection nor a member cache. Run it on its own with python -m cautious_memory serve-interactions,
+as many times as you like behind a load balancer, or load it into the bot.
+"""
+
+import enum
+import json
+import logging
+import time
+
+import aiohttp
+import discord
+from aiohttp import web
+from discord.ext import commands
+
+try:
+	import nacl.exceptions
+	import nacl.signing
+except ImportError:
+	nacl = None
+
+from ..utils import errors
+from ..utils.admission import heavy, priority_of
+
+logger = logging.getLogger(__name__)
+
+API_BASE = 'https://discord.com/api/v8'
+MESSAGE_LENGTH_LIMIT = 2000
+# Discord gives up on an interaction after three seconds, so a command which can't get a database connection
+# well before then is better off answering that the wiki is busy
+ADMISSION_DEADLINE = 1.5
+
+class InteractionType(enum.IntEnum):
+	ping = 1
+	application_command = 2
+
+class ResponseType(enum.IntEnum):
+	pong = 1
+	channel_message = 4
+
+# only visible to the user who used the command
+EPHEMERAL = 1 << 6
+STRING_OPTION = 3
+
+def _title_option(*, required=True):
+	return {'type': STRING_OPTION, 'name': 'title', 'description': 'The title of the page', 'required': required}
+
+# what register-interactions tells Discord about
+COMMANDS = [
+	{'name': 'page', 'description': 'Shows you the contents of a page', 'options': [_title_option()]},
+	{'name': 'search', 'description': "Searches this server's pages for titles similar to your query", 'options': [
+		{'type': STRING_OPTION, 'name': 'query', 'description': 'What to search for', 'required': True}]},
+	{'name': 'list', 'description': 'Shows you a list of all the pages on this server'},
+	{'name': 'history', 'description': 'Shows the revisions of a page', 'options': [_title_option()]},
+	{'name': 'stats', 'description': 'Shows server-wide or per-page statistics', 'options': [
+		_title_option(required=False)]},
+]
+
+class InteractionGuild:
+	"""Just enough of a discord.Guild for WikiDatabase, made from an interaction"""
+	__slots__ = ('id', 'default_role')
+
+	def __init__(self, guild_id):
+		self.id = guild_id
+		self.default_role = discord.Object(guild_id)
+
+	def __str__(self):
+		return str(self.id)
+
+	def get_member(self, user_id):
+		# there's no member cache
+		return None
+
+class InteractionMember:
+	"""Just enough of a discord.Member for WikiDatabase, made from an interaction"""
+	__slots__ = ('id', 'name', 'guild', 'roles', 'guild_permissions')
+
+	def __init__(self, guild, data):
+		user = data['user']
+		self.id = int(user['id'])
+		self.name = user['username']
+		self.guild = guild
+		self.roles = [guild.default_role, *(discord.Object(int(role_id)) for role_id in data['roles'])]
+		# these are the member's permissions in the channel, which is close enough for is_privileged
+		self.guild_permissions = discord.Permissions(int(data['permissions']))
+
+	def __str__(self):
+		return self.name
+
+	@property
+	def mention(self):
+		return f'<@{self.id}>'
+
+def message(content=None, *, embed=None, ephemeral=False):
+	data = {'allowed_mentions': {'parse': []}}
+	if content is not None:
+		data['content'] = content
+	if embed is not None:
+		data['embeds'] = [embed.to_dict()]
+	if ephemeral:
+		data['flags'] = EPHEMERAL
+	return {'type': ResponseType.channel_message, 'data': data}
+
+def truncate_lines(lines, limit=MESSAGE_LENGTH_LIMIT):
+	"""join lines, leaving off the ones which don't fit in limit characters and noting how many there were"""
+	lines = list(lines)
+	text = '\n'.join(lines)
+	if len(text) <= limit:
+		return text
+
+	kept = []
+	length = 0
+	for i, line in enumerate(lines):
+		more = f'…and {len(lines) - i} more'
+		if length + len(line) + 1 + len(more) > limit:
+			break
+		kept.append(line)
+		length += len(line) + 1
+	kept.append(more)
+	return '\n'.join(kept)
+
+class InteractionServer(commands.Cog):
+	"""Answers interactions POSTed by Discord to /interactions.
+
+	Requests are verified with the application's public key, as Discord requires.
+	Responses are sent in the HTTP response, so every command must finish within Discord's three second deadline.
+	"""
+
+	def __init__(self, bot):
+		if nacl is None:
+			raise RuntimeError('serving interactions requires PyNaCl (pip install PyNaCl)')
+
+		self.bot = bot
+		self.wiki_db = self.bot.cogs['WikiDatabase']
+		self.wiki = self.bot.cogs['Wiki']
+		self.config = self.bot.config['interactions']
+		self.verify_key = nacl.signing.VerifyKey(bytes.fromhex(self.config['public_key']))
+		self.handlers = {
+			'page': self.page,
+			'search': self.search,
+			'list': self.list,
+			'history': self.history,
+			'stats': self.stats,
+		}
+
+		self.app = web.Application()
+		self.app.add_routes([web.post('/interactions', self.interaction)])
+		self.runner = web.AppRunner(self.app)
+		self.task = self.bot.loop.create_task(self.start())
+
+	async def start(self):
+		await self.runner.setup()
+		host, port = self.config.get('host', '127.0.0.1'), self.config.get('port', 8081)
+		await web.TCPSite(self.runner, host, port).start()
+		logger.info('interactions server listening on %s:%s', host, port)
+
+	def cog_unload(self):
+		self.task.cancel()
+		self.bot.loop.create_task(self.runner.cleanup())
+
+	def verify(self, request, body):
+		signature = request.headers.get('X-Signature-Ed25519')
+		timestamp = request.headers.get('X-Signature-Timestamp')
+		if signature is None or timestamp is None:
+			raise web.HTTPUnauthorized
+		try:
+			self.verify_key.verify(timestamp.encode() + body, bytes.fromhex(signature))
+		except (ValueError, nacl.exceptions.BadSignatureError):
+			raise web.HTTPUnauthorized
+
+	async def interaction(self, request):
+		body = await request.read()
+		self.verify(request, body)
+		try:
+			interaction = json.loads(body)
+		except ValueError:
+			raise web.HTTPBadRequest
+
+		if interaction['type'] == InteractionType.ping:
+			return web.json_response({'type': ResponseType.pong})
+		if interaction['type'] != InteractionType.application_command:
+			raise web.HTTPBadRequest
+
+		return web.json_response(await self.run_command(interaction))
+
+	async def run_command(self, interaction):
+		data = interaction['data']
+		if 'guild_id' not in interaction:
+			return message('These commands can only be used in a server.', ephemeral=True)
+
+		try:
+			handler = self.handlers[data['name']]
+		except KeyError:
+			return message('Unknown command.', ephemeral=True)
+
+		member = InteractionMember(InteractionGuild(int(interaction['guild_id'])), interaction['member'])
+		options = {option['name']: option['value'] for option in data.get('options', ())}
+		try:
+			with self.bot.admission.classify(priority_of(handler), member.guild.id, deadline=ADMISSION_DEADLINE):
+				return await handler(member, **options)
+		except (errors.CautiousMemoryError, commands.UserInputError) as exc:
+			return message(str(exc), ephemeral=True)
+		except Exception:
+			logger.exception('interaction %s (%s) failed', interaction['id'], data['name'])
+			return message('An internal error occured while trying to run that command.', ephemeral=True)
+
+	## Commands
+
+	async def page(self, member, *, title):
+		page = await self.wiki_db.get_page(member, title)
+		content = await self.wiki_db.render(member.guild.id, page, member=member)
+		await self.wiki_db.log_page_use(member.guild.id, title, member.id)
+		return message(content)
+
+	async def search(self, member, *, query):
+		titles = [page.title async for page in self.wiki_db.search_pages(member, query)]
+		if not titles:
+			return message('No pages matched your search.', ephemeral=True)
+		return message(truncate_lines(titles))
+
+	@heavy
+	async def list(self, member):
+		titles = [page.title async for page in self.wiki_db.get_all_pages(member)]
+		if not titles:
+			return message('No pages have been created yet.', ephemeral=True)
+		return message(truncate_lines(titles))
+
+	@heavy
+	async def history(self, member, *, title):
+		page = await self.wiki_db.resolve_page(member, title)
+		if page.alias:
+			return message(f'“{page.alias}” is an alias. Try /history {page.target}.', ephemeral=True)
+		revisions = [revision async for revision in self.wiki_db.get_page_revisions(member, title)]
+		if not revisions:
+			raise errors.PageNotFoundError(title)
+		# authors can't be looked up without the gateway, so they're shown as mentions
+		return message(truncate_lines(self.wiki.revision_summary(member.guild, revision) for revision in revisions))
+
+	@heavy
+	async def stats(self, member, *, title=None):
+		if title is None:
+			return message(embed=await self.wiki.guild_stats(member.guild.id))
+		return message(embed=await self.wiki.page_stats(member, title, command='/stats'))
+
+async def register_commands(token, application_id, *, guild_id=None):
+	"""replace the application's slash commands with COMMANDS, in one guild or (slowly, up to an hour) globally"""
+	url = f'{API_BASE}/applications/{application_id}'
+	if guild_id is not None:
+		url += f'/guilds/{guild_id}'
+	url += '/commands'
+	async with aiohttp.ClientSession(headers={'Authorization': f'Bot {token}'}) as session:
+		async with session.put(url, json=COMMANDS) as resp:
+			resp.raise_for_status()
+			return await resp.json()
+
+def generate_keys():
+	"""return a new (signing key, verify key) pair, in hex, for testing without Discord"""
+	signing_key = nacl.signing.SigningKey.generate()
+	return signing_key.encode().hex(), signing_key.verify_key.encode().hex()
+
+def fake_interaction(name, options, *, guild_id, user_id, role_ids=(), permissions=0):
+	"""return the payload of an interaction as Discord would send it, for testing"""
+	return {
+		'type': InteractionType.application_command,
+		'id': '0',
+		'token': 'fake',
+		'guild_id': str(guild_id),
+		'channel_id': '0',
+		'member': {
+			'user': {'id': str(user_id), 'username': 'test user', 'discriminator': '0000'},
+			'roles': [str(role_id) for role_id in role_ids],
+			'permissions': str(permissions),
+		},
+		'data': {
+			'id': '0',
+			'name': name,
+			'options': [{'type': STRING_OPTION, 'name': key, 'value': value} for key, value in options.items()],
+		},
+	}
+
+async def send_fake_interaction(url, signing_key, payload):
+	"""sign payload with signing_key (in hex) as Discord would, post it to url, and return the response"""
+	body = json.dumps(payload).encode()
+	timestamp = str(int(time.time()))
+	signature = nacl.signing.SigningKey(bytes.fromhex(signing_key)).sign(timestamp.encode() + body).signature
+	headers = {
+		'Content-Type': 'application/json',
+		'X-Signature-Ed25519': signature.hex(),
+		'X-Signature-Timestamp': timestamp,
+	}
+	async with aiohttp.ClientSession() as session, session.post(url, data=body, headers=headers) as resp:
+		return resp.status, await resp.text()
+
+def setup(bot):
+	config = bot.config.get('interactions')
+	if not config:
+		return
+	# don't take the rest of the bot down with us
+	if nacl is None:
+		logger.warning('not serving interactions: PyNaCl is not installed (pip install PyNaCl)')
+		return
+	if not config.get('public_key'):
+		logger.warning('not serving interactions: interactions.public_key is not set in the config')
+		return
+	bot.add_cog(InteractionServer(bot))
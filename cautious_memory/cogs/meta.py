@@ -49,6 +49,30 @@ class Meta(commands.Cog):
 		"""Sends you a link to invite me to your server."""
 		await ctx.send('<' + discord.utils.oauth_url(self.bot.user.id) + '>')
 
+	@commands.command(hidden=True)
+	@commands.is_owner()
+	async def startup(self, ctx):
+		"""Shows how long each step of startup took."""
+		paginator = commands.Paginator()
+		for line in self.bot.timeline.format().splitlines():
+			paginator.add_line(line)
+		for page in paginator.pages:
+			await ctx.send(page)
+
+	@commands.command(hidden=True)
+	@commands.is_owner()
+	async def admission(self, ctx):
+		"""Shows how long each class of database work has waited for a connection."""
+		table = []
+		for priority, admission_class in self.bot.admission.classes.items():
+			stats = admission_class.stats()
+			if not table:
+				table.append(['class', *stats])
+			table.append([priority.name, *map(str, stats.values())])
+		widths = [max(map(len, column)) for column in zip(*table)]
+		lines = ('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in table)
+		await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
 def setup(bot):
 	bot.add_cog(Meta(bot))
 	if not bot.config.get('support_server_invite_code'):
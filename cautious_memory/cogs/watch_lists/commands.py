@@ -16,6 +16,7 @@
 from bot_bin.sql import connection, optional_connection
 from discord.ext import commands
 
+from .db import Delivery
 from ...utils.paginator import Pages
 
 clean_content = commands.clean_content(use_nicknames=False)
@@ -55,5 +56,51 @@ class WatchLists(commands.Cog, name='Watch Lists'):
 			return
 		await Pages(ctx, entries=entries).begin()
 
+	@commands.command(name='watch-pattern')
+	async def watch_pattern(self, ctx, *, pattern: clean_content):
+		"""Watches every page whose title matches a pattern, including pages created later.
+
+		Patterns are case insensitive. * matches anything, ? matches any one character,
+		and [abc] matches any one of a, b, or c. For example, "guides/*" watches every page starting with "guides/".
+		"""
+		await self.db.watch_pattern(ctx.author, pattern)
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
+
+	@commands.command(name='unwatch-pattern')
+	async def unwatch_pattern(self, ctx, *, pattern: clean_content):
+		"""Stops watching a pattern. Pages you watch individually are not affected."""
+		success = await self.db.unwatch_pattern(ctx.author, pattern)
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][success])
+
+	@commands.command(name='watch-patterns')
+	async def watch_patterns(self, ctx):
+		"""Shows the patterns you are watching."""
+		entries = await self.db.pattern_watch_list(ctx.author)
+		if not entries:
+			await ctx.send(f'You are not watching any patterns. Use the {ctx.prefix}watch-pattern command to do so.')
+			return
+		await Pages(ctx, entries=entries).begin()
+
+	@commands.command(name='watch-delivery', usage='[immediate|hourly|daily]')
+	async def watch_delivery(self, ctx, delivery: str.lower = None):
+		"""Shows or sets when you are sent notifications for pages on your watch list.
+
+		immediate: one message per edit, as soon as it happens. This is the default.
+		hourly or daily: one message per hour or day, with all edits to each page since the last one
+		combined into a single diff.
+		"""
+		if delivery is None:
+			delivery = await self.db.delivery(ctx.author.id)
+			await ctx.send(f'Your watch list delivery is set to {delivery.value}.')
+			return
+
+		try:
+			delivery = Delivery(delivery)
+		except ValueError:
+			raise commands.BadArgument('Delivery must be one of immediate, hourly, or daily.')
+
+		await self.db.set_delivery(ctx.author.id, delivery)
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
+
 def setup(bot):
 	bot.add_cog(WatchLists(bot))
@@ -14,26 +14,54 @@
 # along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import datetime as dt
+import enum
+import itertools
 import logging
+import operator
 
 import discord
 from discord.ext import commands
 from bot_bin.sql import connection, optional_connection
 
+from .matcher import PatternMatcher
 from ..permissions.db import Permissions
-from ...utils import AttrDict, errors
+from ... import utils
+from ...utils import errors
+from ...utils.replicas import optional_read_connection
 
 logger = logging.getLogger(__name__)
 
+class Delivery(enum.Enum):
+	"""When to send someone their watch list notifications"""
+	immediate = 'immediate'
+	hourly = 'hourly'
+	daily = 'daily'
+
 class WatchListsDatabase(commands.Cog):
 	NOTIFICATION_EMBED_COLOR = discord.Color.from_hsv(262/360, 55/100, 76/100)
+	# UTC
+	DAILY_DIGEST_HOUR = 0
+	# Discord's embed limits
+	EMBED_FIELD_LIMIT = 25
+	EMBED_FIELD_VALUE_LIMIT = 1024
+	EMBED_TOTAL_LIMIT = 6000
+	# per user per guild
+	PATTERN_LIMIT = 25
 
 	def __init__(self, bot):
 		self.bot = bot
 		self.wiki_commands = self.bot.cogs['Wiki']
 		self.wiki_db = self.bot.cogs['WikiDatabase']
 		self.queries = self.bot.queries('watch_lists.sql')
+		# guild_id → PatternMatcher, loaded on first use
+		self.matchers = {}
+		self.matcher_locks = collections.defaultdict(asyncio.Lock)
+		self.digest_task = self.bot.loop.create_task(self.digest_loop())
+
+	def cog_unload(self):
+		self.digest_task.cancel()
 
 	@commands.Cog.listener()
 	@optional_connection
@@ -45,23 +73,45 @@ class WatchListsDatabase(commands.Cog):
 				logger.warning(f'on_cm_page_edit: guild_id {new.guild} not found!')
 				return
 
-			coros = []
-			async for user_id in self.page_subscribers(new.page_id):
+			pattern_user_ids = (await self.matcher(new.guild)).match(new.current_title)
+			immediate_user_ids = []
+			digest_user_ids = []
+			async for user_id, delivery in self.page_subscribers(new.page_id, pattern_user_ids):
 				# editing a page you subscribe to should not notify yourself
 				if user_id == new.author:
 					continue
 
-				member = guild.get_member(user_id)
+				if delivery is not Delivery.immediate:
+					# permissions are checked when the digest is sent
+					digest_user_ids.append(user_id)
+				else:
+					immediate_user_ids.append(user_id)
+
+			# the author too, for the notification embeds
+			members = await self.bot.member_resolver.resolve(guild, immediate_user_ids + [new.author])
+			coros = []
+			for user_id in immediate_user_ids:
+				member = members.get(user_id)
 				if member is None: continue
 
 				try:
 					await self.wiki_db.check_permissions(member, Permissions.view, new.current_title)
 				except errors.MissingPagePermissionsError:
-					return
+					continue
 
-				coros.append(member.send(embed=self.page_edit_notification(member, old, new)))
+				if old is None:
+					embed = self.page_create_notification(member, new)
+				else:
+					embed = self.page_edit_notification(member, old, new)
+				coros.append(member.send(embed=embed))
 
-			await asyncio.gather(*coros)
+			if digest_user_ids:
+				await connection().execute(
+					self.queries.queue_page_edit_notifications(),
+					new.guild, new.page_id, None if old is None else old.revision_id, new.revision_id,
+					digest_user_ids)
+
+		await asyncio.gather(*coros)
 
 	@commands.Cog.listener()
 	@optional_connection
@@ -71,21 +121,179 @@ class WatchListsDatabase(commands.Cog):
 			logger.warning(f'on_cm_page_delete: guild_id {guild_id} not found!')
 			return
 
-		coros = []
-		async for user_id in self.page_subscribers(page_id):
-			member = guild.get_member(user_id)
-			if member is None: continue
-			coros.append(member.send(embed=self.page_delete_notification(guild, title)))
+		pattern_user_ids = (await self.matcher(guild_id)).match(title)
+		immediate_user_ids = []
+		digest_user_ids = []
+		async for user_id, delivery in self.page_subscribers(page_id, pattern_user_ids):
+			if delivery is not Delivery.immediate:
+				digest_user_ids.append(user_id)
+			else:
+				immediate_user_ids.append(user_id)
+
+		members = await self.bot.member_resolver.resolve(guild, immediate_user_ids)
+		coros = [
+			member.send(embed=self.page_delete_notification(guild, title))
+			for member in members.values()]
+
+		if digest_user_ids:
+			await connection().execute(
+				self.queries.queue_page_delete_notifications(),
+				guild_id, page_id, title, digest_user_ids)
+
 		await asyncio.gather(*coros)
 		await self.delete_page_subscribers(page_id)
 
+	### Digests
+
+	async def digest_loop(self):
+		while True:
+			now = dt.datetime.utcnow()
+			next_hour = now.replace(minute=0, second=0, microsecond=0) + dt.timedelta(hours=1)
+			await asyncio.sleep((next_hour - now).total_seconds())
+
+			# immediate is included in case someone switched to it while they had notifications pending
+			deliveries = [Delivery.immediate, Delivery.hourly]
+			if next_hour.hour == self.DAILY_DIGEST_HOUR:
+				deliveries.append(Delivery.daily)
+
+			try:
+				await self.send_digests(deliveries)
+			except Exception:
+				logger.exception('failed to send watch list digests')
+
+	async def send_digests(self, deliveries):
+		"""send the pending notifications of everyone with one of deliveries.
+		Notifications are deleted once they've been sent, or if they can't ever be,
+		so those whose DMs failed for another reason are retried in the next digest.
+		"""
+		pending = await self.bot.pool.fetch(
+			self.queries.pending_notifications(),
+			[delivery.value for delivery in deliveries])
+
+		# look up every recipient in each guild at once
+		guild_user_ids = collections.defaultdict(list)
+		for notification in pending:
+			guild_user_ids[notification['guild']].append(notification['user_id'])
+		guild_members = {}
+		for guild_id, user_ids in guild_user_ids.items():
+			guild = self.bot.get_guild(guild_id)
+			if guild is not None:
+				guild_members[guild_id] = await self.bot.member_resolver.resolve(guild, user_ids)
+
+		# several people watching the same page get the same diff
+		diffs = {}
+		# (notifications, coroutine which sends them)
+		sends = []
+		done = []
+		for user_id, notifications in itertools.groupby(pending, key=operator.itemgetter('user_id')):
+			notifications = list(notifications)
+			fields = []
+			for notification in notifications:
+				member = guild_members.get(notification['guild'], {}).get(user_id)
+				if member is None:
+					continue
+				field = await self.digest_field(member, notification, diffs)
+				if field is not None:
+					fields.append(field)
+					# any of their member objects can be used to DM them
+					recipient = member
+
+			if fields:
+				sends.append((notifications, self.send_digest(recipient, fields)))
+			else:
+				# nothing they can see, or they've left every guild these are from
+				done.extend(notifications)
+
+		results = await asyncio.gather(*(coro for notifications, coro in sends), return_exceptions=True)
+		for (notifications, coro), result in zip(sends, results):
+			# Forbidden means they don't accept DMs from us, which retrying won't fix
+			if isinstance(result, Exception) and not isinstance(result, discord.Forbidden):
+				logger.warning('failed to send a watch list digest to %s', notifications[0]['user_id'], exc_info=result)
+				continue
+			done.extend(notifications)
+
+		if done:
+			await self.bot.pool.execute(
+				self.queries.delete_sent_notifications(),
+				[notification['user_id'] for notification in done],
+				[notification['page_id'] for notification in done],
+				[notification['edit_count'] for notification in done],
+				[notification['deleted_title'] for notification in done])
+
+	async def send_digest(self, recipient, fields):
+		for embed in self.digest_embeds(fields):
+			await recipient.send(embed=embed)
+
+	async def digest_field(self, member, notification, diffs):
+		"""return the (name, value) of the embed field describing one page's changes, or None to skip it"""
+		guild = member.guild
+		if notification['deleted_title'] is not None:
+			return f'Page “{notification["deleted_title"]}” was deleted in server {guild}', '\N{wastebasket}'
+
+		key = guild.id, notification['old_revision_id'], notification['new_revision_id']
+		try:
+			old, new, diff = diffs[key]
+		except KeyError:
+			# old_revision_id is null if the page was created since the last digest
+			revision_ids = [revision_id for revision_id in key[1:] if revision_id is not None]
+			try:
+				*old, new = await self.wiki_db.get_individual_revisions(guild.id, revision_ids)
+			except ValueError:
+				# the revisions are gone
+				return None
+			old = old[0] if old else None
+			if old is None:
+				diff = self.creation_summary(new)
+			else:
+				try:
+					diff = self.wiki_commands.diff(guild, old, new)
+				except commands.UserInputError as exc:
+					diff = str(exc)
+			diffs[key] = old, new, diff
+
+		try:
+			await self.wiki_db.check_permissions(member, Permissions.view, new.current_title)
+		except (errors.MissingPagePermissionsError, errors.PageNotFoundError):
+			return None
+
+		count = notification['edit_count']
+		edits = f' ({count} edits)' if count > 1 else ''
+		action = 'created' if old is None else 'edited'
+		return (
+			f'Page “{new.current_title}” was {action} in server {guild}{edits}',
+			self.truncate_code_block(diff, self.EMBED_FIELD_VALUE_LIMIT))
+
+	def digest_embeds(self, fields):
+		def new_embed():
+			embed = discord.Embed(title='Watch list digest', color=self.NOTIFICATION_EMBED_COLOR)
+			embed.timestamp = dt.datetime.utcnow()
+			return embed
+
+		embed = new_embed()
+		length = len(embed.title)
+		for name, value in fields:
+			if len(embed.fields) == self.EMBED_FIELD_LIMIT or length + len(name) + len(value) > self.EMBED_TOTAL_LIMIT:
+				yield embed
+				embed = new_embed()
+				length = len(embed.title)
+			embed.add_field(name=name[:256], value=value, inline=False)
+			length += len(name) + len(value)
+		yield embed
+
+	@staticmethod
+	def truncate_code_block(s, limit):
+		if len(s) <= limit:
+			return s
+		end = '…```' if s.startswith('```') else '…'
+		return s[:limit - len(end)] + end
+
 	def page_edit_notification(self, member, old, new):
 		embed = discord.Embed()
 		embed.title = f'Page “{new.current_title}” was edited in server {member.guild}'
 		embed.color = self.NOTIFICATION_EMBED_COLOR
 		embed.set_footer(text='Edited')
 		embed.timestamp = new.revised
-		author = member.guild.get_member(new.author)
+		author = self.bot.member_resolver.get(member.guild, new.author)
 		if author is not None:
 			embed.set_author(name=author.name, icon_url=author.avatar_url_as(static_format='png', size=64))
 		try:
@@ -94,6 +302,22 @@ class WatchListsDatabase(commands.Cog):
 			embed.description = str(exc)
 		return embed
 
+	def page_create_notification(self, member, new):
+		embed = discord.Embed()
+		embed.title = f'Page “{new.current_title}” was created in server {member.guild}'
+		embed.color = self.NOTIFICATION_EMBED_COLOR
+		embed.set_footer(text='Created')
+		embed.timestamp = new.revised
+		author = self.bot.member_resolver.get(member.guild, new.author)
+		if author is not None:
+			embed.set_author(name=author.name, icon_url=author.avatar_url_as(static_format='png', size=64))
+		embed.description = self.truncate_code_block(self.creation_summary(new), 2048)
+		return embed
+
+	@staticmethod
+	def creation_summary(new):
+		return '```\n' + utils.escape_code_blocks(new.content) + '```'
+
 	def page_delete_notification(self, guild, title):
 		embed = discord.Embed()
 		embed.title = f'Page “{title}” was deleted in server {guild}'
@@ -112,6 +336,7 @@ class WatchListsDatabase(commands.Cog):
 			tag = await connection().execute(self.queries.watch_page(), member.guild.id, member.id, title)
 			if tag.rsplit(None, 1)[-1] == '0':
 				raise errors.PageNotFoundError(title)
+			self.bot.note_write(member.guild.id)
 
 	@optional_connection
 	async def unwatch_page(self, member, title) -> bool:
@@ -119,19 +344,79 @@ class WatchListsDatabase(commands.Cog):
 		return success, ie True if they were a subscriber before.
 		"""
 		tag = await connection().execute(self.queries.unwatch_page(), member.guild.id, member.id, title)
+		self.bot.note_write(member.guild.id)
 		return tag.split(None, 1)[-1] == '1'
 
+	async def matcher(self, guild_id):
+		"""return the PatternMatcher for guild_id's pattern watches"""
+		async with self.matcher_locks[guild_id]:
+			try:
+				return self.matchers[guild_id]
+			except KeyError:
+				pass
+
+			matcher = PatternMatcher()
+			for user_id, pattern in await self.bot.pool.fetch(self.queries.guild_patterns(), guild_id):
+				matcher.add(pattern, user_id)
+			self.matchers[guild_id] = matcher
+			return matcher
+
 	@optional_connection
+	async def watch_pattern(self, member, pattern):
+		"""subscribe the given user to every page in their guild whose title matches the given glob pattern"""
+		if len(pattern) > self.wiki_db.TITLE_LENGTH_LIMIT:
+			raise errors.WatchPatternError(
+				f'That pattern is {len(pattern)} characters long, '
+				f'but the limit is {self.wiki_db.TITLE_LENGTH_LIMIT} characters.')
+
+		async with connection().transaction():
+			count = await connection().fetchval(self.queries.pattern_count(), member.guild.id, member.id)
+			if count >= self.PATTERN_LIMIT:
+				raise errors.WatchPatternError(f'You may only watch up to {self.PATTERN_LIMIT} patterns per server.')
+			await connection().execute(self.queries.watch_pattern(), member.guild.id, member.id, pattern)
+
+		(await self.matcher(member.guild.id)).add(pattern, member.id)
+
+	@optional_connection
+	async def unwatch_pattern(self, member, pattern) -> bool:
+		"""unsubscribe the given user from the given pattern.
+		return success, ie True if they were a subscriber before.
+		"""
+		tag = await connection().execute(self.queries.unwatch_pattern(), member.guild.id, member.id, pattern)
+		(await self.matcher(member.guild.id)).remove(pattern, member.id)
+		return tag.split(None, 1)[-1] == '1'
+
+	async def pattern_watch_list(self, member):
+		return [
+			pattern for pattern, in
+			await self.bot.pool.fetch(self.queries.pattern_watch_list(), member.guild.id, member.id)]
+
+	@optional_read_connection
 	async def watch_list(self, member):
 		async with connection().transaction():
 			async for page_id, title in connection().cursor(self.queries.watch_list(), member.guild.id, member.id):
 				yield page_id, title
 
 	@optional_connection
-	async def page_subscribers(self, page_id):
+	async def page_subscribers(self, page_id, pattern_user_ids=()):
+		"""yield (user_id, Delivery) for every subscriber of the page,
+		and for every user in pattern_user_ids, which is for users whose pattern watches match the page.
+		"""
 		async with connection().transaction():
-			async for user_id, in connection().cursor(self.queries.page_subscribers(), page_id):
-				yield user_id
+			async for user_id, delivery in connection().cursor(
+				self.queries.page_subscribers(), page_id, list(pattern_user_ids),
+			):
+				yield user_id, Delivery(delivery)
+
+	async def delivery(self, user_id):
+		delivery = await self.bot.pool.fetchval(self.queries.get_delivery(), user_id)
+		return Delivery(delivery or Delivery.immediate.value)
+
+	async def set_delivery(self, user_id, delivery: Delivery):
+		if delivery is Delivery.immediate:
+			await self.bot.pool.execute(self.queries.delete_delivery(), user_id)
+		else:
+			await self.bot.pool.execute(self.queries.set_delivery(), user_id, delivery.value)
 
 	@optional_connection
 	async def delete_page_subscribers(self, page_id):
@@ -141,8 +426,8 @@ class WatchListsDatabase(commands.Cog):
 	async def get_revision_and_previous(self, revision_id):
 		rows = await connection().fetch(self.queries.get_revision_and_previous(), revision_id)
 		if not rows: return rows
-		if len(rows) == 1: return None, AttrDict(rows[0])
-		return list(map(AttrDict, rows[::-1]))  # old to new
+		if len(rows) == 1: return None, rows[0]
+		return rows[::-1]  # old to new
 
 def setup(bot):
 	bot.add_cog(WatchListsDatabase(bot))
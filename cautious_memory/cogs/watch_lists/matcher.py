@@ -0,0 +1,114 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import fnmatch
+import re
+
+from ..wiki.directory import fold
+
+WILDCARDS = re.compile(r'[*?\[]')
+
+def literal_prefix(pattern):
+	"""return the part of a glob pattern before its first wildcard"""
+	match = WILDCARDS.search(pattern)
+	return pattern if match is None else pattern[:match.start()]
+
+class _Node:
+	__slots__ = ('children', 'prefix_users', 'globs')
+
+	def __init__(self):
+		self.children = {}
+		# users watching every title that starts with the path to this node
+		self.prefix_users = set()
+		# pattern → (compiled pattern, users), for glob patterns whose literal prefix is the path to this node
+		self.globs = {}
+
+	def is_empty(self):
+		return not (self.children or self.prefix_users or self.globs)
+
+class PatternMatcher:
+	"""Every pattern watch in one guild.
+
+	Patterns are case insensitive globs. "prefix*" patterns are stored as trie nodes;
+	other globs are stored at the node of their literal prefix, so matching a title walks the trie once
+	and only tests the globs whose literal prefix the title starts with.
+	"""
+	__slots__ = ('root',)
+
+	def __init__(self):
+		self.root = _Node()
+
+	def _path(self, prefix, *, create):
+		"""return the nodes from the root to the node for prefix, or None if it doesn't exist and create is False"""
+		nodes = [self.root]
+		for char in prefix:
+			node = nodes[-1].children.get(char)
+			if node is None:
+				if not create:
+					return None
+				node = nodes[-1].children[char] = _Node()
+			nodes.append(node)
+		return nodes
+
+	def add(self, pattern, user_id):
+		pattern = fold(pattern)
+		prefix = literal_prefix(pattern)
+		node = self._path(prefix, create=True)[-1]
+		if pattern == prefix + '*':
+			node.prefix_users.add(user_id)
+		else:
+			_, users = node.globs.setdefault(pattern, (re.compile(fnmatch.translate(pattern), re.DOTALL), set()))
+			users.add(user_id)
+
+	def remove(self, pattern, user_id):
+		pattern = fold(pattern)
+		prefix = literal_prefix(pattern)
+		path = self._path(prefix, create=False)
+		if path is None:
+			return
+
+		node = path[-1]
+		if pattern == prefix + '*':
+			node.prefix_users.discard(user_id)
+		elif pattern in node.globs:
+			_, users = node.globs[pattern]
+			users.discard(user_id)
+			if not users:
+				del node.globs[pattern]
+
+		# prune nodes that no longer lead anywhere
+		for parent, char in zip(reversed(path[:-1]), reversed(prefix)):
+			if not parent.children[char].is_empty():
+				break
+			del parent.children[char]
+
+	def match(self, title):
+		"""return the IDs of every user with a pattern matching title"""
+		title = fold(title)
+		users = set()
+		node = self.root
+		depth = 0
+		while True:
+			users |= node.prefix_users
+			for regex, glob_users in node.globs.values():
+				if regex.match(title):
+					users |= glob_users
+			if depth == len(title):
+				break
+			node = node.children.get(title[depth])
+			if node is None:
+				break
+			depth += 1
+		return users
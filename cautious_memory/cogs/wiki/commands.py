@@ -27,6 +27,8 @@ from discord.ext import commands
 from ..permissions.db import Permissions
 from ... import utils
 from ...utils import errors
+from ...utils.admission import heavy
+from ...utils.cache import LRUCache
 from ...utils.paginator import Pages, TextPages
 
 # if someone names a page with an @mention, we should use the username of that user
@@ -48,11 +50,38 @@ class RevisionID(commands.Converter):
 		self.title = await clean_content.convert(ctx, title)
 		return self
 
+class AsOf(commands.Converter):
+	"""--at <timestamp> [--deleted], optionally followed by a title"""
+	async def convert(self, ctx, arg):
+		words = arg.split(None, 2)
+		if len(words) < 2 or words[0] != '--at':
+			raise commands.BadArgument('Expected --at <timestamp>.')
+
+		try:
+			at = datetime.datetime.fromisoformat(words[1])
+		except ValueError:
+			raise commands.BadArgument('Timestamps must look like 2020-01-31 or 2020-01-31T18:30.')
+		if at.tzinfo is not None:
+			at = at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+		self.at = at
+
+		rest = words[2] if len(words) == 3 else ''
+		self.include_deleted = rest.split(None, 1)[:1] == ['--deleted']
+		if self.include_deleted:
+			rest = rest[len('--deleted'):].strip()
+		self.title = rest or None
+		return self
+
 class Wiki(commands.Cog):
+	RAW_CACHE_SIZE = 1000
+	MULTI_PAGE_LIMIT = 10
+
 	def __init__(self, bot):
 		self.bot = bot
 		self.db = self.bot.cogs['WikiDatabase']
 		self.permissions_db = self.bot.cogs['PermissionsDatabase']
+		# (revision ID, format) → output of render_raw
+		self.raw_cache = LRUCache(self.RAW_CACHE_SIZE)
 
 	def cog_check(self, ctx):
 		if not ctx.guild:
@@ -61,11 +90,55 @@ class Wiki(commands.Cog):
 
 	@commands.command(aliases=['show', 'view'])
 	async def page(self, ctx, *, title: clean_content):
-		"""Shows you the contents of the page requested."""
-		async with self.bot.pool.acquire() as conn, conn.transaction():
-			connection.set(conn)
-			page = await self.db.get_page(ctx.author, title)
-			await self.db.log_page_use(ctx.guild.id, title)
+		"""Shows you the contents of the page requested.
+
+		Pages can include the contents of other pages by writing {{page:Title}}.
+
+		To see the page as it was at some time in the past, put --at <timestamp> before the title.
+		Timestamps are like 2020-01-31 or 2020-01-31T18:30, in UTC.
+		Administrators may add --deleted after the timestamp to also look for pages that have since been deleted.
+		"""
+		if title.startswith('--at '):
+			await self.page_at(ctx, await AsOf().convert(ctx, title))
+			return
+
+		# get_page may read from a replica, so these can't share a connection
+		page = await self.db.get_page(ctx.author, title)
+		content = await self.db.render(ctx.guild.id, page, member=ctx.author)
+		await self.db.log_page_use(ctx.guild.id, title, ctx.author.id)
+		await ctx.send(content)
+
+	@commands.command(usage='<title> | <title> | …')
+	async def pages(self, ctx, *, titles: clean_content = None):
+		"""Shows you the contents of several pages at once.
+
+		Separate the titles with "|", like this: pages rules | faq | roles
+		Pages are sent in as few messages as possible.
+		Without any titles, this lists every page, like the list command.
+		"""
+		if titles is None or titles.startswith('--at '):
+			await ctx.invoke(self.list, as_of=titles and await AsOf().convert(ctx, titles))
+			return
+
+		titles = list(dict.fromkeys(filter(None, (title.strip() for title in titles.split('|')))))
+		if not titles:
+			raise commands.BadArgument('At least one title is required.')
+		if len(titles) > self.MULTI_PAGE_LIMIT:
+			raise commands.BadArgument(f'You can only show up to {self.MULTI_PAGE_LIMIT} pages at once.')
+
+		pages = await self.db.get_pages(ctx.author, titles)
+		contents = [await self.db.render(ctx.guild.id, page, member=ctx.author) for page in pages]
+		await self.db.log_page_uses(ctx.guild.id, [page.page_id for page in pages], ctx.author.id)
+		for message in utils.pack(contents):
+			await ctx.send(message)
+
+	async def page_at(self, ctx, as_of):
+		if as_of.title is None:
+			raise commands.BadArgument('A title is required.')
+		page = await self.db.get_page_at(ctx.author, as_of.title, as_of.at, include_deleted=as_of.include_deleted)
+		await ctx.send(
+			f'“{page.title}” as of {utils.format_datetime(as_of.at)} '
+			f'(revision {page.revision_id}, {utils.format_datetime(page.revised)}):')
 		await ctx.send(page.content)
 
 	@commands.command(aliases=['readlink'])
@@ -80,28 +153,33 @@ class Wiki(commands.Cog):
 				f'“{page.target}” is not an alias. Use the {ctx.prefix}history command for more information on it.')
 
 	@commands.command()
+	@heavy
 	async def stats(self, ctx, *, title: clean_content = None):
 		"""Shows server-wide or per-page statistics on page usage and revision."""
 		if title is None:
-			await self.guild_stats(ctx)
+			e = await self.guild_stats(ctx.guild.id)
 		else:
-			await self.page_stats(ctx, title)
+			e = await self.page_stats(ctx.author, title, command=ctx.prefix + ctx.invoked_with)
+		await ctx.send(embed=e)
 
-	async def guild_stats(self, ctx):
+	async def guild_stats(self, guild_id):
 		cutoff = datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
 		e = discord.Embed(title='Page stats')
 		# no transaction because maybe doing a lot of COUNTing would require table wide locks
 		# to maintain consistency (dunno, just a hunch)
-		async with self.bot.pool.acquire() as conn:
+		async with self.bot.read_pool(guild_id).acquire() as conn:
 			connection.set(conn)
-			page_count = await self.db.page_count(ctx.guild.id)
-			revisions_count = await self.db.revisions_count(ctx.guild.id)
-			total_page_uses = await self.db.total_page_uses(ctx.guild.id, cutoff=cutoff)
-			e.description = f'{page_count} pages, {revisions_count} revisions, {total_page_uses} recent page uses'
+			page_count = await self.db.page_count(guild_id)
+			revisions_count = await self.db.revisions_count(guild_id)
+			total_page_uses = await self.db.total_page_uses(guild_id, cutoff=cutoff)
+			unique_viewers = await self.db.guild_unique_viewers(guild_id, cutoff=cutoff)
+			e.description = (
+				f'{page_count} pages, {revisions_count} revisions, {total_page_uses} recent page uses, '
+				f'~{unique_viewers} recent unique viewers')
 
 			first_place = ord('🥇')
 
-			top_pages = await self.db.top_pages(ctx.guild.id, cutoff=cutoff)
+			top_pages = await self.db.top_pages(guild_id, cutoff=cutoff)
 			if top_pages:
 				value = '\n'.join(
 					f'{chr(first_place + i)} {page.title} ({page.count} recent uses)'
@@ -111,7 +189,7 @@ class Wiki(commands.Cog):
 
 			e.add_field(name='Top pages', inline=False, value=value)
 
-			top_editors = await self.db.top_editors(ctx.guild.id, cutoff=cutoff)
+			top_editors = await self.db.top_editors(guild_id, cutoff=cutoff)
 			if top_editors:
 				value = '\n'.join(
 					f'{chr(first_place + i)} <@{editor.id}> ({editor.count} revisions)'
@@ -121,32 +199,35 @@ class Wiki(commands.Cog):
 
 			e.add_field(name='Top editors', inline=False, value=value)
 
-		await ctx.send(embed=e)
+		return e
 
-	async def page_stats(self, ctx, title):
+	async def page_stats(self, member, title, *, command):
+		"""command is how to invoke the stats command, for suggesting it if title is an alias"""
 		cutoff = datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
 
-		e = discord.Embed(title=f'Stats for “{title}”')
-		async with self.bot.pool.acquire() as conn:
+		guild_id = member.guild.id
+		async with self.bot.read_pool(guild_id).acquire() as conn:
 			connection.set(conn)
-			page = await self.db.get_page(ctx.author, title, partial=True)
-			if page.alias:  # TODO try and defer this HTTP call till after conn is closed
-				await ctx.send(f'That page is an alias. Try {ctx.prefix}{ctx.invoked_with} {page.original}.')
-				return
+			page = await self.db.get_page(member, title, partial=True)
+			if page.alias:
+				raise commands.BadArgument(f'That page is an alias. Try {command} {page.original}.')
 
-			top_editors = await self.db.top_page_editors(ctx.guild.id, title)
-			revisions_count = await self.db.page_revisions_count(ctx.guild.id, title)
-			usage_count = await self.db.page_uses(ctx.guild.id, title, cutoff=cutoff)
+			top_editors = await self.db.top_page_editors(guild_id, title)
+			revisions_count = await self.db.page_revisions_count(guild_id, title)
+			usage_count = await self.db.page_uses(guild_id, title, cutoff=cutoff)
+			unique_viewers = await self.db.page_unique_viewers(guild_id, title, cutoff=cutoff)
 
 		e = discord.Embed(title=f'Stats for {page.original}')
-		e.description = f'{revisions_count} all time revisions, {usage_count} recent uses'
+		e.description = (
+			f'{revisions_count} all time revisions, {usage_count} recent uses, '
+			f'~{unique_viewers} recent unique viewers')
 
 		first_place = ord('🥇')
 		e.add_field(name='Top editors', inline=False, value='\n'.join(
 			f'{chr(first_place + i)} <@{editor.id}> authored {editor.rank:.2%} ({editor.count}) revisions recently'
 			for i, editor in enumerate(top_editors)))
 
-		await ctx.send(embed=e)
+		return e
 
 	emoji_escape_regex = re.compile(r'<a?(:\w+:)\d+>', re.ASCII)
 	emoji_remove_escaped_underscores_regex = re.compile(r':(?:\w|\\_)+:', re.ASCII)
@@ -157,26 +238,16 @@ class Wiki(commands.Cog):
 
 		This is with markdown escaped, which is useful for editing.
 		"""
-		async with self.bot.pool.acquire() as conn, conn.transaction():
-			connection.set(conn)
-			page = await self.db.get_page(ctx.author, title)
-			await self.db.log_page_use(ctx.guild.id, title)
+		page = await self.db.get_page(ctx.author, title)
+		await self.db.log_page_use(ctx.guild.id, title, ctx.author.id)
 
-		# replace emojis with their names for mobile users, since on android at least, copying a message
-		# with emojis in it copies just the name, not the name and colons
-		# we also don't want the user to see the raw <:name:1234> form because they can't send that directly
-		escaped = self.emoji_escape_regex.sub(r'\1', page.content)
+		escaped = self.render_raw(page, 'markdown')
 		if len(escaped) > 2000:
 			# in this case we don't want to send the fully escaped version
 			# since there is no markdown in a plaintext file
-			await ctx.send(discord.File(io.StringIO(escaped), page.title + '.md'))
+			await ctx.send(file=self.raw_file(page))
 		else:
-			# escape_markdown messes up emojis for mobile users
-			escaped2 = self.emoji_remove_escaped_underscores_regex.sub(
-				lambda m: m[0].replace(r'\_', '_'), discord.utils.escape_markdown(escaped))
-			if len(escaped2) > 2000:
-				await ctx.send(file=discord.File(io.StringIO(escaped), page.title + '.md'))
-			await ctx.send(escaped2)
+			await ctx.send(escaped)
 
 	@commands.command(aliases=['altraw'])
 	async def coderaw(self, ctx, *, title: clean_content):
@@ -184,32 +255,65 @@ class Wiki(commands.Cog):
 
 		This is for some tricky markdown that is hard to show outside of a code block, like ">" at the end of a link.
 		"""
-		async with self.bot.pool.acquire() as conn, conn.transaction():
-			connection.set(conn)
-			page = await self.db.get_page(ctx.author, title)
-			await self.db.log_page_use(ctx.guild.id, title)
+		page = await self.db.get_page(ctx.author, title)
+		await self.db.log_page_use(ctx.guild.id, title, ctx.author.id)
 
-		emoji_escaped = self.emoji_escape_regex.sub(r'\1', page.content)
-		code_blocked = utils.code_block(utils.escape_code_blocks(emoji_escaped))
+		code_blocked = self.render_raw(page, 'code')
 		if len(code_blocked) > 2000:
-			await ctx.send(file=discord.File(io.StringIO(emoji_escaped), page.title + '.md'))
+			await ctx.send(file=self.raw_file(page))
 		else:
 			await ctx.send(code_blocked)
 
 	@commands.command()
 	async def fileraw(self, ctx, *, title: clean_content):
 		"""Shows the raw contents of a page in a file attachment."""
-		async with self.bot.pool.acquire() as conn, conn.transaction():
-			connection.set(conn)
-			page = await self.db.get_page(ctx.author, title)
-			await self.db.log_page_use(ctx.guild.id, title)
+		page = await self.db.get_page(ctx.author, title)
+		await self.db.log_page_use(ctx.guild.id, title, ctx.author.id)
+		await ctx.send(file=self.raw_file(page))
+
+	def raw_file(self, page):
+		# BytesIO shares the cached bytes rather than copying them
+		return discord.File(io.BytesIO(self.render_raw(page, 'file')), page.title + '.md')
+
+	def render_raw(self, page, format):
+		"""return the latest revision of page escaped for one of the raw commands.
+		format is 'markdown', 'code', or 'file', which is encoded, ready to upload.
+		Revisions never change, so the output is cached by revision ID.
+		"""
+		key = page.latest_revision, format
+		rendered = self.raw_cache.get(key)
+		if rendered is not None:
+			return rendered
 
+		# replace emojis with their names for mobile users, since on android at least, copying a message
+		# with emojis in it copies just the name, not the name and colons
+		# we also don't want the user to see the raw <:name:1234> form because they can't send that directly
 		escaped = self.emoji_escape_regex.sub(r'\1', page.content)
-		await ctx.send(file=discord.File(io.StringIO(escaped), page.title + '.md'))
+		if format == 'file':
+			rendered = escaped.encode()
+		elif format == 'code':
+			rendered = utils.code_block(utils.escape_code_blocks(escaped))
+		else:
+			# escape_markdown messes up emojis for mobile users
+			rendered = self.emoji_remove_escaped_underscores_regex.sub(
+				lambda m: m[0].replace(r'\_', '_'), discord.utils.escape_markdown(escaped))
+
+		self.raw_cache[key] = rendered
+		return rendered
+
+	@commands.command(usage='[--at <timestamp> [--deleted]]')
+	@heavy
+	async def list(self, ctx, *, as_of: AsOf = None):
+		"""Shows you a list of all the pages on this server.
+
+		With --at <timestamp>, shows the pages as they were at that time, in UTC.
+		Timestamps are like 2020-01-31 or 2020-01-31T18:30.
+		Administrators may add --deleted to include pages that have since been deleted.
+		"""
+		if as_of is not None:
+			await self.list_at(ctx, as_of)
+			return
 
-	@commands.command(aliases=['pages'])
-	async def list(self, ctx):
-		"""Shows you a list of all the pages on this server."""
 		paginator = Pages(ctx, entries=[p.title async for p in self.db.get_all_pages(ctx.author)])
 
 		if not paginator.entries:
@@ -218,7 +322,18 @@ class Wiki(commands.Cog):
 
 		await paginator.begin()
 
+	async def list_at(self, ctx, as_of):
+		pages = await self.db.get_pages_at(ctx.author, as_of.at, include_deleted=as_of.include_deleted)
+		if not pages:
+			await ctx.send(f'There were no pages as of {utils.format_datetime(as_of.at)}.')
+			return
+
+		await Pages(ctx, entries=[
+			f'{page.title} (revision {page.revision_id})' + (' (since deleted)' if page.deleted else '')
+			for page in pages]).begin()
+
 	@commands.command(name='recent-revisions', aliases=['recent', 'recent-changes'])
+	@heavy
 	async def recent_revisions(self, ctx):
 		"""Shows you a list of the most recent revisions to pages on this server.
 
@@ -227,9 +342,9 @@ class Wiki(commands.Cog):
 		cutoff_delta = datetime.timedelta(weeks=2)
 		cutoff = datetime.datetime.utcnow() - cutoff_delta
 
-		entries = [
-			self.revision_summary(ctx.guild, revision)
-			async for revision in self.db.get_recent_revisions(ctx.author, cutoff)]
+		revisions = [revision async for revision in self.db.get_recent_revisions(ctx.author, cutoff)]
+		await self.resolve_authors(ctx.guild, revisions)
+		entries = [self.revision_summary(ctx.guild, revision) for revision in revisions]
 
 		if not entries:
 			delta = absolute_natural_timedelta(cutoff_delta.total_seconds())
@@ -239,6 +354,7 @@ class Wiki(commands.Cog):
 		await Pages(ctx, entries=entries, numbered=False).begin()
 
 	@commands.command()
+	@heavy
 	async def search(self, ctx, *, query):
 		"""Searches this server's wiki pages for titles similar to your query."""
 		paginator = Pages(ctx, entries=[p.title async for p in self.db.search_pages(ctx.author, query)])
@@ -317,20 +433,21 @@ class Wiki(commands.Cog):
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
 
 	@commands.command(aliases=['revisions'])
+	@heavy
 	async def history(self, ctx, *, title: clean_content):
 		"""Shows the revisions of a particular page"""
 
-		async with self.bot.pool.acquire() as conn:
+		async with self.bot.read_pool(ctx.guild.id).acquire() as conn:
 			connection.set(conn)
 			page = await self.db.resolve_page(ctx.author, title)
 			if page.alias:
 				await ctx.send(f'“{page.alias}” is an alias. Try {ctx.prefix}{ctx.invoked_with} {page.target}.')
 				return
 
-			entries = [
-				self.revision_summary(ctx.guild, revision)
-				async for revision in self.db.get_page_revisions(ctx.author, title)]
+			revisions = [revision async for revision in self.db.get_page_revisions(ctx.author, title)]
 
+		await self.resolve_authors(ctx.guild, revisions)
+		entries = [self.revision_summary(ctx.guild, revision) for revision in revisions]
 		if not entries:
 			raise errors.PageNotFoundError(title)
 
@@ -360,6 +477,7 @@ class Wiki(commands.Cog):
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
 
 	@commands.command(aliases=['diff'], usage='<revision 1> <revision 2>')
+	@heavy
 	async def compare(self, ctx, revision_id_1: int, revision_id_2: int):
 		"""Compares two page revisions by their ID.
 
@@ -371,7 +489,7 @@ class Wiki(commands.Cog):
 			await ctx.send('Provided revision IDs must be distinct.')
 			return
 
-		async with self.bot.pool.acquire() as conn:
+		async with self.bot.read_pool(ctx.guild.id).acquire() as conn:
 			connection.set(conn)
 			try:
 				old, new = await self.db.get_individual_revisions(ctx.guild.id, (revision_id_1, revision_id_2))
@@ -382,13 +500,13 @@ class Wiki(commands.Cog):
 				return
 			await self.db.check_permissions(ctx.author, Permissions.edit, new.title)
 
+		await self.resolve_authors(ctx.guild, [old, new])
 		await TextPages(ctx, self.diff(ctx.guild, old, new), prefix='', suffix='').begin()
 
-	@classmethod
-	def diff(cls, guild, old, new):
+	def diff(self, guild, old, new):
 		# wew this was hard to get right
 		if new.old_title != old.title or new.title != old.title:
-			return cls.renamed_revision_summary(guild, new, old_title=old.title)
+			return self.renamed_revision_summary(guild, new, old_title=old.title)
 
 		if old.page_id != new.page_id:
 			raise commands.UserInputError('You can only compare revisions of the same page.')
@@ -396,8 +514,8 @@ class Wiki(commands.Cog):
 		diff = list(difflib.unified_diff(
 			old.content.splitlines(),
 			new.content.splitlines(),
-			fromfile=cls.revision_summary(guild, old),
-			tofile=cls.revision_summary(guild, new),
+			fromfile=self.revision_summary(guild, old),
+			tofile=self.revision_summary(guild, new),
 			lineterm=''))
 
 		if not diff:
@@ -405,9 +523,8 @@ class Wiki(commands.Cog):
 
 		return '```diff\n' + '\n'.join(map(utils.escape_code_blocks, diff)) + '```'
 
-	@classmethod
-	def revision_summary(cls, guild, revision):
-		author = cls.format_member(guild, revision.author)
+	def revision_summary(self, guild, revision):
+		author = self.format_member(guild, revision.author)
 		author_at = f'{author} at {utils.format_datetime(revision.revised)}'
 		title = (
 			f'“{revision.current_title}”'
@@ -415,15 +532,18 @@ class Wiki(commands.Cog):
 			else f'“{revision.current_title}” (then called “{revision.title}”)')
 		return f'#{revision.revision_id}) {title} was revised by {author_at}'
 
-	@classmethod
-	def renamed_revision_summary(cls, guild, revision, *, old_title):
-		author = cls.format_member(guild, revision.author)
+	def renamed_revision_summary(self, guild, revision, *, old_title):
+		author = self.format_member(guild, revision.author)
 		author_at = f'{author} at {utils.format_datetime(revision.revised)}'
 		return f'“{old_title}” was renamed to “{revision.title}” by {author_at} with no changes'
 
-	@classmethod
-	def format_member(cls, guild, member_id):
-		return guild.get_member(member_id) or f'unknown user with ID {member_id}'
+	def format_member(self, guild, member_id):
+		# authors who haven't been looked up (see resolve_authors) or have left are shown as mentions
+		return self.bot.member_resolver.get(guild, member_id) or f'<@{member_id}>'
+
+	async def resolve_authors(self, guild, revisions):
+		"""look up the authors of revisions in as few requests as possible, for format_member"""
+		await self.bot.member_resolver.resolve(guild, [revision.author for revision in revisions])
 
 def setup(bot):
 	bot.add_cog(Wiki(bot))
@@ -15,6 +15,7 @@
 
 import datetime
 import enum
+import logging
 import operator
 import typing
 
@@ -23,48 +24,219 @@ import discord
 from bot_bin.sql import connection, optional_connection
 from discord.ext import commands
 
+from . import transclusion
+from .directory import TitleDirectory, fold
 from ..permissions.db import Permissions
-from ...utils import AttrDict, errors, round_down
+from ...utils import AttrDict, errors, hll, round_down
+from ...utils.archive import RevisionArchive
+from ...utils.cache import LRUCache
+from ...utils.replicas import optional_read_connection
+
+logger = logging.getLogger(__name__)
 
 class WikiDatabase(commands.Cog):
 	TITLE_LENGTH_LIMIT = 200
 	CONTENT_LENGTH_LIMIT = round_down(2000 - len('cm/edit "" ') - TITLE_LENGTH_LIMIT, multiple=50)
+	RENDER_CACHE_SIZE = 1000
+	# in case a title change notification is missed, e.g. while the listener connection is down
+	DIRECTORY_TTL = 5 * 60
 
 	def __init__(self, bot):
 		self.bot = bot
 		self.permissions_db = self.bot.cogs['PermissionsDatabase']
 		self.queries = self.bot.queries('wiki.sql')
+		self.directory = TitleDirectory(self._load_directory, ttl=self.DIRECTORY_TTL)
+		archive_config = self.bot.config.get('revision_archive')
+		self.archive = RevisionArchive(archive_config['path']) if archive_config else None
+		# page_id → transclusion.Rendered
+		self.render_cache = LRUCache(self.RENDER_CACHE_SIZE)
+		# bumped on every invalidation, so that renders which raced with one aren't cached
+		self.render_cache_generation = 0
+
+	def cog_unload(self):
+		if self.archive is not None:
+			self.archive.close()
+
+	@commands.Cog.listener()
+	async def on_cm_title_change(self, guild_id, op, page_id, alias, title):
+		# page titles are handled by on_cm_page_edit and on_cm_page_delete
+		if alias:
+			await self.invalidate_dependents(guild_id, [fold(title)])
+
+		directory = self.directory.cached(guild_id)
+		if directory is None:
+			return
+		if op == 'add':
+			directory.add(page_id, title, alias=alias)
+		else:
+			directory.remove(page_id, title, alias=alias)
 
-	@optional_connection
+	@commands.Cog.listener()
+	async def on_cm_page_edit(self, revision_id):
+		row = await self.bot.pool.fetchrow(self.queries.revision_page_titles(), revision_id)
+		if row is None:
+			return
+		self.render_cache.pop(row['page_id'])
+		self.render_cache_generation += 1
+		# this may have been written by another process, so make sure re-renders don't read from a lagging replica
+		self.bot.note_write(row['guild'])
+		await self.invalidate_dependents(row['guild'], row['titles'])
+
+	@commands.Cog.listener()
+	async def on_cm_page_delete(self, guild_id, page_id, title):
+		self.render_cache.pop(page_id)
+		self.render_cache_generation += 1
+		await self.invalidate_dependents(guild_id, [fold(title)])
+
+	@commands.Cog.listener()
+	async def on_cm_wiki_import(self, guild_id):
+		# imports don't send per page notifications
+		self.directory.invalidate(guild_id)
+		self.render_cache.clear()
+		self.render_cache_generation += 1
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild):
+		self.directory.invalidate(guild.id)
+
+	async def _load_directory(self, guild_id):
+		return await self.bot.pool.fetch(self.queries.get_directory(), guild_id)
+
+	async def lookup_title(self, guild_id, title):
+		"""return the directory entry for the page or alias called title, or None if there is none.
+		This doesn't touch the database unless the guild's directory hasn't been loaded yet.
+		"""
+		return (await self.directory.get(guild_id)).get(title)
+
+	def _update_directory(self, guild_id, update):
+		"""apply update to the guild's directory after a write.
+		If the write is part of a transaction which is still open, it may yet be rolled back,
+		so the directory is thrown away instead.
+		"""
+		directory = self.directory.cached(guild_id)
+		if directory is None:
+			return
+		if connection().is_in_transaction():
+			self.directory.invalidate(guild_id)
+		else:
+			update(directory)
+
+	@optional_read_connection
 	async def get_page(self, member, title, *, partial=False, check_permissions=True):
+		if await self.lookup_title(member.guild.id, title) is None:
+			raise await self.page_not_found(member, title)
 		if check_permissions: await self.check_permissions(member, Permissions.view, title)
 		query = self.queries.get_page_basic() if partial else self.queries.get_page()
 		row = await connection().fetchrow(query, member.guild.id, title)
 		if row is None:
-			raise errors.PageNotFoundError(title)
+			raise await self.page_not_found(member, title)
 
-		return AttrDict(row)
+		return row
 
-	@optional_connection
+	@optional_read_connection
+	async def get_pages(self, member, titles):
+		"""return the pages called titles, in the same order, looking them all up in one query.
+		Raise if any of them doesn't exist or member may not view it.
+		"""
+		role_ids = [role.id for role in member.roles if role != member.guild.default_role]
+		rows = await connection().fetch(
+			self.queries.get_pages(),
+			member.guild.id, list({fold(title) for title in titles}),
+			member.id, role_ids, Permissions.default.value)
+		pages = {row['requested']: row for row in rows}
+
+		results = []
+		privileged = None
+		for title in titles:
+			page = pages.get(fold(title))
+			if page is None:
+				raise await self.page_not_found(member, title)
+			if Permissions.view not in Permissions(page['permissions']):
+				if privileged is None:
+					privileged = await self.bot.is_privileged(member)
+				if not privileged:
+					raise errors.MissingPagePermissionsError(Permissions.view)
+			results.append(page)
+
+		return results
+
+	@optional_read_connection
 	async def get_page_revisions(self, member, title):
 		await self.check_permissions(member, Permissions.view, title)
 		async for row in self.cursor(self.queries.get_page_revisions(), member.guild.id, title):
-			yield row
+			yield self.unarchive(row)
 
-	@optional_connection
+	@optional_read_connection
+	async def get_page_revisions_before(self, member, title, before_revision_id, limit):
+		"""return up to limit revisions of a page older than before_revision_id, newest first"""
+		await self.check_permissions(member, Permissions.view, title)
+		rows = await connection().fetch(
+			self.queries.get_page_revisions_before(),
+			member.guild.id, title, before_revision_id, limit)
+		return list(map(self.unarchive, rows))
+
+	@optional_read_connection
+	async def get_pages_after(self, member, after_title, limit):
+		"""return up to limit pages whose titles sort after after_title"""
+		await self.check_permissions(member, Permissions.view)
+		return await connection().fetch(self.queries.get_pages_after(), member.guild.id, after_title, limit)
+
+	@optional_read_connection
+	async def get_aliases_after(self, member, after_title, limit):
+		"""return up to limit aliases whose titles sort after after_title"""
+		await self.check_permissions(member, Permissions.view)
+		return await connection().fetch(self.queries.get_aliases_after(), member.guild.id, after_title, limit)
+
+	@optional_read_connection
 	async def get_all_pages(self, member):
 		"""return an async iterator over all pages for the given guild"""
 		await self.check_permissions(member, Permissions.view)
 		async for row in self.cursor(self.queries.get_all_pages(), member.guild.id):
 			yield row
 
-	@optional_connection
+	@optional_read_connection
 	async def get_recent_revisions(self, member, cutoff: datetime.datetime):
 		"""return an async iterator over recent (after cutoff) revisions for the given guild, sorted by time"""
 		await self.check_permissions(member, Permissions.view)
 		async for row in self.cursor(self.queries.get_recent_revisions(), member.guild.id, cutoff):
 			yield row
 
+	@optional_read_connection
+	async def get_page_at(self, member, title, at: datetime.datetime, *, include_deleted=False):
+		"""return the page as it was at the given time.
+		If include_deleted, title may also be the title of a page which has since been deleted.
+		"""
+		entry = await self.lookup_title(member.guild.id, title)
+		if entry is not None:
+			await self.check_permissions(member, Permissions.view, title)
+			page_id = entry.page_id
+		elif include_deleted:
+			await self.check_deleted_permissions(member)
+			page_id = await connection().fetchval(self.queries.deleted_page_id(), member.guild.id, title, at)
+		else:
+			page_id = None
+
+		if page_id is None:
+			raise await self.page_not_found(member, title)
+
+		row = await connection().fetchrow(self.queries.get_page_at(), page_id, at)
+		if row is None:
+			raise errors.PageNotFoundError(title)
+		return self.unarchive(row)
+
+	@optional_read_connection
+	async def get_pages_at(self, member, at: datetime.datetime, *, include_deleted=False):
+		"""return every page that existed at the given time, with its title then"""
+		await self.check_permissions(member, Permissions.view)
+		if include_deleted:
+			await self.check_deleted_permissions(member)
+		return await connection().fetch(self.queries.get_pages_at(), member.guild.id, at, include_deleted)
+
+	async def check_deleted_permissions(self, member):
+		# page specific permissions are gone along with the page, so they can't say who may see it
+		if not await self.bot.is_privileged(member):
+			raise errors.MissingDeletedPagePermissionsError
+
 	@optional_connection
 	async def resolve_page(self, member, title):
 		# XXX if a user is denied permissions for a page, that applies to its aliases too.
@@ -72,19 +244,15 @@ class WikiDatabase(commands.Cog):
 		# the fact that they were denied permission to view that alias would leak information about what
 		# page it is an alias to. Consider allowing anyone to resolve an alias, or only denying those who
 		# were globally denied view permissions.
-		async with connection().transaction():
-			await self.check_permissions(member, Permissions.view, title)
-			row = await connection().fetchrow(self.queries.get_alias(), member.guild.id, title)
-			if row is not None:
-				return AttrDict(row)
-
-			row = await connection().fetchrow(self.queries.get_page_no_alias(), member.guild.id, title)
-			if row is not None:
-				return AttrDict(row)
+		entry = await self.lookup_title(member.guild.id, title)
+		if entry is None:
+			raise await self.page_not_found(member, title)
 
-			raise errors.PageNotFoundError(title)
+		await self.check_permissions(member, Permissions.view, title)
+		directory = await self.directory.get(member.guild.id)
+		return AttrDict(target=directory.target(entry), alias=entry.title if entry.alias else None)
 
-	@optional_connection
+	@optional_read_connection
 	async def search_pages(self, member, query):
 		"""return an async iterator over all pages whose title is similar to query"""
 		await self.check_permissions(member, Permissions.view)
@@ -96,14 +264,14 @@ class WikiDatabase(commands.Cog):
 		"""return an async iterator over all rows matched by query and args. Lazy equivalent to fetch()"""
 		async with connection().transaction():
 			async for row in connection().cursor(query, *args):
-				yield AttrDict(row)
+				yield row
 
-	@optional_connection
+	@optional_read_connection
 	async def get_individual_revisions(self, guild_id, revision_ids):
 		"""return a list of page revisions for the given guild.
 		the revisions are sorted by their revision ID.
 		"""
-		results = list(map(AttrDict, await connection().fetch(
+		results = list(map(self.unarchive, await connection().fetch(
 			self.queries.get_individual_revisions(),
 			guild_id, revision_ids)))
 
@@ -112,41 +280,150 @@ class WikiDatabase(commands.Cog):
 
 		return results
 
+	async def invalidate_dependents(self, guild_id, titles):
+		"""forget the renders of every page which includes any of titles, directly or indirectly,
+		and tell everyone else who shows those pages to show them again
+		"""
+		page_ids = [
+			page_id for page_id, in
+			await self.bot.pool.fetch(self.queries.page_dependents(), guild_id, titles, transclusion.MAX_DEPTH)]
+		if not page_ids:
+			return
+
+		for page_id in page_ids:
+			self.render_cache.pop(page_id)
+		self.render_cache_generation += 1
+		self.bot.dispatch('cm_page_includes_change', guild_id, page_ids)
+
+	@optional_read_connection
+	async def render(self, guild_id, page, *, member=None):
+		"""return the content of page with its {{page:Title}} includes expanded.
+		page must have the page_id, latest_revision, and content of a page.
+		If member is given, they must be allowed to view every included page.
+		"""
+		rendered = self.render_cache.get(page['page_id'])
+		if rendered is None or rendered.revision_ids[0] != page['latest_revision']:
+			generation = self.render_cache_generation
+			revision_ids = [page['latest_revision']]
+			titles = set()
+			content = await self._expand(guild_id, page['content'], [page['page_id']], revision_ids, titles)
+			rendered = transclusion.Rendered(tuple(revision_ids), transclusion.truncate(content), titles)
+			if generation == self.render_cache_generation:
+				self.render_cache[page['page_id']] = rendered
+
+		if member is not None:
+			for title in rendered.titles:
+				await self.check_permissions(member, Permissions.view, title)
+
+		return rendered.content
+
+	async def check_includes(self, member, title):
+		"""raise if member may not view every page that the page called title includes, however deeply.
+		Bound messages are re-rendered without a member, so this is what keeps an edit
+		from showing a page to everyone who can see the message.
+		"""
+		page = await connection().fetchrow(self.queries.get_page(), member.guild.id, title)
+		await self.render(member.guild.id, page, member=member)
+
+	async def _expand(self, guild_id, content, stack, revision_ids, titles):
+		"""expand the includes in content. stack is the page IDs of the pages being expanded."""
+		parts = []
+		position = 0
+		for match in transclusion.INCLUDE_PATTERN.finditer(content):
+			parts.append(content[position:match.start()])
+			position = match.end()
+			title = match[1].strip()
+			if not title:
+				parts.append(match[0])
+				continue
+
+			if len(stack) > transclusion.MAX_DEPTH:
+				parts.append(f'[“{title}” is nested too deeply to be included]')
+				continue
+
+			page = await connection().fetchrow(self.queries.get_page(), guild_id, title)
+			if page is None:
+				parts.append(f'[“{title}” not found]')
+			elif page['page_id'] in stack:
+				parts.append(f'[“{title}” includes itself]')
+			else:
+				revision_ids.append(page['latest_revision'])
+				titles.add(page['title'])
+				stack.append(page['page_id'])
+				parts.append(await self._expand(guild_id, page['content'], stack, revision_ids, titles))
+				stack.pop()
+
+		parts.append(content[position:])
+		return ''.join(parts)
+
+	def unarchive(self, revision):
+		"""fill in the content of a revision whose content was moved to the revision archive"""
+		if revision.content is None and revision.archive_segment is not None:
+			# e.g. a stateless interactions server on a host without the archive directory
+			if self.archive is None:
+				raise errors.ArchivedRevisionUnavailableError(revision.revision_id)
+			try:
+				content = self.archive.read(revision.archive_segment, revision.archive_offset, revision.archive_length)
+			except FileNotFoundError:
+				logger.error(
+					'segment %s of the revision archive is missing (needed for revision %s)',
+					revision.archive_segment, revision.revision_id)
+				raise errors.ArchivedRevisionUnavailableError(revision.revision_id)
+			# records are immutable, so only archived revisions pay for a copy
+			return AttrDict(revision.items(), content=content)
+		return revision
+
 	async def page_count(self, guild_id, *, connection=None):
-		return await (connection or self.bot.pool).fetchval(self.queries.page_count(), guild_id)
+		return await (connection or self.bot.read_pool(guild_id)).fetchval(self.queries.page_count(), guild_id)
 
 	async def revisions_count(self, guild_id, *, connection=None):
-		return await (connection or self.bot.pool).fetchval(self.queries.revisions_count(), guild_id)
+		return await (connection or self.bot.read_pool(guild_id)).fetchval(self.queries.revisions_count(), guild_id)
 
 	async def page_uses(self, guild_id, title, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		return await (connection or self.bot.pool).fetchval(self.queries.page_uses(), guild_id, title, cutoff)
+		return await (connection or self.bot.read_pool(guild_id)).fetchval(self.queries.page_uses(), guild_id, title, cutoff)
+
+	async def page_unique_viewers(self, guild_id, title, *, cutoff=None, connection=None):
+		"""return the approximate number of distinct users who viewed the page since cutoff"""
+		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
+		sketches = await (connection or self.bot.read_pool(guild_id)).fetch(
+			self.queries.page_view_sketches(),
+			guild_id, title, cutoff)
+		return hll.estimate(hll.merge(sketch for sketch, in sketches))
+
+	async def guild_unique_viewers(self, guild_id, *, cutoff=None, connection=None):
+		"""return the approximate number of distinct users who viewed any page in the guild since cutoff"""
+		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
+		sketches = await (connection or self.bot.read_pool(guild_id)).fetch(
+			self.queries.guild_view_sketches(),
+			guild_id, cutoff)
+		return hll.estimate(hll.merge(sketch for sketch, in sketches))
 
 	async def page_revisions_count(self, guild_id, title, *, connection=None):
-		return await (connection or self.bot.pool).fetchval(self.queries.page_revisions_count(), guild_id, title)
+		return await (connection or self.bot.read_pool(guild_id)).fetchval(self.queries.page_revisions_count(), guild_id, title)
 
 	async def top_page_editors(self, guild_id, title, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		editors = list(map(AttrDict, await (connection or self.bot.pool).fetch(
+		editors = await (connection or self.bot.read_pool(guild_id)).fetch(
 			self.queries.top_page_editors(),
-			guild_id, title, cutoff)))
+			guild_id, title, cutoff)
 		if not editors:
 			raise errors.PageNotFoundError(title)
 		return editors
 
 	async def total_page_uses(self, guild_id, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		return await (connection or self.bot.pool).fetchval(self.queries.total_page_uses(), guild_id, cutoff)
+		return await (connection or self.bot.read_pool(guild_id)).fetchval(self.queries.total_page_uses(), guild_id, cutoff)
 
 	async def top_pages(self, guild_id, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		return list(map(AttrDict, await (connection or self.bot.pool).fetch(self.queries.top_pages(), guild_id, cutoff)))
+		return await (connection or self.bot.read_pool(guild_id)).fetch(self.queries.top_pages(), guild_id, cutoff)
 
 	async def top_editors(self, guild_id, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		return list(map(AttrDict, await (connection or self.bot.pool).fetch(
+		return await (connection or self.bot.read_pool(guild_id)).fetch(
 			self.queries.top_editors(),
-			guild_id, cutoff)))
+			guild_id, cutoff)
 
 	@optional_connection
 	async def create_page(self, member, title, content):
@@ -155,8 +432,7 @@ class WikiDatabase(commands.Cog):
 
 		async with connection().transaction():
 			await self.check_permissions(member, Permissions.create)
-			if await connection().fetchrow(self.queries.get_alias(), member.guild.id, title):
-				raise errors.PageExistsError
+			await self.ensure_title_available(member, title)
 
 			try:
 				page_id = await connection().fetchval(self.queries.create_page(), member.guild.id, title)
@@ -164,6 +440,11 @@ class WikiDatabase(commands.Cog):
 				raise errors.PageExistsError
 
 			await connection().execute(self.queries.create_first_revision(), page_id, member.id, content, title)
+			if transclusion.INCLUDE_PATTERN.search(content):
+				await self.check_includes(member, title)
+			self.bot.note_write(member.guild.id)
+
+		self._update_directory(member.guild.id, lambda directory: directory.add(page_id, title))
 
 	@optional_connection
 	async def alias_page(self, member, alias_title, target_title):
@@ -174,6 +455,11 @@ class WikiDatabase(commands.Cog):
 			await self.check_permissions(member, Permissions.view, target_title)
 			await self.ensure_title_available(member, alias_title)
 
+			target = await self.lookup_title(member.guild.id, target_title)
+			if target is None or target.alias:
+				# aliases to aliases are not supported
+				raise errors.PageNotFoundError(target_title)
+
 			try:
 				await connection().execute(self.queries.alias_page(), member.guild.id, alias_title, target_title)
 			except asyncpg.NotNullViolationError:
@@ -181,6 +467,11 @@ class WikiDatabase(commands.Cog):
 				raise errors.PageNotFoundError(target_title)
 			except asyncpg.UniqueViolationError:
 				raise errors.PageExistsError
+			self.bot.note_write(member.guild.id)
+
+		self._update_directory(
+			member.guild.id,
+			lambda directory: directory.add(target.page_id, alias_title, alias=True))
 
 	@optional_connection
 	async def revise_page(self, member, title, new_content) -> typing.Optional[str]:
@@ -192,9 +483,12 @@ class WikiDatabase(commands.Cog):
 
 			page = await connection().fetchrow(self.queries.get_page_basic(), member.guild.id, title)
 			if page is None:
-				raise errors.PageNotFoundError(title)
+				raise await self.page_not_found(member, title)
 
 			await connection().execute(self.queries.create_revision(), page['page_id'], member.id, new_content)
+			if transclusion.INCLUDE_PATTERN.search(new_content):
+				await self.check_includes(member, title)
+			self.bot.note_write(member.guild.id)
 
 			if page['alias']:
 				return page['original']
@@ -203,6 +497,9 @@ class WikiDatabase(commands.Cog):
 	async def rename_page(self, member, title, new_title):
 		self.check_title(new_title)
 
+		if await self.lookup_title(member.guild.id, title) is None:
+			raise await self.page_not_found(member, title)
+
 		async with connection().transaction():
 			await self.ensure_title_available(member, new_title)
 
@@ -212,9 +509,12 @@ class WikiDatabase(commands.Cog):
 				raise errors.PageExistsError
 
 			if page_id is None:
-				raise errors.PageNotFoundError(title)
+				raise await self.page_not_found(member, title)
 
 			await connection().execute(self.queries.log_page_rename(), page_id, member.id, new_title)
+			self.bot.note_write(member.guild.id)
+
+		self._update_directory(member.guild.id, lambda directory: directory.rename(page_id, new_title))
 
 	@optional_connection
 	async def delete_page(self, member, title) -> bool:
@@ -224,7 +524,8 @@ class WikiDatabase(commands.Cog):
 		"""
 		async with connection().transaction():
 			# we use resolve_page here for separate permissions check depending on type
-			is_alias = (await self.resolve_page(member, title)).alias
+			is_alias = (await self.resolve_page(member, title)).alias is not None
+			entry = await self.lookup_title(member.guild.id, title)
 
 			if is_alias:
 				# why Permissions.edit and not Permissions.delete?
@@ -234,30 +535,56 @@ class WikiDatabase(commands.Cog):
 				command_tag = await connection().execute(self.queries.delete_alias(), member.guild.id, title)
 				if command_tag.split()[-1] == '0':
 					raise RuntimeError('page is supposed to be an alias but delete_alias did not delete it', title)
-				return True
-
-			await self.check_permissions(member, Permissions.delete, title)
-			command_tag = await connection().execute(self.queries.delete_page(), member.guild.id, title)
-			if command_tag.split()[-1] == '0':
-				raise RuntimeError('page is not supposed to be an alias but delete_page did not delete it', title)
+			else:
+				await self.check_permissions(member, Permissions.delete, title)
+				command_tag = await connection().execute(self.queries.delete_page(), member.guild.id, title)
+				if command_tag.split()[-1] == '0':
+					raise RuntimeError('page is not supposed to be an alias but delete_page did not delete it', title)
+			self.bot.note_write(member.guild.id)
 
-			return False
+		if entry is not None:
+			if is_alias:
+				update = lambda directory: directory.remove(entry.page_id, entry.title, alias=True)
+			else:
+				update = lambda directory: directory.remove_page(entry.page_id)
+			self._update_directory(member.guild.id, update)
 
-		raise errors.PageNotFoundError(title)
+		return is_alias
 
 	@optional_connection
 	async def check_permissions(self, member, required_permissions, title=None):
 		if title is None:
 			actual_perms = await self.permissions_db.member_permissions(member)
 		else:
-			actual_perms = await self.permissions_db.permissions_for(member, title)
+			try:
+				actual_perms = await self.permissions_db.permissions_for(member, title)
+			except errors.PageNotFoundError:
+				raise await self.page_not_found(member, title)
 		if required_permissions in actual_perms or await self.bot.is_privileged(member):
 			return True
 		raise errors.MissingPagePermissionsError(required_permissions)
 
 	@optional_connection
-	async def log_page_use(self, guild_id, title):
-		await connection().execute(self.queries.log_page_use(), guild_id, title)
+	async def page_not_found(self, member, title):
+		"""return a PageNotFoundError for title, suggesting up to three similar titles
+		if the member is allowed to list this guild's pages.
+		The titles are ranked from the directory, so permissions are only looked up if there's something to suggest.
+		"""
+		suggestions = (await self.directory.get(member.guild.id)).similar(title, 3)
+		if suggestions and (
+			Permissions.view not in await self.permissions_db.member_permissions(member)
+			and not await self.bot.is_privileged(member)
+		):
+			suggestions = []
+		return errors.PageNotFoundError(title, suggestions)
+
+	@optional_connection
+	async def log_page_use(self, guild_id, title, user_id):
+		await connection().execute(self.queries.log_page_use(), guild_id, title, *hll.register(user_id))
+
+	@optional_connection
+	async def log_page_uses(self, guild_id, page_ids, user_id):
+		await connection().execute(self.queries.log_page_uses(), guild_id, list(set(page_ids)), *hll.register(user_id))
 
 	@classmethod
 	def check_content(cls, content):
@@ -269,9 +596,14 @@ class WikiDatabase(commands.Cog):
 		if len(title) > cls.TITLE_LENGTH_LIMIT:
 			raise errors.PageTitleTooLongError(title, cls.TITLE_LENGTH_LIMIT)
 
-	@optional_connection
 	async def ensure_title_available(self, member, title):
-		if await connection().fetchrow(self.queries.get_page_basic(), member.guild.id, title):
+		"""raise PageExistsError if a page or alias called title exists. Call this in the write's transaction."""
+		# the directory may be stale (e.g. a notification hasn't arrived yet), so it can only rule titles out.
+		# pages and aliases have separate unique indexes, so the database has the final say.
+		if (
+			await self.lookup_title(member.guild.id, title) is not None
+			or await connection().fetchrow(self.queries.get_page_basic(), member.guild.id, title)
+		):
 			raise errors.PageExistsError
 
 	## Permissions
@@ -0,0 +1,167 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import re
+import time
+
+# pg_trgm's default similarity threshold, so that suggestions are about as picky as the search command
+SIMILARITY_THRESHOLD = 0.3
+WORD_PATTERN = re.compile(r'[^\W_]+')
+
+def fold(title):
+	# must match lower() in the SQL, which is what pages_uniq_idx and aliases_uniq_idx use
+	return title.lower()
+
+def trigrams(title):
+	"""return the trigrams of title the way pg_trgm computes them: per word, padded with two spaces before and one after"""
+	result = set()
+	for word in WORD_PATTERN.findall(fold(title)):
+		word = f'  {word} '
+		result.update(word[i:i+3] for i in range(len(word) - 2))
+	return result
+
+def similarity(a, b):
+	"""pg_trgm's similarity() of two sets of trigrams"""
+	if not a or not b:
+		return 0
+	common = len(a & b)
+	return common / (len(a) + len(b) - common)
+
+class DirectoryEntry:
+	__slots__ = ('page_id', 'title', 'alias')
+
+	def __init__(self, page_id, title, alias):
+		self.page_id = page_id
+		self.title = title
+		self.alias = alias
+
+class GuildDirectory:
+	"""Every page and alias title in one guild."""
+	__slots__ = ('entries', 'page_titles', 'trigram_index')
+
+	def __init__(self):
+		# fold(title) → DirectoryEntry
+		self.entries = {}
+		# page_id → title of the page (not its aliases)
+		self.page_titles = {}
+		# trigram → fold(title) of every entry with that trigram
+		self.trigram_index = {}
+
+	def get(self, title):
+		return self.entries.get(fold(title))
+
+	def similar(self, title, limit):
+		"""return up to limit titles similar to title, most similar first. This matches pg_trgm's % operator."""
+		query = trigrams(title)
+		candidates = set().union(*(self.trigram_index.get(trigram, ()) for trigram in query))
+		scored = []
+		for key in candidates:
+			score = similarity(query, trigrams(key))
+			if score >= SIMILARITY_THRESHOLD:
+				scored.append((score, self.entries[key].title))
+		return [title for score, title in heapq.nlargest(limit, scored)]
+
+	def target(self, entry):
+		"""return the title of the page that this entry is or points to"""
+		return self.page_titles[entry.page_id]
+
+	# these are all idempotent, as they are applied both by our own writes and by the notifications for them
+
+	def add(self, page_id, title, *, alias=False):
+		self.entries[fold(title)] = DirectoryEntry(page_id, title, alias)
+		for trigram in trigrams(title):
+			self.trigram_index.setdefault(trigram, set()).add(fold(title))
+		if not alias:
+			self.page_titles[page_id] = title
+
+	def remove(self, page_id, title, *, alias=False):
+		entry = self.entries.get(fold(title))
+		if entry is not None and entry.page_id == page_id and entry.alias == alias:
+			self._delete(fold(title))
+		if not alias and self.page_titles.get(page_id) == title:
+			del self.page_titles[page_id]
+
+	def rename(self, page_id, new_title):
+		self.remove(page_id, self.page_titles.get(page_id, ''))
+		self.add(page_id, new_title)
+
+	def remove_page(self, page_id):
+		"""remove a page and all of its aliases"""
+		for key, entry in list(self.entries.items()):
+			if entry.page_id == page_id:
+				self._delete(key)
+		self.page_titles.pop(page_id, None)
+
+	def _delete(self, key):
+		del self.entries[key]
+		for trigram in trigrams(key):
+			keys = self.trigram_index[trigram]
+			keys.discard(key)
+			if not keys:
+				del self.trigram_index[trigram]
+
+class TitleDirectory:
+	"""Lazily loaded GuildDirectories for every guild.
+
+	load is a coroutine function which takes a guild ID and returns an iterable of (page_id, title, alias).
+	Directories are kept up to date by notifications, but they're reloaded after ttl seconds anyway,
+	in case some notifications were missed, e.g. while the listener connection was down.
+	"""
+	def __init__(self, load, *, ttl=None):
+		self._load = load
+		self.ttl = ttl
+		self._guilds = {}
+		# guild_id → time.monotonic() when its directory was loaded
+		self._loaded_at = {}
+		self._loading = {}
+		# bumped on invalidation so that a load which raced with an invalidation is thrown away
+		self._generations = {}
+
+	def cached(self, guild_id):
+		directory = self._guilds.get(guild_id)
+		if directory is not None and self.ttl is not None and time.monotonic() - self._loaded_at[guild_id] > self.ttl:
+			self.invalidate(guild_id)
+			return None
+		return directory
+
+	def invalidate(self, guild_id):
+		self._guilds.pop(guild_id, None)
+		self._loaded_at.pop(guild_id, None)
+		self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+
+	async def get(self, guild_id) -> GuildDirectory:
+		directory = self.cached(guild_id)
+		if directory is not None:
+			return directory
+
+		try:
+			fut = self._loading[guild_id]
+		except KeyError:
+			fut = self._loading[guild_id] = asyncio.ensure_future(self._build(guild_id))
+			fut.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+		return await asyncio.shield(fut)
+
+	async def _build(self, guild_id):
+		generation = self._generations.get(guild_id, 0)
+		loaded_at = time.monotonic()
+		directory = GuildDirectory()
+		for page_id, title, alias in await self._load(guild_id):
+			directory.add(page_id, title, alias=alias)
+		if self._generations.get(guild_id, 0) == generation:
+			self._guilds[guild_id] = directory
+			self._loaded_at[guild_id] = loaded_at
+		return directory
@@ -0,0 +1,45 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""{{page:Title}} includes the content of another page when a page is shown.
+
+Which titles each page includes is kept in the page_includes table by a trigger,
+so that when a page changes, the pages which include it can be found without reading every page.
+"""
+
+import re
+
+# this pattern must match update_page_includes() in schema.sql
+INCLUDE_PATTERN = re.compile(r'\{\{page:([^{}]+)\}\}')
+# how many levels of includes are expanded
+MAX_DEPTH = 5
+# Discord's message length limit
+RENDERED_LENGTH_LIMIT = 2000
+
+class Rendered:
+	"""A page with its includes expanded"""
+	__slots__ = ('revision_ids', 'content', 'titles')
+
+	def __init__(self, revision_ids, content, titles):
+		# the revision of the page, followed by the revisions of every page it included
+		self.revision_ids = revision_ids
+		self.content = content
+		# the titles of the included pages, for permissions checks
+		self.titles = titles
+
+def truncate(content):
+	if len(content) <= RENDERED_LENGTH_LIMIT:
+		return content
+	return content[:RENDERED_LENGTH_LIMIT - 1] + '…'
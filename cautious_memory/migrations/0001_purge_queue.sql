@@ -0,0 +1,35 @@
+-- garbage collection of data from guilds the bot has left and roles which have been deleted. See cogs/gc.py.
+
+CREATE TABLE purge_queue(
+	purge_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+	guild BIGINT NOT NULL,
+	role_id BIGINT,
+	role_ids BIGINT[] NOT NULL DEFAULT '{}',
+	not_before TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'UTC')
+);
+
+CREATE UNIQUE INDEX purge_queue_guild_idx ON purge_queue (guild) WHERE role_id IS NULL;
+CREATE UNIQUE INDEX purge_queue_role_idx ON purge_queue (guild, role_id) WHERE role_id IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION tombstone_deleted_page() RETURNS TRIGGER AS $$ BEGIN
+	-- the garbage collector (see cogs/gc.py) is deleting pages for good
+	IF current_setting('cm.purging', true) = 'on' THEN
+		RETURN old;
+	END IF;
+
+	INSERT INTO deleted_pages (page_id, guild, title, created)
+	VALUES (old.page_id, old.guild, old.title, old.created)
+	ON CONFLICT (page_id) DO NOTHING;
+
+	INSERT INTO deleted_revisions (
+		revision_id, page_id, author, content, new_title, revised,
+		archive_segment, archive_offset, archive_length)
+	SELECT
+		revision_id, page_id, author, content, new_title, revised,
+		archive_segment, archive_offset, archive_length
+	FROM revisions
+	WHERE page_id = old.page_id
+	ON CONFLICT (revision_id) DO NOTHING;
+
+	RETURN old;
+END; $$ LANGUAGE plpgsql;
@@ -20,23 +20,24 @@ FROM api_tokens
 WHERE user_id = $1
 -- :endmacro
 
--- :macro existing_token()
--- params: user_id, app_id
-SELECT app_name, secret
-FROM api_tokens
-WHERE user_id = $1 AND app_id = $2
--- :endmacro
-
 -- :macro new_token()
--- params: user_id, app_name, secret
-INSERT INTO api_tokens (user_id, app_name, secret)
+-- params: user_id, app_name, secret_hash
+INSERT INTO api_tokens (user_id, app_name, secret_hash)
 VALUES ($1, $2, $3)
 RETURNING app_id
 -- :endmacro
 
--- :macro get_secret()
+-- :macro regenerate_token()
+-- params: user_id, app_id, secret_hash
+UPDATE api_tokens
+SET secret_hash = $3
+WHERE user_id = $1 AND app_id = $2
+RETURNING app_name
+-- :endmacro
+
+-- :macro get_secret_hash()
 -- params: user_id, app_id
-SELECT secret
+SELECT secret_hash
 FROM api_tokens
 WHERE user_id = $1 AND app_id = $2
 -- :endmacro
@@ -0,0 +1,40 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+-- :macro cold_revisions()
+-- params: cutoff, limit
+-- the latest revision of each page is never archived, since that's what get_page reads
+SELECT revision_id, content
+FROM revisions
+WHERE
+	revised < $1
+	AND content IS NOT NULL
+	AND NOT EXISTS (SELECT 1 FROM pages WHERE pages.latest_revision = revisions.revision_id)
+ORDER BY revision_id
+LIMIT $2
+FOR UPDATE OF revisions SKIP LOCKED
+-- :endmacro
+
+-- :macro archive_revisions()
+-- params: revision_ids, segments, offsets, lengths
+UPDATE revisions
+SET
+	content = NULL,
+	archive_segment = archived.segment,
+	archive_offset = archived."offset",
+	archive_length = archived.length
+FROM unnest($1::INTEGER[], $2::INTEGER[], $3::BIGINT[], $4::INTEGER[]) AS archived (revision_id, segment, "offset", length)
+WHERE revisions.revision_id = archived.revision_id
+-- :endmacro
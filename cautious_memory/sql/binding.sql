@@ -1,6 +1,7 @@
 -- :macro get_revision()
 -- params: revision_id
-SELECT revisions.content, pages.guild, page_id
+-- latest_revision is so that the result can be rendered like a page
+SELECT revisions.content, pages.guild, page_id, revision_id AS latest_revision
 FROM
 	revisions
 	INNER JOIN pages USING (page_id)
@@ -24,6 +25,26 @@ WHERE pages.guild = $1
 ORDER BY page_id
 -- :endmacro
 
+-- :macro guild_bound_contents()
+-- params: guild_id
+SELECT channel_id, message_id, pages.page_id, latest_revision, content
+FROM
+	bound_messages
+	INNER JOIN pages USING (page_id)
+	INNER JOIN revisions ON (pages.latest_revision = revisions.revision_id)
+WHERE pages.guild = $1
+-- :endmacro
+
+-- :macro pages_bound_contents()
+-- params: page_ids
+SELECT channel_id, message_id, pages.page_id, latest_revision, content
+FROM
+	bound_messages
+	INNER JOIN pages USING (page_id)
+	INNER JOIN revisions ON (pages.latest_revision = revisions.revision_id)
+WHERE pages.page_id = ANY ($1::INTEGER[])
+-- :endmacro
+
 -- :macro bind()
 -- params: channel_id, message_id, page_id
 INSERT INTO bound_messages (channel_id, message_id, page_id)
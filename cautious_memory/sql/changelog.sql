@@ -0,0 +1,53 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+-- :macro changelog_channels()
+SELECT guild, channel_id
+FROM changelog_channels
+-- :endmacro
+
+-- :macro set_changelog_channel()
+-- params: guild_id, channel_id
+INSERT INTO changelog_channels (guild, channel_id)
+VALUES ($1, $2)
+ON CONFLICT (guild) DO UPDATE
+SET channel_id = EXCLUDED.channel_id
+-- :endmacro
+
+-- :macro delete_changelog_channel()
+-- params: guild_id
+DELETE FROM changelog_channels
+WHERE guild = $1
+-- :endmacro
+
+-- :macro changelog_revision()
+-- params: revision_id
+-- renames are logged as revisions with a new title and no content
+SELECT
+	guild, page_id, revision_id, author, new_title, pages.title AS current_title,
+	content IS NULL AND archive_segment IS NULL AS is_rename,
+	NOT EXISTS (
+		SELECT 1
+		FROM revisions AS r
+		WHERE r.page_id = revisions.page_id AND r.revision_id < $1) AS is_create,
+	(
+		SELECT r.new_title
+		FROM revisions AS r
+		WHERE r.page_id = revisions.page_id AND r.revision_id < $1 AND r.new_title IS NOT NULL
+		ORDER BY r.revision_id DESC
+		LIMIT 1) AS old_title
+FROM revisions INNER JOIN pages USING (page_id)
+WHERE revision_id = $1
+-- :endmacro
@@ -0,0 +1,174 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+--- EXPORT
+
+-- :macro export_pages()
+-- params: guild_id
+SELECT page_id, title, latest_revision, created
+FROM pages
+WHERE guild = $1
+ORDER BY page_id
+-- :endmacro
+
+-- :macro export_aliases()
+-- params: guild_id
+SELECT title, page_id, aliased
+FROM aliases
+WHERE guild = $1
+-- :endmacro
+
+-- :macro export_revisions()
+-- params: guild_id
+SELECT revision_id, page_id, author, content, archive_segment, archive_offset, archive_length, new_title, revised
+FROM revisions INNER JOIN pages USING (page_id)
+WHERE guild = $1
+ORDER BY revision_id
+-- :endmacro
+
+-- :macro export_page_permissions()
+-- params: guild_id
+SELECT page_id, entity, allow, deny
+FROM page_permissions INNER JOIN pages USING (page_id)
+WHERE guild = $1
+-- :endmacro
+
+-- :macro export_bound_messages()
+-- params: guild_id
+SELECT message_id, channel_id, page_id
+FROM bound_messages INNER JOIN pages USING (page_id)
+WHERE guild = $1
+-- :endmacro
+
+--- IMPORT
+
+-- :macro suppress_notifications()
+-- the notify_page_* triggers check this setting; SET LOCAL lasts until the end of the transaction
+SET LOCAL cm.suppress_notify = 'on'
+-- :endmacro
+
+-- :macro create_staging_tables()
+-- no length limits here: the real tables enforce them when we merge
+CREATE TEMPORARY TABLE import_pages(
+	page_id INTEGER PRIMARY KEY,
+	title TEXT NOT NULL,
+	latest_revision INTEGER NOT NULL,
+	created TIMESTAMP WITHOUT TIME ZONE,
+	new_page_id INTEGER
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE import_aliases(
+	title TEXT NOT NULL,
+	page_id INTEGER NOT NULL,
+	aliased TIMESTAMP WITHOUT TIME ZONE
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE import_revisions(
+	revision_id INTEGER PRIMARY KEY,
+	page_id INTEGER NOT NULL,
+	author BIGINT NOT NULL,
+	content TEXT,
+	new_title TEXT,
+	revised TIMESTAMP WITHOUT TIME ZONE,
+	new_revision_id INTEGER
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE import_page_permissions(
+	page_id INTEGER NOT NULL,
+	entity BIGINT NOT NULL,
+	allow INTEGER NOT NULL,
+	deny INTEGER NOT NULL
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE import_bound_messages(
+	message_id BIGINT NOT NULL,
+	channel_id BIGINT NOT NULL,
+	page_id INTEGER NOT NULL
+) ON COMMIT DROP;
+-- :endmacro
+
+-- :macro import_conflict()
+-- params: guild_id
+-- return one title from the import which already exists as a page or alias in the guild
+SELECT title
+FROM (
+	SELECT title FROM import_pages
+	UNION ALL
+	SELECT title FROM import_aliases) AS imported
+WHERE
+	EXISTS (SELECT 1 FROM pages WHERE guild = $1 AND lower(pages.title) = lower(imported.title))
+	OR EXISTS (SELECT 1 FROM aliases WHERE guild = $1 AND lower(aliases.title) = lower(imported.title))
+LIMIT 1
+-- :endmacro
+
+-- :macro allocate_page_ids()
+UPDATE import_pages
+SET new_page_id = nextval(pg_get_serial_sequence('pages', 'page_id'))
+-- :endmacro
+
+-- :macro allocate_revision_ids()
+-- revision IDs must be allocated in their original order, since history is ordered by revision ID
+UPDATE import_revisions
+SET new_revision_id = allocated.new_revision_id
+FROM (
+	SELECT revision_id, nextval(pg_get_serial_sequence('revisions', 'revision_id')) AS new_revision_id
+	FROM (SELECT revision_id FROM import_revisions ORDER BY revision_id) AS ordered) AS allocated
+WHERE import_revisions.revision_id = allocated.revision_id
+-- :endmacro
+
+-- :macro merge_pages()
+-- params: guild_id
+-- latest_revision is DEFERRABLE INITIALLY DEFERRED, so it may point to revisions we haven't inserted yet
+INSERT INTO pages (page_id, title, latest_revision, guild, created)
+SELECT p.new_page_id, p.title, r.new_revision_id, $1, p.created
+FROM import_pages AS p INNER JOIN import_revisions AS r ON (p.latest_revision = r.revision_id)
+-- :endmacro
+
+-- :macro merge_revisions()
+INSERT INTO revisions (revision_id, page_id, author, content, new_title, revised)
+SELECT r.new_revision_id, p.new_page_id, r.author, r.content, r.new_title, r.revised
+FROM import_revisions AS r INNER JOIN import_pages AS p USING (page_id)
+ORDER BY r.revision_id
+-- :endmacro
+
+-- :macro merge_aliases()
+-- params: guild_id
+INSERT INTO aliases (title, page_id, guild, aliased)
+SELECT a.title, p.new_page_id, $1, a.aliased
+FROM import_aliases AS a INNER JOIN import_pages AS p USING (page_id)
+-- :endmacro
+
+-- :macro merge_page_permissions()
+-- params: guild_id, source_guild_id
+-- overwrites for @everyone are keyed by the guild ID, so they have to follow the wiki to its new guild
+INSERT INTO page_permissions (page_id, entity, allow, deny)
+SELECT p.new_page_id, CASE WHEN pp.entity = $2 THEN $1 ELSE pp.entity END, pp.allow, pp.deny
+FROM import_page_permissions AS pp INNER JOIN import_pages AS p USING (page_id)
+-- :endmacro
+
+-- :macro merge_bound_messages()
+-- params: guild_id, source_guild_id
+-- bound messages only make sense in the guild they were sent in, so we only restore them in that guild
+INSERT INTO bound_messages (message_id, channel_id, page_id)
+SELECT b.message_id, b.channel_id, p.new_page_id
+FROM import_bound_messages AS b INNER JOIN import_pages AS p USING (page_id)
+WHERE $1::BIGINT = $2::BIGINT
+ON CONFLICT (message_id) DO NOTHING
+-- :endmacro
+
+-- :macro notify_import()
+-- params: guild_id
+SELECT pg_notify('wiki_import', $1::BIGINT::text)
+-- :endmacro
@@ -0,0 +1,154 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+-- :macro queue_guild_purge()
+-- params: guild_id, role_ids, not_before
+INSERT INTO purge_queue (guild, role_ids, not_before)
+VALUES ($1, $2, $3)
+ON CONFLICT (guild) WHERE role_id IS NULL DO NOTHING
+-- :endmacro
+
+-- :macro queue_role_purge()
+-- params: guild_id, role_id
+INSERT INTO purge_queue (guild, role_id)
+VALUES ($1, $2)
+ON CONFLICT (guild, role_id) WHERE role_id IS NOT NULL DO NOTHING
+-- :endmacro
+
+-- :macro cancel_guild_purge()
+-- params: guild_id
+DELETE FROM purge_queue
+WHERE guild = $1 AND role_id IS NULL
+-- :endmacro
+
+-- :macro due_purges()
+SELECT purge_id, guild, role_id, role_ids
+FROM purge_queue
+WHERE not_before <= (now() AT TIME ZONE 'UTC')
+ORDER BY purge_id
+-- :endmacro
+
+-- :macro finish_purge()
+-- params: purge_id
+DELETE FROM purge_queue
+WHERE purge_id = $1
+-- :endmacro
+
+-- :macro purge_guild_page_rows(table)
+-- params: guild_id, limit
+-- for tables with a page_id column which has any number of rows per page.
+-- These would otherwise go by cascade with their pages, all in one transaction.
+DELETE FROM {{ table }}
+WHERE ctid IN (
+	SELECT t.ctid
+	FROM {{ table }} AS t INNER JOIN pages USING (page_id)
+	WHERE pages.guild = $1
+	LIMIT $2)
+-- :endmacro
+
+-- :macro purge_guild_revisions()
+-- params: guild_id, limit
+-- every revision but the latest of each page, which pages.latest_revision refers to, and which goes with its page
+DELETE FROM revisions
+WHERE revision_id IN (
+	SELECT revision_id
+	FROM revisions INNER JOIN pages USING (page_id)
+	WHERE pages.guild = $1 AND revision_id != pages.latest_revision
+	LIMIT $2)
+-- :endmacro
+
+-- :macro purge_guild_deleted_revisions()
+-- params: guild_id, limit
+-- these would otherwise go by cascade with their deleted_pages
+DELETE FROM deleted_revisions
+WHERE revision_id IN (
+	SELECT revision_id
+	FROM deleted_revisions INNER JOIN deleted_pages USING (page_id)
+	WHERE deleted_pages.guild = $1
+	LIMIT $2)
+-- :endmacro
+
+-- :macro purge_guild_pages()
+-- params: guild_id, limit
+-- by now each page has a bounded number of rows referring to it (see PAGE_TABLES in cogs/gc.py),
+-- which go with it by cascade. page_subscribers and bound_messages don't reference pages,
+-- so they're deleted along with each batch.
+WITH
+	batch AS (
+		SELECT page_id
+		FROM pages
+		WHERE guild = $1
+		LIMIT $2),
+	subscribers AS (
+		DELETE FROM page_subscribers
+		WHERE page_id IN (SELECT page_id FROM batch)),
+	bindings AS (
+		DELETE FROM bound_messages
+		WHERE page_id IN (SELECT page_id FROM batch))
+DELETE FROM pages
+WHERE page_id IN (SELECT page_id FROM batch)
+-- :endmacro
+
+-- :macro purge_guild_rows(table)
+-- params: guild_id, limit
+-- for tables with a guild column
+DELETE FROM {{ table }}
+WHERE ctid IN (
+	SELECT ctid
+	FROM {{ table }}
+	WHERE guild = $1
+	LIMIT $2)
+-- :endmacro
+
+-- :macro purge_role_permissions()
+-- params: role_ids
+DELETE FROM role_permissions
+WHERE entity = ANY ($1::BIGINT[])
+-- :endmacro
+
+-- :macro purge_role_overwrites()
+-- params: guild_id, role_id, limit
+DELETE FROM page_permissions
+WHERE ctid IN (
+	SELECT pp.ctid
+	FROM page_permissions AS pp INNER JOIN pages USING (page_id)
+	WHERE pages.guild = $1 AND pp.entity = $2
+	LIMIT $3)
+-- :endmacro
+
+-- :macro unknown_guilds()
+-- params: guild_ids
+-- guilds with data which we're not in
+SELECT guild
+FROM pages
+WHERE NOT guild = ANY ($1::BIGINT[])
+UNION
+SELECT guild
+FROM deleted_pages
+WHERE NOT guild = ANY ($1::BIGINT[])
+-- :endmacro
+
+-- :macro deleted_roles()
+-- params: guild_id, role_ids
+-- roles with page overwrites in the guild which no longer exist.
+-- Page overwrites may be for members too, who may come back, so only roles with role_permissions are considered,
+-- since only roles have those.
+SELECT DISTINCT entity
+FROM
+	page_permissions
+	INNER JOIN pages USING (page_id)
+	INNER JOIN role_permissions USING (entity)
+WHERE pages.guild = $1 AND NOT entity = ANY ($2::BIGINT[])
+-- :endmacro
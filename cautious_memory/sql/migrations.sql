@@ -0,0 +1,38 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+-- :macro create_schema_version()
+-- for databases from before migrations. Must match schema.sql.
+CREATE TABLE IF NOT EXISTS schema_version(
+	version INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	applied TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+-- :endmacro
+
+-- :macro schema_version_exists()
+SELECT to_regclass('schema_version')
+-- :endmacro
+
+-- :macro applied_versions()
+SELECT version
+FROM schema_version
+-- :endmacro
+
+-- :macro record_migration()
+-- params: version, name
+INSERT INTO schema_version (version, name)
+VALUES ($1, $2)
+-- :endmacro
@@ -0,0 +1,56 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+-- :macro table_sizes()
+-- estimated, which is plenty for telling big tables from small ones
+SELECT relname, reltuples::BIGINT
+FROM pg_class
+WHERE relkind = 'r' AND relnamespace = 'public'::REGNAMESPACE
+-- :endmacro
+
+-- :macro seed()
+-- synthetic data for utils/plan_audit.py: 100 guilds of 200 pages with 10 revisions each.
+-- Negative IDs keep it apart from any real data. Run it in a transaction which is rolled back afterwards.
+SET LOCAL cm.suppress_notify = 'on';
+
+INSERT INTO pages (page_id, title, latest_revision, guild)
+SELECT -p, 'seed page ' || p, -(p * 10 + 9), -(p % 100) - 1
+FROM generate_series(1, 20000) AS p;
+
+INSERT INTO revisions (revision_id, page_id, author, content, new_title, revised)
+SELECT
+	-(p * 10 + r), -p, r, repeat('seed ', 50),
+	CASE WHEN r = 0 THEN 'seed page ' || p END,
+	CURRENT_TIMESTAMP - (10 - r) * INTERVAL '1 day' - p * INTERVAL '1 second'
+FROM generate_series(1, 20000) AS p, generate_series(0, 9) AS r;
+
+INSERT INTO aliases (title, page_id, guild)
+SELECT 'seed alias ' || p, -p, -(p % 100) - 1
+FROM generate_series(1, 20000, 4) AS p;
+
+INSERT INTO page_usage_history (page_id, time)
+SELECT -(n % 20000) - 1, (now() AT TIME ZONE 'UTC') - n * INTERVAL '10 seconds'
+FROM generate_series(1, 200000) AS n;
+
+INSERT INTO page_subscribers (page_id, user_id)
+SELECT -(n % 20000) - 1, n
+FROM generate_series(1, 20000) AS n;
+
+INSERT INTO bound_messages (message_id, channel_id, page_id)
+SELECT -n, -(n % 100) - 1, -(n % 20000) - 1
+FROM generate_series(1, 20000) AS n;
+
+ANALYZE;
+-- :endmacro
@@ -31,7 +31,8 @@ CREATE TABLE pages(
 	created TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE UNIQUE INDEX pages_uniq_idx ON pages (lower(title), guild);
+-- guild first, so that this also serves queries for all of a guild's pages
+CREATE UNIQUE INDEX pages_uniq_idx ON pages (guild, lower(title));
 CREATE INDEX pages_name_trgm_idx ON pages USING GIN (title gin_trgm_ops);
 
 CREATE TABLE revisions(
@@ -46,9 +47,19 @@ CREATE TABLE revisions(
 	-- Doing so will require migrating a few existing pages
 	content VARCHAR(2000),
 	new_title VARCHAR(:title_length_limit),
-	revised TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+	revised TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	-- once a revision's content has been moved to the revision archive (see utils/archive.py),
+	-- content is NULL and these say where to find it
+	archive_segment INTEGER,
+	archive_offset BIGINT,
+	archive_length INTEGER
 );
 
+-- also finds the latest revision of a page at or before a given time in one probe, for "as of" queries
+CREATE INDEX revisions_page_id_revised_idx ON revisions (page_id, revised DESC);
+-- for recent revisions
+CREATE INDEX revisions_revised_idx ON revisions (revised);
+
 ALTER TABLE pages ADD CONSTRAINT "pages_latest_revision_fkey" FOREIGN KEY (latest_revision) REFERENCES revisions DEFERRABLE INITIALLY DEFERRED;
 
 CREATE TABLE aliases(
@@ -59,15 +70,256 @@ CREATE TABLE aliases(
 	aliased TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE UNIQUE INDEX aliases_uniq_idx ON aliases (lower(title), guild);
+CREATE UNIQUE INDEX aliases_uniq_idx ON aliases (guild, lower(title));
 CREATE INDEX aliases_name_trgm_idx ON aliases USING GIN (title gin_trgm_ops);
 
+-- tombstones of deleted pages, so that "as of" queries can show pages that have since been deleted.
+-- written by the tombstone_deleted_page trigger
+CREATE TABLE deleted_pages(
+	page_id INTEGER PRIMARY KEY,
+	guild BIGINT NOT NULL,
+	-- the title when it was deleted
+	title VARCHAR(:title_length_limit) NOT NULL,
+	created TIMESTAMP WITHOUT TIME ZONE,
+	deleted TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX deleted_pages_title_idx ON deleted_pages (guild, lower(title));
+
+-- the revisions of deleted pages. The columns must be in the same order as revisions for revision_history.
+CREATE TABLE deleted_revisions(
+	revision_id INTEGER PRIMARY KEY,
+	page_id INTEGER NOT NULL REFERENCES deleted_pages ON DELETE CASCADE,
+	author BIGINT NOT NULL,
+	content VARCHAR(2000),
+	new_title VARCHAR(:title_length_limit),
+	revised TIMESTAMP WITHOUT TIME ZONE,
+	archive_segment INTEGER,
+	archive_offset BIGINT,
+	archive_length INTEGER
+);
+
+CREATE INDEX deleted_revisions_page_id_revised_idx ON deleted_revisions (page_id, revised DESC);
+
+-- every revision, whether or not its page still exists
+CREATE VIEW revision_history AS
+	SELECT * FROM revisions
+	UNION ALL
+	SELECT * FROM deleted_revisions;
+
+CREATE FUNCTION tombstone_deleted_page() RETURNS TRIGGER AS $$ BEGIN
+	-- the garbage collector (see cogs/gc.py) is deleting pages for good
+	IF current_setting('cm.purging', true) = 'on' THEN
+		RETURN old;
+	END IF;
+
+	INSERT INTO deleted_pages (page_id, guild, title, created)
+	VALUES (old.page_id, old.guild, old.title, old.created)
+	ON CONFLICT (page_id) DO NOTHING;
+
+	INSERT INTO deleted_revisions (
+		revision_id, page_id, author, content, new_title, revised,
+		archive_segment, archive_offset, archive_length)
+	SELECT
+		revision_id, page_id, author, content, new_title, revised,
+		archive_segment, archive_offset, archive_length
+	FROM revisions
+	WHERE page_id = old.page_id
+	ON CONFLICT (revision_id) DO NOTHING;
+
+	RETURN old;
+END; $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tombstone_deleted_page
+BEFORE DELETE ON pages
+FOR EACH ROW
+EXECUTE PROCEDURE tombstone_deleted_page();
+
 CREATE TABLE page_usage_history(
 	page_id INTEGER NOT NULL REFERENCES pages ON DELETE CASCADE,
 	time TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'UTC')
 );
 
-CREATE INDEX page_usage_history_idx ON page_usage_history (page_id);
+-- page uses since a cutoff are one range scan per page
+CREATE INDEX page_usage_history_idx ON page_usage_history (page_id, time);
+-- for expiring old page uses
+CREATE INDEX page_usage_history_time_idx ON page_usage_history (time);
+
+-- HyperLogLog sketches of who viewed each page (and any page in each guild) each day,
+-- for estimating unique viewers over any number of days. See utils/hll.py for the format.
+CREATE TABLE page_view_sketches(
+	page_id INTEGER NOT NULL REFERENCES pages ON DELETE CASCADE,
+	day DATE NOT NULL,
+	sketch BYTEA NOT NULL,
+	PRIMARY KEY (page_id, day)
+);
+
+CREATE TABLE guild_view_sketches(
+	guild BIGINT NOT NULL,
+	day DATE NOT NULL,
+	sketch BYTEA NOT NULL,
+	PRIMARY KEY (guild, day)
+);
+
+--- REVISION COUNTS
+
+-- these are kept up to date by triggers on revisions so that stats don't have to count every revision.
+-- counts by day are summed over the days of a period to get leaderboards.
+
+CREATE TABLE page_revision_counts(
+	page_id INTEGER PRIMARY KEY REFERENCES pages ON DELETE CASCADE,
+	count INTEGER NOT NULL
+);
+
+CREATE TABLE page_author_revision_counts(
+	page_id INTEGER NOT NULL REFERENCES pages ON DELETE CASCADE,
+	author BIGINT NOT NULL,
+	day DATE NOT NULL,
+	count INTEGER NOT NULL,
+	PRIMARY KEY (page_id, day, author)
+);
+
+CREATE TABLE guild_revision_counts(
+	guild BIGINT PRIMARY KEY,
+	count INTEGER NOT NULL
+);
+
+CREATE TABLE guild_author_revision_counts(
+	guild BIGINT NOT NULL,
+	author BIGINT NOT NULL,
+	day DATE NOT NULL,
+	count INTEGER NOT NULL,
+	PRIMARY KEY (guild, day, author)
+);
+
+-- statement level, so that bulk inserts (e.g. imports) do one upsert per counter rather than per revision
+CREATE FUNCTION count_inserted_revisions() RETURNS TRIGGER AS $$ BEGIN
+	INSERT INTO page_revision_counts AS c (page_id, count)
+	SELECT page_id, count(*)
+	FROM new_revisions
+	GROUP BY page_id
+	ON CONFLICT (page_id) DO UPDATE SET count = c.count + excluded.count;
+
+	INSERT INTO page_author_revision_counts AS c (page_id, author, day, count)
+	SELECT page_id, author, revised::DATE, count(*)
+	FROM new_revisions
+	GROUP BY page_id, author, revised::DATE
+	ON CONFLICT (page_id, day, author) DO UPDATE SET count = c.count + excluded.count;
+
+	INSERT INTO guild_revision_counts AS c (guild, count)
+	SELECT guild, count(*)
+	FROM new_revisions INNER JOIN pages USING (page_id)
+	GROUP BY guild
+	ON CONFLICT (guild) DO UPDATE SET count = c.count + excluded.count;
+
+	INSERT INTO guild_author_revision_counts AS c (guild, author, day, count)
+	SELECT guild, author, revised::DATE, count(*)
+	FROM new_revisions INNER JOIN pages USING (page_id)
+	GROUP BY guild, author, revised::DATE
+	ON CONFLICT (guild, day, author) DO UPDATE SET count = c.count + excluded.count;
+
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE FUNCTION count_deleted_revisions() RETURNS TRIGGER AS $$ BEGIN
+	UPDATE page_revision_counts AS c
+	SET count = c.count - d.count
+	FROM (SELECT page_id, count(*) FROM old_revisions GROUP BY page_id) AS d
+	WHERE c.page_id = d.page_id;
+
+	UPDATE page_author_revision_counts AS c
+	SET count = c.count - d.count
+	FROM (
+		SELECT page_id, author, revised::DATE AS day, count(*)
+		FROM old_revisions
+		GROUP BY page_id, author, revised::DATE
+	) AS d
+	WHERE (c.page_id, c.day, c.author) = (d.page_id, d.day, d.author);
+
+	-- when a whole page is deleted, its page no longer exists by now, so these don't match its revisions.
+	-- uncount_deleted_page() has taken care of them instead.
+	UPDATE guild_revision_counts AS c
+	SET count = c.count - d.count
+	FROM (SELECT guild, count(*) FROM old_revisions INNER JOIN pages USING (page_id) GROUP BY guild) AS d
+	WHERE c.guild = d.guild;
+
+	UPDATE guild_author_revision_counts AS c
+	SET count = c.count - d.count
+	FROM (
+		SELECT guild, author, revised::DATE AS day, count(*)
+		FROM old_revisions INNER JOIN pages USING (page_id)
+		GROUP BY guild, author, revised::DATE
+	) AS d
+	WHERE (c.guild, c.day, c.author) = (d.guild, d.day, d.author);
+
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE FUNCTION uncount_deleted_page() RETURNS TRIGGER AS $$ BEGIN
+	UPDATE guild_revision_counts
+	SET count = count - coalesce((SELECT count FROM page_revision_counts WHERE page_id = old.page_id), 0)
+	WHERE guild = old.guild;
+
+	UPDATE guild_author_revision_counts AS c
+	SET count = c.count - p.count
+	FROM page_author_revision_counts AS p
+	WHERE p.page_id = old.page_id AND (c.guild, c.day, c.author) = (old.guild, p.day, p.author);
+
+	RETURN old;
+END; $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER count_inserted_revisions
+AFTER INSERT ON revisions
+REFERENCING NEW TABLE AS new_revisions
+FOR EACH STATEMENT
+EXECUTE PROCEDURE count_inserted_revisions();
+
+CREATE TRIGGER count_deleted_revisions
+AFTER DELETE ON revisions
+REFERENCING OLD TABLE AS old_revisions
+FOR EACH STATEMENT
+EXECUTE PROCEDURE count_deleted_revisions();
+
+-- before the page's revisions are deleted by the cascade, while we can still tell which guild they were in
+CREATE TRIGGER uncount_deleted_page
+BEFORE DELETE ON pages
+FOR EACH ROW
+EXECUTE PROCEDURE uncount_deleted_page();
+
+--- TRANSCLUSION
+
+-- the titles of the pages that each page's latest revision includes (see cogs/wiki/transclusion.py)
+CREATE TABLE page_includes(
+	page_id INTEGER NOT NULL REFERENCES pages ON DELETE CASCADE,
+	guild BIGINT NOT NULL,
+	-- lowercase. Not a reference to pages, since the included page may not exist yet, or may be renamed.
+	title TEXT NOT NULL,
+	PRIMARY KEY (page_id, title)
+);
+
+CREATE INDEX page_includes_title_idx ON page_includes (guild, title);
+
+-- this pattern must match INCLUDE_PATTERN in cogs/wiki/transclusion.py
+CREATE FUNCTION update_page_includes() RETURNS TRIGGER AS $$ BEGIN
+	DELETE FROM page_includes WHERE page_id = new.page_id;
+
+	INSERT INTO page_includes (page_id, guild, title)
+	SELECT DISTINCT pages.page_id, pages.guild, lower(btrim(include[1]))
+	FROM
+		pages
+		INNER JOIN revisions ON (pages.latest_revision = revisions.revision_id),
+		regexp_matches(revisions.content, '\{\{page:([^{}]+)\}\}', 'g') AS include
+	WHERE pages.page_id = new.page_id AND btrim(include[1]) != '';
+
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+-- deferred so that it sees latest_revision after imports, which insert pages before their revisions
+CREATE CONSTRAINT TRIGGER update_page_includes
+AFTER INSERT OR UPDATE OF latest_revision ON pages
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW
+EXECUTE PROCEDURE update_page_includes();
 
 --- WATCH LISTS / MESSAGE BINDING
 
@@ -80,6 +332,36 @@ CREATE TABLE page_subscribers(
 
 CREATE INDEX page_subscribers_user_id_idx ON page_subscribers (user_id);
 
+-- watches on every page whose title matches a glob pattern, including pages created later
+CREATE TABLE pattern_subscribers(
+	guild BIGINT NOT NULL,
+	user_id BIGINT NOT NULL,
+	-- stored lowercase, since patterns are case insensitive
+	pattern VARCHAR(:title_length_limit) NOT NULL,
+	PRIMARY KEY (guild, user_id, pattern)
+);
+
+CREATE TABLE watch_preferences(
+	user_id BIGINT PRIMARY KEY,
+	-- users without a row get immediate delivery
+	delivery TEXT NOT NULL CHECK (delivery IN ('hourly', 'daily'))
+);
+
+-- notifications waiting to be sent in a digest. One row per user per page, no matter how many edits.
+CREATE TABLE pending_notifications(
+	user_id BIGINT NOT NULL,
+	guild BIGINT NOT NULL,
+	-- not a foreign key, so that deletions can be queued
+	page_id INTEGER NOT NULL,
+	-- the diff sent is from old_revision_id to new_revision_id
+	old_revision_id INTEGER,
+	new_revision_id INTEGER,
+	edit_count INTEGER NOT NULL DEFAULT 1,
+	-- set if the page has been deleted since
+	deleted_title VARCHAR(:title_length_limit),
+	PRIMARY KEY (user_id, page_id)
+);
+
 CREATE TABLE bound_messages(
 	message_id BIGINT PRIMARY KEY,
 	channel_id BIGINT NOT NULL,
@@ -89,7 +371,17 @@ CREATE TABLE bound_messages(
 
 CREATE INDEX bound_messages_page_id_idx ON bound_messages (page_id);
 
+-- where to post digests of each guild's wiki changes
+CREATE TABLE changelog_channels(
+	guild BIGINT PRIMARY KEY,
+	channel_id BIGINT NOT NULL
+);
+
+-- bulk operations (e.g. importing a wiki) SET LOCAL cm.suppress_notify = 'on' and notify once at the end instead
 CREATE FUNCTION notify_page_edit() RETURNS TRIGGER AS $$ BEGIN
+	IF current_setting('cm.suppress_notify', true) = 'on' THEN
+		RETURN new;
+	END IF;
 	PERFORM * FROM pg_notify('page_edit', new.revision_id::text);
 	RETURN new;
 END; $$ LANGUAGE plpgsql;
@@ -100,6 +392,9 @@ FOR EACH ROW
 EXECUTE PROCEDURE notify_page_edit();
 
 CREATE FUNCTION notify_page_delete() RETURNS TRIGGER AS $$ BEGIN
+	IF current_setting('cm.suppress_notify', true) = 'on' THEN
+		RETURN NULL;
+	END IF;
 	PERFORM * FROM pg_notify('page_delete', old.guild::text || ',' || old.page_id::text || ',' || old.title);
 	RETURN NULL;
 END; $$ LANGUAGE plpgsql;
@@ -109,6 +404,33 @@ AFTER DELETE ON pages
 FOR EACH ROW
 EXECUTE PROCEDURE notify_page_delete();
 
+-- keeps the in-memory title directory of every bot process up to date
+-- payload: guild_id,add|remove,page_id,is_alias,title
+CREATE FUNCTION notify_title_change() RETURNS TRIGGER AS $$ BEGIN
+	IF current_setting('cm.suppress_notify', true) = 'on' THEN
+		RETURN NULL;
+	END IF;
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM * FROM pg_notify('title_change', concat_ws(',',
+			old.guild, 'remove', old.page_id, TG_TABLE_NAME = 'aliases', old.title));
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM * FROM pg_notify('title_change', concat_ws(',',
+			new.guild, 'add', new.page_id, TG_TABLE_NAME = 'aliases', new.title));
+	END IF;
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_page_title_change
+AFTER INSERT OR DELETE OR UPDATE OF title ON pages
+FOR EACH ROW
+EXECUTE PROCEDURE notify_title_change();
+
+CREATE TRIGGER notify_alias_title_change
+AFTER INSERT OR DELETE ON aliases
+FOR EACH ROW
+EXECUTE PROCEDURE notify_title_change();
+
 --- PERMISSIONS
 
 CREATE TABLE role_permissions(
@@ -137,7 +459,46 @@ CREATE TABLE api_tokens(
 	user_id BIGINT NOT NULL,
 	app_id BIGINT GENERATED BY DEFAULT AS IDENTITY,
 	app_name VARCHAR(200),
-	secret BYTEA NOT NULL,
+	-- HMAC-SHA256 of the secret, keyed with api.secret_key from the config
+	secret_hash BYTEA NOT NULL,
 
 	PRIMARY KEY (user_id, app_id)
 );
+
+-- keeps the verified token cache of every bot process up to date
+-- payload: user_id,app_id
+CREATE FUNCTION notify_api_token_change() RETURNS TRIGGER AS $$ BEGIN
+	PERFORM * FROM pg_notify('api_token_change', concat_ws(',', old.user_id, old.app_id));
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_api_token_change
+AFTER DELETE OR UPDATE ON api_tokens
+FOR EACH ROW
+EXECUTE PROCEDURE notify_api_token_change();
+
+--- GARBAGE COLLECTION
+
+-- data waiting to be deleted in batches by cogs/gc.py
+CREATE TABLE purge_queue(
+	purge_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+	guild BIGINT NOT NULL,
+	-- null to purge all of the guild's data, otherwise just the page overwrites of this deleted role
+	role_id BIGINT,
+	-- when purging a guild, its roles, whose role_permissions are deleted too
+	role_ids BIGINT[] NOT NULL DEFAULT '{}',
+	not_before TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'UTC')
+);
+
+CREATE UNIQUE INDEX purge_queue_guild_idx ON purge_queue (guild) WHERE role_id IS NULL;
+CREATE UNIQUE INDEX purge_queue_role_idx ON purge_queue (guild, role_id) WHERE role_id IS NOT NULL;
+
+--- MIGRATIONS
+
+-- which migrations in cautious_memory/migrations have been applied. See utils/migrations.py.
+-- a database created from this file is up to date, so run python -m cautious_memory migrate --baseline after.
+CREATE TABLE schema_version(
+	version INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	applied TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -38,11 +38,118 @@ WHERE user_id = $2
 ORDER BY lower(title)
 -- :endmacro
 
+-- :macro watch_pattern()
+-- params: guild_id, user_id, pattern
+INSERT INTO pattern_subscribers (guild, user_id, pattern)
+VALUES ($1, $2, lower($3))
+ON CONFLICT DO NOTHING
+-- :endmacro
+
+-- :macro unwatch_pattern()
+-- params: guild_id, user_id, pattern
+DELETE FROM pattern_subscribers
+WHERE (guild, user_id, pattern) = ($1, $2, lower($3))
+-- :endmacro
+
+-- :macro pattern_count()
+-- params: guild_id, user_id
+SELECT count(*)
+FROM pattern_subscribers
+WHERE (guild, user_id) = ($1, $2)
+-- :endmacro
+
+-- :macro pattern_watch_list()
+-- params: guild_id, user_id
+SELECT pattern
+FROM pattern_subscribers
+WHERE (guild, user_id) = ($1, $2)
+ORDER BY pattern
+-- :endmacro
+
+-- :macro guild_patterns()
+-- params: guild_id
+SELECT user_id, pattern
+FROM pattern_subscribers
+WHERE guild = $1
+-- :endmacro
+
 -- :macro page_subscribers()
--- params: page_id
-SELECT user_id
-FROM page_subscribers
-WHERE page_id = $1
+-- params: page_id, pattern_user_ids
+-- pattern_user_ids are the users whose pattern watches match the page
+SELECT user_id, coalesce(delivery, 'immediate') AS delivery
+FROM
+	(
+		SELECT user_id
+		FROM page_subscribers
+		WHERE page_id = $1
+		UNION
+		SELECT unnest($2::BIGINT[])) AS subscribers
+	LEFT JOIN watch_preferences USING (user_id)
+-- :endmacro
+
+-- :macro get_delivery()
+-- params: user_id
+SELECT delivery
+FROM watch_preferences
+WHERE user_id = $1
+-- :endmacro
+
+-- :macro set_delivery()
+-- params: user_id, delivery
+INSERT INTO watch_preferences (user_id, delivery)
+VALUES ($1, $2)
+ON CONFLICT (user_id) DO UPDATE
+SET delivery = EXCLUDED.delivery
+-- :endmacro
+
+-- :macro delete_delivery()
+-- params: user_id
+DELETE FROM watch_preferences
+WHERE user_id = $1
+-- :endmacro
+
+-- :macro queue_page_edit_notifications()
+-- params: guild_id, page_id, old_revision_id, new_revision_id, user_ids
+-- further edits before the digest is sent extend the pending diff rather than adding to it
+INSERT INTO pending_notifications (user_id, guild, page_id, old_revision_id, new_revision_id)
+SELECT user_id, $1, $2, $3, $4
+FROM unnest($5::BIGINT[]) AS user_id
+ON CONFLICT (user_id, page_id) DO UPDATE
+SET
+	new_revision_id = EXCLUDED.new_revision_id,
+	edit_count = pending_notifications.edit_count + 1
+-- :endmacro
+
+-- :macro queue_page_delete_notifications()
+-- params: guild_id, page_id, title, user_ids
+INSERT INTO pending_notifications (user_id, guild, page_id, deleted_title)
+SELECT user_id, $1, $2, $3
+FROM unnest($4::BIGINT[]) AS user_id
+ON CONFLICT (user_id, page_id) DO UPDATE
+SET deleted_title = EXCLUDED.deleted_title
+-- :endmacro
+
+-- :macro pending_notifications()
+-- params: deliveries
+-- users without preferences get immediate delivery
+SELECT *
+FROM pending_notifications AS pn
+WHERE coalesce((SELECT delivery FROM watch_preferences AS wp WHERE wp.user_id = pn.user_id), 'immediate')
+	= ANY ($1::TEXT[])
+ORDER BY user_id, guild, page_id
+-- :endmacro
+
+-- :macro delete_sent_notifications()
+-- params: user_ids, page_ids, edit_counts, deleted_titles
+-- a notification which was extended (by another edit or a deletion) since it was read is kept for the next digest
+DELETE FROM pending_notifications AS pn
+USING unnest($1::BIGINT[], $2::INTEGER[], $3::INTEGER[], $4::TEXT[])
+	AS sent (user_id, page_id, edit_count, deleted_title)
+WHERE
+	pn.user_id = sent.user_id
+	AND pn.page_id = sent.page_id
+	AND pn.edit_count = sent.edit_count
+	AND pn.deleted_title IS NOT DISTINCT FROM sent.deleted_title
 -- :endmacro
 
 -- :macro delete_page_subscribers()
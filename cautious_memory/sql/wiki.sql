@@ -1,7 +1,7 @@
 -- :macro get_page()
 -- params: guild_id, title
 SELECT
-	pages.page_id, created, content, pages.title,
+	pages.page_id, created, content, pages.title, latest_revision,
 	-- tfw condition repeated three times
 	CASE WHEN aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) THEN aliases.title ELSE NULL END AS alias,
 	aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) AS is_alias
@@ -19,7 +19,7 @@ WHERE
 -- params: guild_id, title
 -- for when you don't need the revisions but still need to resolve aliases
 SELECT
-	pages.page_id, created, pages.title AS original,
+	pages.page_id, created, pages.title AS original, latest_revision,
 	CASE WHEN aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) THEN aliases.title ELSE NULL END AS alias
 FROM
 	aliases
@@ -30,6 +30,39 @@ WHERE
 	(lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
 -- :endmacro
 
+-- :macro get_directory()
+-- params: guild_id
+SELECT page_id, title, FALSE AS alias
+FROM pages
+WHERE guild = $1
+UNION ALL
+SELECT page_id, title, TRUE AS alias
+FROM aliases
+WHERE guild = $1
+-- :endmacro
+
+-- :macro get_pages()
+-- params: guild_id, folded_titles, member_id, role_ids, Permissions.default.value
+-- get_page for several titles at once, along with the member's permissions for each page.
+-- requested is the folded title (or alias) which matched. Titles not found have no row.
+-- role_ids must not include the guild ID, as for permissions_for().
+WITH found AS (
+	SELECT lower(title) AS requested, page_id
+	FROM pages
+	WHERE guild = $1 AND lower(title) = ANY ($2::TEXT[])
+	UNION ALL
+	SELECT lower(title), page_id
+	FROM aliases
+	WHERE guild = $1 AND lower(title) = ANY ($2::TEXT[]))
+SELECT
+	requested, pages.page_id, created, content, pages.title, latest_revision,
+	permissions_for(pages.page_id, $3, $4, $1, $5) AS permissions
+FROM
+	found
+	INNER JOIN pages USING (page_id)
+	INNER JOIN revisions ON pages.latest_revision = revisions.revision_id
+-- :endmacro
+
 -- :macro get_page_no_alias()
 -- params: guild_id, title
 SELECT title AS target, NULL AS alias
@@ -67,7 +100,8 @@ WHERE EXISTS (
 -- :macro get_page_revisions()
 -- params: guild_id, title
 SELECT
-	page_id, revision_id, author, content, revised, pages.title AS current_title,
+	page_id, revision_id, author, content, archive_segment, archive_offset, archive_length,
+	revised, pages.title AS current_title,
 	coalesce_agg(new_title) OVER (PARTITION BY page_id ORDER BY revision_id ASC) AS title
 FROM pages INNER JOIN revisions USING (page_id)
 WHERE
@@ -76,6 +110,35 @@ WHERE
 ORDER BY revision_id DESC
 -- :endmacro
 
+-- :macro get_page_revisions_before()
+-- params: guild_id, title, before_revision_id, limit
+SELECT *
+FROM ({{ get_page_revisions() }}) AS page_revisions
+WHERE revision_id < $3
+ORDER BY revision_id DESC
+LIMIT $4
+-- :endmacro
+
+-- :macro get_pages_after()
+-- params: guild_id, after_title, limit
+-- for keyset pagination
+SELECT page_id, title, latest_revision, created
+FROM pages
+WHERE guild = $1 AND lower(title) > lower($2)
+ORDER BY lower(title)
+LIMIT $3
+-- :endmacro
+
+-- :macro get_aliases_after()
+-- params: guild_id, after_title, limit
+-- for keyset pagination
+SELECT aliases.title, pages.title AS target, aliased
+FROM aliases INNER JOIN pages USING (page_id)
+WHERE aliases.guild = $1 AND lower(aliases.title) > lower($2)
+ORDER BY lower(aliases.title)
+LIMIT $3
+-- :endmacro
+
 -- :macro get_all_pages()
 -- params: guild_id
 -- TODO dedupe
@@ -121,7 +184,10 @@ LIMIT 100
 WITH all_revisions AS (
 	-- TODO dedupe from get_page_revisions (use a stored proc?)
 	SELECT
-		page_id, revision_id, author, coalesce_agg(content) OVER w AS content, revised, pages.title AS current_title,
+		page_id, revision_id, author, revised, pages.title AS current_title,
+		-- the revision which holds this revision's content, whether in the table or in the archive
+		coalesce_agg(CASE WHEN content IS NOT NULL OR archive_segment IS NOT NULL THEN revision_id END)
+			OVER w AS content_revision_id,
 		coalesce_agg(new_title) OVER w AS title,
 		coalesce_agg(new_title) OVER (
 			PARTITION BY page_id
@@ -131,10 +197,15 @@ WITH all_revisions AS (
 	WHERE guild = $1
 	WINDOW w AS (PARTITION BY page_id ORDER BY revision_id))
 -- using an outer query here prevents prematurely filtering the window funcs above to the selected revision IDs
-SELECT *
-FROM all_revisions
-WHERE revision_id = ANY ($2)
-ORDER BY revision_id ASC  -- usually this is used for diffs so we want oldest-newest
+SELECT
+	all_revisions.*,
+	content_revisions.content, content_revisions.archive_segment,
+	content_revisions.archive_offset, content_revisions.archive_length
+FROM
+	all_revisions
+	LEFT JOIN revisions AS content_revisions ON (content_revisions.revision_id = all_revisions.content_revision_id)
+WHERE all_revisions.revision_id = ANY ($2)
+ORDER BY all_revisions.revision_id ASC  -- usually this is used for diffs so we want oldest-newest
 -- :endmacro
 
 -- :macro create_page()
@@ -203,15 +274,54 @@ WHERE page_id = $1
 -- :endmacro
 
 -- :macro log_page_use()
--- params: guild_id, title
+-- params: guild_id, title, register, rank
+-- register and rank are the viewer's HyperLogLog register index and rank (see utils/hll.py).
+-- the sketches are only written to if that register grows, which is rare once a page has had a few viewers.
 -- TODO dedupe this CTE
 WITH page AS (
 	SELECT page_id
 	FROM aliases RIGHT JOIN pages USING (page_id)
 	WHERE pages.guild = $1 AND (lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
-	LIMIT 1)
-INSERT INTO page_usage_history (page_id)
-VALUES ((SELECT * FROM page))
+	LIMIT 1),
+page_use AS (
+	INSERT INTO page_usage_history (page_id)
+	VALUES ((SELECT * FROM page))),
+page_sketch AS (
+	INSERT INTO page_view_sketches AS s (page_id, day, sketch)
+	-- an empty sketch is hll.REGISTERS zero bytes
+	SELECT page_id, (now() AT TIME ZONE 'UTC')::DATE, set_byte(decode(repeat('00', 512), 'hex'), $3, $4)
+	FROM page
+	ON CONFLICT (page_id, day) DO UPDATE
+	SET sketch = set_byte(s.sketch, $3, $4)
+	WHERE get_byte(s.sketch, $3) < $4)
+INSERT INTO guild_view_sketches AS s (guild, day, sketch)
+SELECT $1, (now() AT TIME ZONE 'UTC')::DATE, set_byte(decode(repeat('00', 512), 'hex'), $3, $4)
+WHERE EXISTS (SELECT 1 FROM page)
+ON CONFLICT (guild, day) DO UPDATE
+SET sketch = set_byte(s.sketch, $3, $4)
+WHERE get_byte(s.sketch, $3) < $4
+-- :endmacro
+
+-- :macro log_page_uses()
+-- params: guild_id, page_ids, register, rank
+-- log_page_use for several pages at once. page_ids must not contain duplicates.
+WITH
+	page_use AS (
+		INSERT INTO page_usage_history (page_id)
+		SELECT unnest($2::INTEGER[])),
+	page_sketch AS (
+		INSERT INTO page_view_sketches AS s (page_id, day, sketch)
+		SELECT page_id, (now() AT TIME ZONE 'UTC')::DATE, set_byte(decode(repeat('00', 512), 'hex'), $3, $4)
+		FROM unnest($2::INTEGER[]) AS page_id
+		ON CONFLICT (page_id, day) DO UPDATE
+		SET sketch = set_byte(s.sketch, $3, $4)
+		WHERE get_byte(s.sketch, $3) < $4)
+INSERT INTO guild_view_sketches AS s (guild, day, sketch)
+SELECT $1, (now() AT TIME ZONE 'UTC')::DATE, set_byte(decode(repeat('00', 512), 'hex'), $3, $4)
+WHERE cardinality($2::INTEGER[]) > 0
+ON CONFLICT (guild, day) DO UPDATE
+SET sketch = set_byte(s.sketch, $3, $4)
+WHERE get_byte(s.sketch, $3) < $4
 -- :endmacro
 
 -- STATS
@@ -229,6 +339,26 @@ FROM page_usage_history
 WHERE page_id = (SELECT * FROM page) AND time > $3
 -- :endmacro
 
+-- :macro page_view_sketches()
+-- params: guild_id, title, cutoff_date
+SELECT sketch
+FROM page_view_sketches
+WHERE page_id = (
+	SELECT page_id
+	FROM aliases RIGHT JOIN pages USING (page_id)
+	WHERE pages.guild = $1 AND
+	(lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
+	LIMIT 1)
+AND day >= $3::DATE
+-- :endmacro
+
+-- :macro guild_view_sketches()
+-- params: guild_id, cutoff_date
+SELECT sketch
+FROM guild_view_sketches
+WHERE guild = $1 AND day >= $2::DATE
+-- :endmacro
+
 -- :macro page_revisions_count()
 -- params: guild_id, title
 WITH page AS (
@@ -237,9 +367,7 @@ WITH page AS (
 	WHERE pages.guild = $1 AND
 	(lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
 	LIMIT 1)
-SELECT count(*)
-FROM revisions
-WHERE page_id = (SELECT * FROM page)
+SELECT coalesce((SELECT count FROM page_revision_counts WHERE page_id = (SELECT * FROM page)), 0)
 -- :endmacro
 
 -- :macro page_count()
@@ -251,9 +379,7 @@ WHERE guild = $1
 
 -- :macro revisions_count()
 -- params: guild_id
-SELECT count(*)
-FROM revisions INNER JOIN pages USING (page_id)
-WHERE guild = $1
+SELECT coalesce((SELECT count FROM guild_revision_counts WHERE guild = $1), 0)
 -- :endmacro
 
 -- :macro total_page_uses()
@@ -275,11 +401,12 @@ LIMIT 3
 
 -- :macro top_editors()
 -- params: guild_id, cutoff_date
--- TODO dedupe from top_pages
-SELECT author AS id, count(revision_id) AS count
-FROM revisions INNER JOIN pages USING (page_id)
-WHERE guild = $1 AND revised > $2
+-- revision counts are by day, so this includes all of the cutoff date
+SELECT author AS id, sum(count) AS count
+FROM guild_author_revision_counts
+WHERE guild = $1 AND day >= $2::DATE
 GROUP BY author
+HAVING sum(count) > 0
 ORDER BY count DESC
 LIMIT 3
 -- :endmacro
@@ -291,10 +418,108 @@ WITH page_id AS (
 	FROM pages LEFT JOIN aliases USING (page_id)
 	WHERE pages.guild = $1 AND (lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
 	LIMIT 1)
-SELECT author AS id, count(*) AS count, count(*)::float8 / sum(count(*)) OVER () AS rank
-FROM revisions
-WHERE page_id = (SELECT * FROM page_id) AND revised > $3
+SELECT author AS id, sum(count) AS count, sum(count)::float8 / sum(sum(count)) OVER () AS rank
+FROM page_author_revision_counts
+WHERE page_id = (SELECT * FROM page_id) AND day >= $3::DATE
 GROUP BY author
+HAVING sum(count) > 0
 ORDER BY rank DESC
 LIMIT 3
 -- :endmacro
+
+-- :macro revision_page_titles()
+-- params: revision_id
+-- every title the revision's page has had, and its aliases, lowercase
+SELECT guild, page_id, array(
+	SELECT lower(new_title)
+	FROM revisions AS r
+	WHERE r.page_id = revisions.page_id AND new_title IS NOT NULL
+	UNION
+	SELECT lower(title)
+	FROM aliases
+	WHERE aliases.page_id = revisions.page_id) AS titles
+FROM revisions INNER JOIN pages USING (page_id)
+WHERE revision_id = $1
+-- :endmacro
+
+-- :macro page_dependents()
+-- params: guild_id, titles, max_depth
+-- pages which include any of titles, directly or through up to max_depth levels of other pages
+WITH RECURSIVE dependents (page_id, depth) AS (
+	SELECT page_id, 1
+	FROM page_includes
+	WHERE guild = $1 AND title = ANY ($2::TEXT[])
+
+	UNION
+
+	SELECT pi.page_id, d.depth + 1
+	FROM
+		dependents AS d
+		INNER JOIN pages AS p ON (p.page_id = d.page_id)
+		INNER JOIN page_includes AS pi ON (
+			pi.guild = p.guild
+			AND (
+				pi.title = lower(p.title)
+				OR pi.title IN (SELECT lower(a.title) FROM aliases AS a WHERE a.page_id = p.page_id)))
+	WHERE d.depth < $3)
+SELECT DISTINCT page_id
+FROM dependents
+-- :endmacro
+
+-- :macro get_page_at()
+-- params: page_id, at
+-- the page as it was at the given time: its latest revision with content at or before then, and its title then.
+-- Each subquery is one probe of a (page_id, revised DESC) index.
+SELECT
+	$1::INTEGER AS page_id, r.revision_id, r.author, r.revised,
+	r.content, r.archive_segment, r.archive_offset, r.archive_length,
+	(
+		SELECT new_title
+		FROM revision_history
+		WHERE page_id = $1 AND revised <= $2 AND new_title IS NOT NULL
+		ORDER BY revised DESC
+		LIMIT 1) AS title
+FROM revision_history AS r
+WHERE r.page_id = $1 AND r.revised <= $2 AND (r.content IS NOT NULL OR r.archive_segment IS NOT NULL)
+ORDER BY r.revised DESC
+LIMIT 1
+-- :endmacro
+
+-- :macro get_pages_at()
+-- params: guild_id, at, include_deleted
+-- every page that existed at the given time, with its title and latest revision then
+SELECT p.page_id, t.title, r.revision_id, r.revised, p.deleted
+FROM
+	(
+		SELECT page_id, NULL::TIMESTAMP AS deleted
+		FROM pages
+		WHERE guild = $1
+		UNION ALL
+		SELECT page_id, deleted
+		FROM deleted_pages
+		WHERE guild = $1 AND $3 AND deleted > $2) AS p
+	-- pages with no revision by then didn't exist yet
+	CROSS JOIN LATERAL (
+		SELECT revision_id, revised
+		FROM revision_history
+		WHERE page_id = p.page_id AND revised <= $2 AND (content IS NOT NULL OR archive_segment IS NOT NULL)
+		ORDER BY revised DESC
+		LIMIT 1) AS r
+	CROSS JOIN LATERAL (
+		SELECT new_title AS title
+		FROM revision_history
+		WHERE page_id = p.page_id AND revised <= $2 AND new_title IS NOT NULL
+		ORDER BY revised DESC
+		LIMIT 1) AS t
+ORDER BY lower(t.title)
+-- :endmacro
+
+-- :macro deleted_page_id()
+-- params: guild_id, title, at
+-- the most recently deleted page with that title which existed at the given time
+SELECT page_id
+FROM deleted_pages
+WHERE guild = $1 AND lower(title) = lower($2) AND deleted > $3
+ORDER BY deleted DESC
+LIMIT 1
+-- :endmacro
@@ -30,6 +30,7 @@ from typing import (
 	overload,
 )
 
+import asyncpg
 import braceexpand
 import discord
 
@@ -65,10 +66,34 @@ def expand(text):
 def message_url(guild_id, channel_id, message_id):
 	return f'https://discordapp.com/channels/{guild_id}/{channel_id}/{message_id}'
 
+def pack(chunks, *, limit=2000, separator='\n\n'):
+	"""join chunks, in order, into as few strings of at most limit characters as possible.
+	Each chunk must be at most limit characters long.
+	"""
+	packed = []
+	for chunk in chunks:
+		if packed and len(packed[-1]) + len(separator) + len(chunk) <= limit:
+			packed[-1] += separator + chunk
+		else:
+			packed.append(chunk)
+	return packed
+
 class AttrDict:
 	def __init__(self, *args, **kwargs):
 		vars(self).update(dict(*args, **kwargs))
 
+class Record(asyncpg.Record):
+	"""A Record whose columns can also be accessed as attributes.
+	Unlike AttrDict, this is what asyncpg creates in the first place, so no copy is made.
+	"""
+	__slots__ = ()
+
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name) from None
+
 def round_down(n, *, multiple):
 	"""round n down to the nearest multiple of multiple"""
 	return n // multiple * multiple
@@ -0,0 +1,289 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Admission control in front of the database pool, so that a few heavy commands can't take every connection.
+
+Database work is in one of three classes: interactive (most commands), heavy (commands marked with @heavy,
+which read a lot), and background (everything else: listeners, the archiver, the garbage collector).
+Each class may hold only so many of the pool's connections at once, and within a class,
+each guild has a token bucket, so that one guild can't take all of them.
+Interactive and heavy work that would wait longer than its deadline is shed with BusyError.
+
+What class the current task's work is in is set with AdmissionController.classify, e.g. around each command.
+Work which already holds a connection isn't admitted again for another one,
+since waiting for a slot it holds itself could deadlock. That includes tasks it starts,
+which inherit its context and so its ticket, and may be awaited while it holds the connection.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import enum
+import logging
+import time
+
+from . import errors
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# waits longer than this many seconds are logged
+SLOW_WAIT = 1
+# how many guilds' buckets to remember per class. A forgotten bucket starts over full.
+BUCKETS_SIZE = 10_000
+
+class Priority(enum.Enum):
+	interactive = 'interactive'
+	heavy = 'heavy'
+	background = 'background'
+
+# the pool holds 10 connections unless database.max_size says otherwise, which these concurrencies add up to.
+# rate is how many connections a guild may acquire per second in the long run, and burst how many at once.
+DEFAULTS = {
+	Priority.interactive: dict(concurrency=6, rate=5, burst=20, deadline=10),
+	Priority.heavy: dict(concurrency=2, rate=0.2, burst=3, deadline=5),
+	Priority.background: dict(concurrency=2, rate=None, burst=None, deadline=None),
+}
+
+_priority = contextvars.ContextVar('admission_priority', default=Priority.background)
+_guild_id = contextvars.ContextVar('admission_guild_id', default=None)
+_deadline = contextvars.ContextVar('admission_deadline', default=None)
+_ticket = contextvars.ContextVar('admission_ticket', default=None)
+
+def heavy(func):
+	"""Mark a command as heavy. This goes below @commands.command()."""
+	func.__admission_priority__ = Priority.heavy
+	return func
+
+def priority_of(func):
+	return getattr(func, '__admission_priority__', Priority.interactive)
+
+class TokenBucket:
+	__slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+
+	def take(self):
+		"""take a token and return how many seconds to wait before using it.
+		If there are none left, a future one is taken, so the bucket may go into debt.
+		"""
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		self.tokens -= 1
+		return max(0, -self.tokens / self.rate)
+
+	def refund(self):
+		self.tokens = min(self.capacity, self.tokens + 1)
+
+class Ticket:
+	"""Permission to hold one connection"""
+	__slots__ = ('admission_class', 'released')
+
+	def __init__(self, admission_class):
+		self.admission_class = admission_class
+		self.released = False
+
+	def release(self):
+		if not self.released:
+			self.released = True
+			self.admission_class.in_use -= 1
+			self.admission_class.semaphore.release()
+
+class AdmissionClass:
+	"""The limits and wait time statistics of one priority"""
+
+	def __init__(self, priority, *, concurrency, rate, burst, deadline):
+		self.priority = priority
+		self.concurrency = concurrency
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.rate = rate
+		self.burst = burst
+		self.deadline = deadline
+		self.buckets = LRUCache(BUCKETS_SIZE)
+
+		self.in_use = 0
+		self.waiting = 0
+		self.admitted = 0
+		self.shed = 0
+		self.total_wait = 0
+		self.max_wait = 0
+
+	def bucket(self, guild_id):
+		if self.rate is None or guild_id is None:
+			return None
+		bucket = self.buckets.get(guild_id)
+		if bucket is None:
+			bucket = self.buckets[guild_id] = TokenBucket(self.rate, self.burst)
+		return bucket
+
+	async def admit(self, guild_id, deadline=None):
+		"""wait for a slot and return a Ticket for it. deadline, if given, is used if it's sooner than the class's."""
+		start = time.monotonic()
+		if self.deadline is not None:
+			deadline = self.deadline if deadline is None else min(deadline, self.deadline)
+		bucket = self.bucket(guild_id)
+		delay = 0 if bucket is None else bucket.take()
+		if deadline is not None and delay > deadline:
+			bucket.refund()
+			self.shed += 1
+			raise errors.BusyError
+
+		self.waiting += 1
+		try:
+			if delay:
+				await asyncio.sleep(delay)
+			if deadline is None or not self.semaphore.locked():
+				await self.semaphore.acquire()
+			else:
+				remaining = max(0, deadline - (time.monotonic() - start))
+				try:
+					await asyncio.wait_for(self.semaphore.acquire(), remaining)
+				except asyncio.TimeoutError:
+					if bucket is not None:
+						bucket.refund()
+					self.shed += 1
+					raise errors.BusyError from None
+		finally:
+			self.waiting -= 1
+
+		wait = time.monotonic() - start
+		self.in_use += 1
+		self.admitted += 1
+		self.total_wait += wait
+		self.max_wait = max(self.max_wait, wait)
+		if wait > SLOW_WAIT:
+			logger.info('%s work for guild %s waited %.2fs for a connection', self.priority.name, guild_id, wait)
+		return Ticket(self)
+
+	def stats(self):
+		return {
+			'in use': f'{self.in_use}/{self.concurrency}',
+			'waiting': self.waiting,
+			'admitted': self.admitted,
+			'shed': self.shed,
+			'mean wait': f'{self.total_wait / self.admitted * 1000:.1f}ms' if self.admitted else '-',
+			'max wait': f'{self.max_wait * 1000:.1f}ms',
+		}
+
+class AdmissionController:
+	def __init__(self, config):
+		self.classes = {
+			priority: AdmissionClass(priority, **{**DEFAULTS[priority], **config.get(priority.name, {})})
+			for priority in Priority}
+
+	@contextlib.contextmanager
+	def classify(self, priority, guild_id=None, *, deadline=None):
+		"""treat the database work done within this block as priority work on behalf of guild_id.
+		If deadline is given, work which would wait longer than that many seconds is shed, whatever its class.
+		"""
+		priority_token = _priority.set(priority)
+		guild_token = _guild_id.set(guild_id)
+		deadline_token = _deadline.set(deadline)
+		try:
+			yield
+		finally:
+			_deadline.reset(deadline_token)
+			_guild_id.reset(guild_token)
+			_priority.reset(priority_token)
+
+	async def admit(self):
+		"""wait until the current context may acquire a connection, and return a Ticket, or None if it already holds one"""
+		held = _ticket.get()
+		if held is not None and not held.released:
+			return None
+		ticket = await self.classes[_priority.get()].admit(_guild_id.get(), _deadline.get())
+		_ticket.set(ticket)
+		return ticket
+
+class _AcquireContext:
+	__slots__ = ('pool', 'timeout', 'connection')
+
+	def __init__(self, pool, timeout):
+		self.pool = pool
+		self.timeout = timeout
+		self.connection = None
+
+	def __await__(self):
+		return self.pool._acquire(self.timeout).__await__()
+
+	async def __aenter__(self):
+		self.connection = await self.pool._acquire(self.timeout)
+		return self.connection
+
+	async def __aexit__(self, *excinfo):
+		await self.pool.release(self.connection)
+
+class AdmittedPool:
+	"""An asyncpg pool whose connections are admitted by an AdmissionController before they're acquired.
+	Everything besides acquiring and releasing connections is passed through to the pool.
+	"""
+
+	def __init__(self, pool, controller):
+		self._pool = pool
+		self._controller = controller
+		# connection → its Ticket
+		self._tickets = {}
+
+	def __getattr__(self, name):
+		return getattr(self._pool, name)
+
+	def acquire(self, *, timeout=None):
+		return _AcquireContext(self, timeout)
+
+	async def _acquire(self, timeout):
+		ticket = await self._controller.admit()
+		try:
+			conn = await self._pool.acquire(timeout=timeout)
+		except BaseException:
+			if ticket is not None:
+				ticket.release()
+			raise
+		self._tickets[conn] = ticket
+		return conn
+
+	async def release(self, connection, *, timeout=None):
+		try:
+			await self._pool.release(connection, timeout=timeout)
+		finally:
+			ticket = self._tickets.pop(connection, None)
+			if ticket is not None:
+				ticket.release()
+
+	# the pool's shortcuts acquire connections of their own, which must be admitted too
+
+	async def execute(self, query, *args, timeout=None):
+		async with self.acquire() as conn:
+			return await conn.execute(query, *args, timeout=timeout)
+
+	async def executemany(self, command, args, *, timeout=None):
+		async with self.acquire() as conn:
+			return await conn.executemany(command, args, timeout=timeout)
+
+	async def fetch(self, query, *args, timeout=None):
+		async with self.acquire() as conn:
+			return await conn.fetch(query, *args, timeout=timeout)
+
+	async def fetchval(self, query, *args, column=0, timeout=None):
+		async with self.acquire() as conn:
+			return await conn.fetchval(query, *args, column=column, timeout=timeout)
+
+	async def fetchrow(self, query, *args, timeout=None):
+		async with self.acquire() as conn:
+			return await conn.fetchrow(query, *args, timeout=timeout)
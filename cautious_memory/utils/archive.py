@@ -0,0 +1,88 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import zlib
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+Location = Tuple[int, int, int]  # segment, offset, length
+
+class RevisionArchive:
+	"""Append-only segment files of zlib compressed revision contents.
+
+	Each record is addressed by (segment, offset, length), which is stored alongside the revision in the database.
+	Segments are never modified except to append to the newest one, so they are memory mapped for reading.
+	"""
+	SEGMENT_SIZE_LIMIT = 64 * 1024 ** 2
+	SUFFIX = '.zseg'
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self._maps = {}
+
+	def segment_path(self, segment):
+		return self.path / f'{segment:08}{self.SUFFIX}'
+
+	def current_segment(self):
+		segments = [int(p.stem) for p in self.path.glob('*' + self.SUFFIX)]
+		return max(segments, default=0)
+
+	def append(self, contents: Iterable[str]) -> List[Location]:
+		"""archive each of contents, returning their locations in the same order.
+		The data is flushed to disk before this returns, so the locations may be committed to the database right away.
+		This does blocking IO, so run it in an executor.
+		"""
+		segment = self.current_segment()
+		path = self.segment_path(segment)
+		if path.exists() and path.stat().st_size >= self.SEGMENT_SIZE_LIMIT:
+			segment += 1
+			path = self.segment_path(segment)
+
+		locations = []
+		with open(path, 'ab') as f:
+			offset = f.tell()
+			for content in contents:
+				record = zlib.compress(content.encode('utf-8'), 9)
+				f.write(record)
+				locations.append((segment, offset, len(record)))
+				offset += len(record)
+			f.flush()
+			os.fsync(f.fileno())
+
+		return locations
+
+	def read(self, segment, offset, length) -> str:
+		m = self._maps.get(segment)
+		if m is None or len(m) < offset + length:
+			# not mapped yet, or the segment has been appended to since we mapped it
+			m = self._map(segment)
+		return zlib.decompress(m[offset:offset + length]).decode('utf-8')
+
+	def _map(self, segment):
+		with open(self.segment_path(segment), 'rb') as f:
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		old = self._maps.pop(segment, None)
+		if old is not None:
+			old.close()
+		self._maps[segment] = m
+		return m
+
+	def close(self):
+		for m in self._maps.values():
+			m.close()
+		self._maps.clear()
@@ -0,0 +1,64 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+class LRUCache:
+	"""A mapping which holds at most maxsize items, evicting the least recently used.
+	If ttl is given, items are also forgotten that many seconds after they were set.
+	"""
+	def __init__(self, maxsize, *, ttl=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		# key → (expiry, value)
+		self._data = OrderedDict()
+
+	def __len__(self):
+		return len(self._data)
+
+	def __contains__(self, key):
+		return self.get(key, _missing) is not _missing
+
+	def get(self, key, default=None):
+		try:
+			expiry, value = self._data[key]
+		except KeyError:
+			return default
+
+		if expiry is not None and expiry <= time.monotonic():
+			del self._data[key]
+			return default
+
+		self._data.move_to_end(key)
+		return value
+
+	def __setitem__(self, key, value):
+		expiry = None if self.ttl is None else time.monotonic() + self.ttl
+		self._data[key] = expiry, value
+		self._data.move_to_end(key)
+		while len(self._data) > self.maxsize:
+			self._data.popitem(last=False)
+
+	def pop(self, key, default=None):
+		try:
+			return self._data.pop(key)[1]
+		except KeyError:
+			return default
+
+	def clear(self):
+		self._data.clear()
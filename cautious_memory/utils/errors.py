@@ -40,9 +40,14 @@ class PageExistsError(PageError):
 		super().__init__(f'A page or alias with that name already exists.')
 
 class PageNotFoundError(PageError):
-	def __init__(self, name):
+	def __init__(self, name, suggestions=()):
 		self.name = name
-		super().__init__(f'A page called “{name}” does not exist.')
+		self.suggestions = suggestions
+		message = f'A page called “{name}” does not exist.'
+		if suggestions:
+			joined = natural_join([f'“{suggestion}”' for suggestion in suggestions], conj='or')
+			message += f' Did you mean {joined}?'
+		super().__init__(message)
 
 class MissingPagePermissionsError(PageError):
 	"""Raised when the user tries to perform an action they do not have permissions for."""
@@ -51,6 +56,11 @@ class MissingPagePermissionsError(PageError):
 		joined = natural_join([permission.name for permission in permissions_needed])
 		super().__init__(f'Missing permissions to perform this action. You need these permissions: {joined}.')
 
+class MissingDeletedPagePermissionsError(PageError):
+	"""Raised when someone other than an administrator tries to see pages which have been deleted."""
+	def __init__(self):
+		super().__init__('Only administrators may see pages that have been deleted.')
+
 class PageTitleTooLongError(PageError):
 	def __init__(self, title, limit):
 		super().__init__(
@@ -60,3 +70,24 @@ class PageContentTooLongError(PageError):
 	def __init__(self, content, limit):
 		super().__init__(
 			f'That page would be {len(content)} characters long, but the limit is {limit} characters.')
+
+class ArchivedRevisionUnavailableError(CautiousMemoryError, UserInputError):
+	"""Raised when an archived revision's segment file isn't on this host."""
+	def __init__(self, revision_id):
+		self.revision_id = revision_id
+		super().__init__(
+			f'The content of revision {revision_id} has been archived, and the archive is not available here. '
+			'Try again later, or ask the bot owner.')
+
+class WatchPatternError(CautiousMemoryError, UserInputError):
+	"""Raised when a pattern watch could not be added."""
+	pass
+
+class WikiImportError(CautiousMemoryError, UserInputError):
+	"""Raised when a wiki export could not be imported."""
+	pass
+
+class BusyError(CautiousMemoryError, UserInputError):
+	"""Raised when heavy work is shed because the database is busy."""
+	def __init__(self):
+		super().__init__('The wiki is busy right now. Please try that again in a minute.')
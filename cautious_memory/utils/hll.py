@@ -0,0 +1,62 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""HyperLogLog sketches, for estimating how many distinct items have been seen in constant space.
+
+A sketch is a bytes object of REGISTERS registers, one byte each.
+Adding an item sets one register to the max of its current value and a rank derived from the item's hash,
+so items are added in SQL with get_byte/set_byte, and sketches are merged by taking the max of each register.
+The standard error of an estimate is about 1.04 / sqrt(REGISTERS), or 4.6%.
+"""
+
+import hashlib
+import math
+from typing import Iterable, Tuple
+
+PRECISION = 9
+# if you change this, change the empty sketch in log_page_use in wiki.sql too
+REGISTERS = 1 << PRECISION
+HASH_BITS = 64
+
+def register(item: int) -> Tuple[int, int]:
+	"""return (register index, rank) for an integer item, such as a user ID"""
+	h = int.from_bytes(
+		hashlib.blake2b(item.to_bytes(8, 'big', signed=True), digest_size=HASH_BITS // 8).digest(),
+		'big')
+	index = h >> (HASH_BITS - PRECISION)
+	rest = h & ((1 << (HASH_BITS - PRECISION)) - 1)
+	# the position of the leftmost 1 bit of the rest of the hash
+	rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+	return index, rank
+
+def merge(sketches: Iterable[bytes]) -> bytes:
+	"""return a sketch of the union of sketches"""
+	merged = bytearray(REGISTERS)
+	for sketch in sketches:
+		merged = bytearray(map(max, merged, sketch))
+	return bytes(merged)
+
+def estimate(sketch: bytes) -> int:
+	"""return the approximate number of distinct items added to sketch"""
+	m = len(sketch)
+	alpha = 0.7213 / (1 + 1.079 / m)
+	raw = alpha * m * m / sum(2.0 ** -r for r in sketch)
+
+	zeros = sketch.count(0)
+	if raw <= 2.5 * m and zeros:
+		# few items: linear counting is more accurate
+		return round(m * math.log(m / zeros))
+	# no large range correction is needed for a 64 bit hash
+	return round(raw)
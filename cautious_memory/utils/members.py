@@ -0,0 +1,81 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+class MemberResolver:
+	"""Looks up guild members by ID, whether or not discord.py caches every member.
+
+	Members that discord.py has cached are used as is. The rest are requested from the gateway,
+	up to QUERY_LIMIT per request, and kept in a bounded LRU cache, so that memory use
+	scales with the members the bot actually deals with rather than the members of every guild.
+	Users found not to be members are cached too, so that they aren't requested over and over.
+
+	Without the members intent there are no events to tell us when a cached member changes,
+	so entries expire after ttl seconds instead.
+	"""
+	# the most user IDs Discord accepts in one request
+	QUERY_LIMIT = 100
+
+	def __init__(self, *, maxsize=10_000, ttl=5 * 60):
+		# (guild ID, user ID) → member, or None if they aren't one
+		self.cache = LRUCache(maxsize, ttl=ttl)
+
+	def get(self, guild, user_id):
+		"""return the member with ID user_id if they're cached, without making any requests"""
+		member = guild.get_member(user_id)
+		if member is not None:
+			return member
+		return self.cache.get((guild.id, user_id))
+
+	async def fetch(self, guild, user_id):
+		"""return the member with ID user_id, or None if they aren't a member of guild"""
+		return (await self.resolve(guild, [user_id])).get(user_id)
+
+	async def resolve(self, guild, user_ids):
+		"""return a dict mapping each of user_ids who is a member of guild to their member object"""
+		members = {}
+		missing = []
+		for user_id in dict.fromkeys(user_ids):
+			member = guild.get_member(user_id)
+			if member is None:
+				member = self.cache.get((guild.id, user_id), _missing)
+			if member is _missing:
+				missing.append(user_id)
+			elif member is not None:
+				members[user_id] = member
+
+		for i in range(0, len(missing), self.QUERY_LIMIT):
+			batch = missing[i:i + self.QUERY_LIMIT]
+			try:
+				# cache=False: the results are ours to cache, not discord.py's
+				found = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+			except asyncio.TimeoutError:
+				logger.warning('timed out requesting %s members of guild %s', len(batch), guild.id)
+				continue
+
+			for member in found:
+				members[member.id] = member
+			for user_id in batch:
+				self.cache[guild.id, user_id] = members.get(user_id)
+
+		return members
@@ -0,0 +1,233 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Versioned schema migrations. See cautious_memory/migrations/README.md for how to write them."""
+
+import asyncio
+import importlib.util
+import re
+from pathlib import Path
+
+MIGRATIONS_DIR = Path(__file__).parent.parent / 'migrations'
+FILENAME_PATTERN = re.compile(r'(\d+)_(\w+)\.(sql|py)')
+NO_TRANSACTION_DIRECTIVE = '-- migrate: no-transaction'
+DOLLAR_QUOTE_PATTERN = re.compile(r'\$(?:[A-Za-z_]\w*)?\$')
+# arbitrary, but fixed, so that two runners never migrate at once
+ADVISORY_LOCK_ID = 0x636d6d67
+
+# (statement pattern, lock mode). The first match wins. Lock mode None means no lock on an existing table.
+LOCK_LEVELS = [(re.compile(pattern, re.IGNORECASE), mode) for pattern, mode in [
+	(r'CREATE (UNIQUE )?INDEX CONCURRENTLY', 'SHARE UPDATE EXCLUSIVE'),
+	(r'CREATE (UNIQUE )?INDEX', 'SHARE'),
+	(r'(DROP INDEX|REINDEX .*) CONCURRENTLY', 'SHARE UPDATE EXCLUSIVE'),
+	(r'ALTER TABLE .* VALIDATE CONSTRAINT', 'SHARE UPDATE EXCLUSIVE'),
+	(r'ALTER TABLE .* ADD (CONSTRAINT \S+ )?FOREIGN KEY', 'SHARE ROW EXCLUSIVE'),
+	(r'CREATE (CONSTRAINT )?TRIGGER', 'SHARE ROW EXCLUSIVE'),
+	(r'ALTER TABLE|DROP (TABLE|INDEX|TRIGGER)|REINDEX|VACUUM FULL|CLUSTER', 'ACCESS EXCLUSIVE'),
+	(r'UPDATE|DELETE|INSERT', 'ROW EXCLUSIVE'),
+	(r'CREATE|COMMENT|GRANT|REVOKE|SET', None),
+]]
+
+LOCK_EFFECTS = {
+	'ACCESS EXCLUSIVE': 'blocks reads and writes',
+	'SHARE ROW EXCLUSIVE': 'blocks writes',
+	'SHARE': 'blocks writes',
+	'SHARE UPDATE EXCLUSIVE': "doesn't block reads or writes",
+	'ROW EXCLUSIVE': "doesn't block reads or writes",
+	None: "doesn't lock existing tables",
+}
+
+class MigrationError(Exception):
+	pass
+
+class Migration:
+	__slots__ = ('version', 'name', 'path')
+
+	def __init__(self, version, name, path):
+		self.version = version
+		self.name = name
+		self.path = path
+
+	def __str__(self):
+		return self.path.stem
+
+	@property
+	def is_python(self):
+		return self.path.suffix == '.py'
+
+	@property
+	def in_transaction(self):
+		"""Python migrations manage their own transactions"""
+		return not self.is_python and NO_TRANSACTION_DIRECTIVE not in self.path.read_text().splitlines()
+
+	def statements(self):
+		return split_statements(self.path.read_text())
+
+	def module(self):
+		spec = importlib.util.spec_from_file_location(f'cautious_memory.migrations.m{self.version}', self.path)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+		return module
+
+	async def apply(self, conn):
+		if self.is_python:
+			await self.module().migrate(conn)
+		elif self.in_transaction:
+			# one round trip, and atomic
+			await conn.execute(self.path.read_text())
+		else:
+			# CREATE INDEX CONCURRENTLY and friends can't be run in a transaction, even an implicit one
+			for statement in self.statements():
+				await conn.execute(statement)
+
+	def describe(self):
+		"""yield lines describing what applying this migration would do, for dry runs"""
+		if self.is_python:
+			module = self.module()
+			yield f'{self} (python, manages its own transactions)'
+			if module.__doc__:
+				yield from ('\t' + line for line in module.__doc__.strip().splitlines())
+			return
+
+		in_transaction = self.in_transaction
+		yield f'{self} (sql, {"one transaction" if in_transaction else "no transaction"})'
+		for statement in self.statements():
+			mode = lock_level(statement)
+			summary = ' '.join(strip_comments(statement).split())
+			if len(summary) > 100:
+				summary = summary[:99] + '…'
+			yield f'\t{mode or "no lock"} ({LOCK_EFFECTS[mode]}): {summary}'
+			if in_transaction and re.search(r'\bCONCURRENTLY\b', statement, re.IGNORECASE):
+				yield f'\t\tthis will fail: CONCURRENTLY needs "{NO_TRANSACTION_DIRECTIVE}"'
+
+def load(directory=MIGRATIONS_DIR):
+	"""return every migration in directory, sorted by version"""
+	migrations = {}
+	for path in directory.iterdir():
+		match = FILENAME_PATTERN.fullmatch(path.name)
+		if match is None:
+			continue
+		version = int(match[1])
+		if version in migrations:
+			raise MigrationError(f'{path.name} and {migrations[version].path.name} have the same version')
+		migrations[version] = Migration(version, match[2], path)
+	return [migrations[version] for version in sorted(migrations)]
+
+def strip_comments(statement):
+	return '\n'.join(line for line in statement.splitlines() if not line.lstrip().startswith('--'))
+
+def split_statements(sql):
+	"""split sql into statements on semicolons outside of strings, dollar quotes, and comments"""
+	statements = []
+	start = 0
+	i = 0
+	while i < len(sql):
+		if sql.startswith('--', i):
+			end = sql.find('\n', i)
+			i = len(sql) if end == -1 else end
+			continue
+
+		if sql[i] == "'":
+			# '' inside a string is treated as the end of one string and the start of another, which is fine
+			end = sql.find("'", i + 1)
+			i = len(sql) if end == -1 else end + 1
+			continue
+
+		match = DOLLAR_QUOTE_PATTERN.match(sql, i)
+		if match is not None:
+			end = sql.find(match[0], match.end())
+			i = len(sql) if end == -1 else end + len(match[0])
+			continue
+
+		if sql[i] == ';':
+			statements.append(sql[start:i])
+			start = i + 1
+		i += 1
+
+	statements.append(sql[start:])
+	return [statement.strip() for statement in statements if strip_comments(statement).strip()]
+
+def lock_level(statement):
+	"""return the strongest table lock mode that statement takes, as best as we can tell without running it"""
+	statement = ' '.join(strip_comments(statement).split())
+	for pattern, mode in LOCK_LEVELS:
+		if pattern.match(statement):
+			return mode
+	# be pessimistic about anything we don't recognize
+	return 'ACCESS EXCLUSIVE'
+
+async def backfill(conn, query, *args, batch_size=1000, delay=0.1):
+	"""Run query repeatedly, each time in its own transaction, until it affects no rows.
+	This is for updating big tables without holding row locks on all of them at once, or bloating them in one go.
+
+	query's first parameter is batch_size, which it must use to limit how many rows it affects,
+	and the rest are args. delay is how long to sleep between batches, so as not to starve everyone else.
+	Return the number of rows affected in total.
+	"""
+	total = 0
+	while True:
+		tag = await conn.execute(query, batch_size, *args)
+		count = int(tag.rsplit(None, 1)[-1])
+		total += count
+		if not count:
+			return total
+		await asyncio.sleep(delay)
+
+async def applied_versions(conn, queries, *, dry_run=False):
+	if dry_run:
+		# a dry run mustn't create the table, so one without it just has nothing applied
+		if await conn.fetchval(queries.schema_version_exists()) is None:
+			return set()
+	else:
+		await conn.execute(queries.create_schema_version())
+	return {version for version, in await conn.fetch(queries.applied_versions())}
+
+async def migrate(conn, queries, migrations, *, dry_run=False, baseline=False, lock_timeout='5s', log=print):
+	"""apply every migration in migrations which hasn't been applied yet.
+	If baseline, record them as applied without running them, e.g. for a database just created from schema.sql.
+	"""
+	await conn.execute('SELECT pg_advisory_lock($1)', ADVISORY_LOCK_ID)
+	try:
+		applied = await applied_versions(conn, queries, dry_run=dry_run)
+		pending = [migration for migration in migrations if migration.version not in applied]
+		if not pending:
+			log('Nothing to migrate.')
+			return
+
+		# DDL which waits for a lock makes everyone else wait behind it, so give up instead
+		await conn.execute("SELECT set_config('lock_timeout', $1, false)", lock_timeout)
+
+		for migration in pending:
+			if dry_run:
+				for line in migration.describe():
+					log(line)
+				continue
+
+			if baseline:
+				log(f'Marking {migration} as applied')
+				await conn.execute(queries.record_migration(), migration.version, migration.name)
+				continue
+
+			log(f'Applying {migration}')
+			if migration.in_transaction:
+				async with conn.transaction():
+					await migration.apply(conn)
+					await conn.execute(queries.record_migration(), migration.version, migration.name)
+			else:
+				# if this fails partway through, the migration must be safe to run again
+				await migration.apply(conn)
+				await conn.execute(queries.record_migration(), migration.version, migration.name)
+	finally:
+		await conn.execute('SELECT pg_advisory_unlock($1)', ADVISORY_LOCK_ID)
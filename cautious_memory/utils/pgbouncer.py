@@ -0,0 +1,53 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Support for running behind PgBouncer in transaction pooling mode.
+
+In that mode, consecutive transactions of one connection may run on different server connections,
+and each server connection is shared by every process using PgBouncer. So nothing may outlive a transaction:
+no session settings, no LISTEN, and no prepared statements which are used again later.
+"""
+
+import uuid
+
+import asyncpg
+
+class PgBouncerConnection(asyncpg.Connection):
+	"""A connection with prepared statement names unique to this process.
+
+	With the statement cache disabled, asyncpg still uses named prepared statements for cursors.
+	Those are prepared and used within one transaction, which is fine, but they're closed later,
+	so they may be left behind on the server connection, where another process could pick the same name.
+	(PgBouncer's server_lifetime eventually cleans them up.)
+	"""
+	__slots__ = ()
+
+	# asyncpg's names are only unique within a process
+	_namespace = uuid.uuid4().hex[:12]
+
+	def _get_unique_id(self, prefix):
+		return f'__cm_{self._namespace}' + super()._get_unique_id(prefix)
+
+def configure(database_config):
+	"""make the connection options in database_config (as passed to asyncpg.connect) safe to use through PgBouncer"""
+	# otherwise each statement is prepared on one server connection and executed on whichever one we get next
+	database_config.setdefault('statement_cache_size', 0)
+	database_config.setdefault('connection_class', PgBouncerConnection)
+
+def direct_options(config):
+	"""return the options for connecting to Postgres itself, for what needs a session: LISTEN, advisory locks, etc.
+	Without PgBouncer, that's just the database options.
+	"""
+	return {**config['database'], **config.get('pgbouncer', {}).get('direct', {})}
@@ -0,0 +1,130 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Checks the query plan of every SQL macro, to catch missing indexes and plan regressions.
+
+Run it with python -m cautious_memory audit-plans. Since the macros take parameters,
+each one is prepared and explained with plan_cache_mode = force_generic_plan,
+so that the plan doesn't depend on the (null) arguments.
+Nothing is written to the database: everything happens in a transaction which is rolled back.
+"""
+
+import json
+
+import asyncpg
+import jinja2
+
+# tables with at least this many rows shouldn't be scanned sequentially
+SEQ_SCAN_ROW_LIMIT = 10_000
+# a plan which costs this many times its baseline cost is a regression
+COST_REGRESSION_FACTOR = 1.5
+# templates which aren't queries run by the bot
+SKIP_TEMPLATES = {'schema.sql', 'functions.sql', 'migrations.sql', 'plan_audit.sql'}
+# macros which can't be prepared outside of where they're used. Any other macro which fails to prepare is a problem,
+# since that usually means that it's broken, e.g. by a schema change.
+UNEXPLAINABLE = {
+	# SET can't be prepared
+	'export.sql:suppress_notifications',
+	# several statements
+	'export.sql:create_staging_tables',
+	# these use the temporary tables made by create_staging_tables
+	'export.sql:allocate_page_ids',
+	'export.sql:allocate_revision_ids',
+	'export.sql:import_conflict',
+	'export.sql:merge_aliases',
+	'export.sql:merge_bound_messages',
+	'export.sql:merge_page_permissions',
+	'export.sql:merge_pages',
+	'export.sql:merge_revisions',
+}
+
+class AuditResult:
+	__slots__ = ('costs', 'problems', 'skipped')
+
+	def __init__(self):
+		# 'template.sql:macro' → total cost of its plan
+		self.costs = {}
+		self.problems = []
+		# 'template.sql:macro' → why it couldn't be explained, for macros in UNEXPLAINABLE
+		self.skipped = {}
+
+def macros(jinja_env):
+	"""yield (key, query) for every macro in every template"""
+	for template_name in sorted(jinja_env.list_templates(extensions=['sql'])):
+		if template_name in SKIP_TEMPLATES:
+			continue
+		module = jinja_env.get_template(template_name).module
+		for name, macro in sorted(vars(module).items()):
+			# macros with template arguments (e.g. table names) are generated per use and checked where they're used
+			if isinstance(macro, jinja2.runtime.Macro) and not macro.arguments:
+				yield f'{template_name}:{name}', macro()
+
+async def explain(conn, name, query):
+	"""return the generic plan of query. name must be unique among the session's prepared statements."""
+	async with conn.transaction():
+		await conn.execute(f'PREPARE {name} AS {query}')
+	try:
+		async with conn.transaction():
+			param_count = await conn.fetchval(
+				'SELECT cardinality(parameter_types) FROM pg_prepared_statements WHERE name = $1', name)
+			args = ', '.join(['NULL'] * param_count)
+			[plan] = json.loads(await conn.fetchval(f'EXPLAIN (FORMAT JSON) EXECUTE {name}({args})'))
+			return plan['Plan']
+	finally:
+		await conn.execute(f'DEALLOCATE {name}')
+
+def walk(plan):
+	yield plan
+	for child in plan.get('Plans', ()):
+		yield from walk(child)
+
+async def audit(conn, queries, jinja_env, *, seed=False, baseline=None):
+	"""explain every macro and return an AuditResult.
+	queries is the plan_audit.sql template module. If seed, synthetic data is added first.
+	baseline maps keys to costs from an earlier run.
+	"""
+	result = AuditResult()
+	tr = conn.transaction()
+	await tr.start()
+	try:
+		if seed:
+			await conn.execute(queries.seed())
+		await conn.execute('SET LOCAL plan_cache_mode = force_generic_plan')
+		sizes = dict(await conn.fetch(queries.table_sizes()))
+
+		for i, (key, query) in enumerate(macros(jinja_env)):
+			try:
+				plan = await explain(conn, f'plan_audit_{i}', query)
+			except asyncpg.PostgresError as exc:
+				if key in UNEXPLAINABLE:
+					result.skipped[key] = str(exc)
+				else:
+					result.problems.append(f'{key}: could not be prepared: {exc}')
+				continue
+
+			cost = result.costs[key] = plan['Total Cost']
+			for node in walk(plan):
+				if node['Node Type'] != 'Seq Scan':
+					continue
+				rows = sizes.get(node['Relation Name'], 0)
+				if rows >= SEQ_SCAN_ROW_LIMIT:
+					result.problems.append(f'{key}: sequential scan of {node["Relation Name"]} (~{rows} rows)')
+
+			if baseline and key in baseline and cost > baseline[key] * COST_REGRESSION_FACTOR:
+				result.problems.append(f'{key}: cost went from {baseline[key]} to {cost}')
+	finally:
+		await tr.rollback()
+
+	return result
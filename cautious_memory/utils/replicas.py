@@ -0,0 +1,149 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import functools
+import inspect
+import logging
+import random
+import time
+
+import asyncpg
+from bot_bin.sql import connection
+
+logger = logging.getLogger(__name__)
+
+# how far behind the primary a replica is, in seconds, or NULL if it isn't streaming from the primary.
+# a streaming replica which has replayed everything it has received is considered caught up,
+# since pg_last_xact_replay_timestamp() doesn't advance while the primary is idle.
+# One whose WAL receiver has disconnected has also replayed everything it received, but it's falling behind.
+# Seeing pg_stat_wal_receiver.status needs the pg_read_all_stats role (or pg_monitor).
+LAG_QUERY = """
+	SELECT CASE
+		WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+		WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+		ELSE extract(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+	END
+"""
+
+class Replica:
+	__slots__ = ('pool', 'lag')
+
+	def __init__(self, pool):
+		self.pool = pool
+		# None until the first successful lag check, or if the last one failed
+		self.lag = None
+
+class ReplicaSet:
+	"""Read replicas of the primary database, and which of them are currently fit to read from.
+
+	A replica is used only while its replication lag is at most max_lag seconds.
+	After a guild is written to, its reads go to the primary for max_lag seconds,
+	so that a replica can't hand back data from before the write.
+	"""
+	def __init__(self, config):
+		self.config = config
+		self.max_lag = config.get('max_lag', 5)
+		self.check_interval = config.get('check_interval', 10)
+		self.replicas = []
+		# guild_id → time.monotonic() of the last write
+		self.last_writes = {}
+
+	async def connect(self, base_config):
+		async def create_pool(replica_config):
+			return await asyncpg.create_pool(**{**base_config, **replica_config})
+
+		pools = await asyncio.gather(*map(create_pool, self.config['replicas']))
+		self.replicas = list(map(Replica, pools))
+		await self.check_lag()
+		self.task = asyncio.ensure_future(self.check_lag_forever())
+
+	async def close(self):
+		with contextlib.suppress(AttributeError):
+			self.task.cancel()
+		await asyncio.gather(*(replica.pool.close() for replica in self.replicas))
+
+	async def check_lag_forever(self):
+		while True:
+			await asyncio.sleep(self.check_interval)
+			await self.check_lag()
+
+	async def check_lag(self):
+		async def check(replica):
+			try:
+				replica.lag = await asyncio.wait_for(replica.pool.fetchval(LAG_QUERY), timeout=self.max_lag)
+				if replica.lag is None:
+					logger.warning('A read replica is not streaming from the primary, so it is not being used')
+			except (asyncio.TimeoutError, OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+				logger.warning('Lag check of a read replica failed', exc_info=True)
+				replica.lag = None
+
+		await asyncio.gather(*map(check, self.replicas))
+
+	def note_write(self, guild_id):
+		self.last_writes[guild_id] = time.monotonic()
+
+	def pool(self, guild_id=None):
+		"""return the replica pool to use for reading guild_id's data, or None if the primary should be used"""
+		last_write = self.last_writes.get(guild_id)
+		if last_write is not None:
+			if time.monotonic() - last_write < self.max_lag:
+				return None
+			del self.last_writes[guild_id]
+
+		healthy = [replica for replica in self.replicas if replica.lag is not None and replica.lag <= self.max_lag]
+		if not healthy:
+			return None
+		return random.choice(healthy).pool
+
+def _guild_id(x):
+	"""x is a member, a guild, or a guild ID"""
+	guild = getattr(x, 'guild', x)
+	return getattr(guild, 'id', guild)
+
+@contextlib.asynccontextmanager
+async def _acquire(pool):
+	try:
+		# allow someone to call a decorated function twice within the same Task
+		connection().is_closed()
+	except (asyncpg.InterfaceError, LookupError):
+		# once this is released, using it raises InterfaceError, so later calls acquire a new connection
+		async with pool.acquire() as conn:
+			connection.set(conn)
+			yield conn
+	else:
+		yield connection()
+
+def optional_read_connection(func):
+	"""Like bot_bin.sql.optional_connection, but the connection may be to a read replica.
+
+	Only use this for functions that never write.
+	The first argument of the decorated function must be a member, guild, or guild ID.
+	If a connection has already been acquired in this task, that one is used instead.
+	"""
+	if inspect.isasyncgenfunction(func):
+		@functools.wraps(func)
+		async def inner(self, guild, *args, **kwargs):
+			async with _acquire(self.bot.read_pool(_guild_id(guild))):
+				async for x in func(self, guild, *args, **kwargs):
+					yield x
+	else:
+		@functools.wraps(func)
+		async def inner(self, guild, *args, **kwargs):
+			async with _acquire(self.bot.read_pool(_guild_id(guild))):
+				return await func(self, guild, *args, **kwargs)
+
+	return inner
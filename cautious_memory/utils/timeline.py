@@ -0,0 +1,68 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import time
+
+class StartupTimeline:
+	"""Records when each step of startup happened and how long it took.
+
+	Times are in seconds relative to origin, a time.perf_counter() value.
+	"""
+	def __init__(self, origin):
+		self.origin = origin
+		# (name, start, duration), where duration is None for instantaneous events
+		self.events = []
+		self._marked = set()
+
+	def add(self, name, start, end=None):
+		self.events.append((name, start - self.origin, None if end is None else end - start))
+
+	@contextlib.contextmanager
+	def span(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, start, time.perf_counter())
+
+	async def timed(self, name, aw):
+		with self.span(name):
+			return await aw
+
+	def mark(self, name):
+		"""record an instantaneous event, the first time it happens. Return whether this was the first time."""
+		if name in self._marked:
+			return False
+		self._marked.add(name)
+		self.add(name, time.perf_counter())
+		return True
+
+	def elapsed(self, name):
+		"""return when the named event happened, or None if it hasn't yet"""
+		for event_name, start, duration in self.events:
+			if event_name == name:
+				return start
+		return None
+
+	def format(self):
+		width = max((len(name) for name, *_ in self.events), default=0)
+		lines = []
+		for name, start, duration in sorted(self.events, key=lambda event: event[1]):
+			line = f'{start * 1000:9.1f} ms  {name:<{width}}'
+			if duration is not None:
+				line += f'  {duration * 1000:8.1f} ms'
+			lines.append(line.rstrip())
+		return '\n'.join(lines)
@@ -9,6 +9,8 @@ setuptools.setup(
 	packages=[
 		'cautious_memory',
 		'cautious_memory.cogs',
+		'cautious_memory.cogs.changelog',
+		'cautious_memory.cogs.export',
 		'cautious_memory.cogs.permissions',
 		'cautious_memory.cogs.wiki',
 		'cautious_memory.utils',
@@ -17,12 +19,17 @@ setuptools.setup(
 	include_package_data=True,
 
 	install_requires=[
-		'asyncpg',
+		'asyncpg>=0.22.0',
 		'bot_bin[sql]>=1.1.0,<2.0.0',
 		'braceexpand',
-		'discord.py>=1.2.2,<2.0.0',
+		'discord.py>=1.5,<2.0.0',
 		'jinja2',
 		'jishaku>=1.14.0',
 		'json5',
 	],
+
+	extras_require={
+		# for the slash commands server (cogs/interactions.py)
+		'interactions': ['PyNaCl'],
+	},
 )